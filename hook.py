@@ -2,22 +2,24 @@
 import os
 import sys
 import logging
+import logging.handlers
 
-# Set up logging to troubleshoot
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='minimax_app.log'
+# Giữ tạm log trong bộ nhớ; main.setup_logging sẽ chuyển chúng vào
+# file log JSON lines chung thay vì mở một file log riêng
+logging.getLogger().addHandler(
+    logging.handlers.MemoryHandler(capacity=1000, flushLevel=logging.CRITICAL + 1)
 )
+logging.getLogger().setLevel(logging.INFO)
+hook_logger = logging.getLogger("minimax.hook")
 
 try:
     import numpy
-    logging.info(f"NumPy loaded successfully: version {numpy.__version__}")
+    hook_logger.info("NumPy loaded successfully: version %s", numpy.__version__)
 except Exception as e:
-    logging.error(f"Error loading NumPy: {e}")
+    hook_logger.error("Error loading NumPy: %s", e)
 
 try:
     import pandas
-    logging.info(f"Pandas loaded successfully: version {pandas.__version__}")
+    hook_logger.info("Pandas loaded successfully: version %s", pandas.__version__)
 except Exception as e:
-    logging.error(f"Error loading Pandas: {e}")
+    hook_logger.error("Error loading Pandas: %s", e)
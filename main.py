@@ -1,24 +1,54 @@
 import os
 import sys
+import ctypes
+import ctypes.util
+import argparse
+import asyncio
+import atexit
 import time
 import requests
 import json
 import pandas as pd
+import numpy as np
 import base64
+import gzip
+import zlib
 import threading
+import hashlib
+import hmac
+import secrets
+import re
+import random
+import string
+import shutil
+import select
+import signal
+import struct
+import tempfile
+import bisect
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import queue
+import uuid
+import urllib.parse
+from collections import deque, namedtuple
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk
 import configparser
 import logging
-from datetime import datetime
+import logging.handlers
+from datetime import datetime, timedelta
 
-# Cấu hình logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Logger theo từng thành phần, mức log chỉnh riêng trong mục [Logging] của config.ini
+logger = logging.getLogger("minimax")
+config_logger = logging.getLogger("minimax.config")
+api_logger = logging.getLogger("minimax.api")
+queue_logger = logging.getLogger("minimax.queue")
+download_logger = logging.getLogger("minimax.download")
+data_logger = logging.getLogger("minimax.data")
+app_logger = logging.getLogger("minimax.app")
+diag_logger = logging.getLogger("minimax.diagnostics")
 
 # Hỗ trợ bundling resource vào file exe
 def resource_path(relative_path):
@@ -37,6 +67,275 @@ def ensure_app_dirs():
     os.makedirs(app_data_dir, exist_ok=True)
     return app_data_dir
 
+ConfigSnapshot = namedtuple('ConfigSnapshot', [
+    'api_key', 'output_folder', 'max_videos_per_image', 'model',
+    'max_concurrent_tasks', 'poll_interval', 'download_workers',
+    'disk_write_mbps', 'post_processing', 'skip_existing',
+    'download_bandwidth_kbps', 'min_free_space_mb', 'max_retries', 'retry_delay',
+    'service_port', 'model_concurrency', 'upload_gzip', 'service_input_folder'
+])
+
+# Trạng thái hàng đợi bất biến, thay bằng bản mới (version tăng dần) mỗi khi hàng đợi thay đổi.
+# Thống kê, giao diện và dịch vụ HTTP chỉ đọc snapshot nên không cần lock.
+QueueSnapshot = namedtuple('QueueSnapshot', [
+    'version', 'queued', 'active', 'downloading', 'completed', 'failed', 'cancelled',
+    'total', 'paused', 'draining', 'groups_done', 'groups_total', 'active_starts', 'models',
+    'endpoint_paused'
+])
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Định dạng mỗi bản ghi log thành một dòng JSON"""
+    
+    # Các trường ngữ cảnh truyền qua extra={...}
+    CONTEXT_FIELDS = ('task_id', 'job_id', 'stage', 'duration', 'diagnostics')
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for field in self.CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def load_log_levels(config_file):
+    """Đọc mức log theo từng logger từ mục [Logging] của config.ini
+
+    Ví dụ: level = INFO, minimax.queue = DEBUG
+    """
+    levels = {'': 'INFO'}
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(config_file)
+    except configparser.Error:
+        return levels
+    if 'Logging' in parser:
+        for name, level in parser['Logging'].items():
+            levels['' if name == 'level' else name] = level.upper()
+    return levels
+
+
+def setup_logging(log_dir, levels=None, max_bytes=5 * 1024 * 1024, backup_count=5):
+    """Cấu hình logging bất đồng bộ: luồng gọi chỉ đẩy bản ghi vào hàng đợi,
+    QueueListener ghi ra file JSON lines (xoay vòng theo dung lượng) và console.
+
+    Trả về QueueListener, cần gọi stop() khi thoát để ghi nốt log.
+    """
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, 'minimax_app.jsonl'),
+        maxBytes=max_bytes,
+        backupCount=backup_count,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonLinesFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    
+    root = logging.getLogger()
+    buffered = [h for h in root.handlers if isinstance(h, logging.handlers.MemoryHandler)]
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    
+    for name, level in (levels or {'': 'INFO'}).items():
+        try:
+            logging.getLogger(name or None).setLevel(level)
+        except (ValueError, TypeError):
+            logger.warning("Mức log không hợp lệ cho '%s': %s", name, level)
+    
+    listener.start()
+    
+    # Chuyển các bản ghi hook.py giữ tạm trước khi logging được cấu hình
+    for handler in buffered:
+        handler.setTarget(queue_handler)
+        handler.flush()
+        handler.close()
+    
+    return listener
+
+
+def benchmark_logging(events=1000, rate=1000):
+    """Đo chi phí ghi log trên luồng gọi ở tốc độ rate sự kiện/giây (micro giây/sự kiện)"""
+    bench_logger = logging.getLogger("minimax.benchmark")
+    interval = 1.0 / rate
+    total = 0.0
+    for i in range(events):
+        start = time.perf_counter()
+        bench_logger.info("Sự kiện %d", i, extra={'task_id': 'bench', 'stage': 'benchmark', 'duration': 0.0})
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        time.sleep(max(0.0, interval - elapsed))
+    return total / events * 1e6
+
+
+class SamplingProfiler:
+    """Profiler lấy mẫu: định kỳ chụp stack của mọi luồng qua sys._current_frames()
+
+    Kết quả ghi dạng folded stacks (mỗi dòng "luồng;hàm;hàm số_mẫu"), dùng trực tiếp
+    với flamegraph.pl hoặc speedscope. Khi đang bật, cứ diagnostics_interval giây lại
+    ghi trạng thái các luồng và số liệu từ diagnostics() vào log minimax.diagnostics.
+    """
+    
+    # Hàm ở đỉnh stack cho thấy luồng đang chờ (khóa, I/O, hàng đợi) chứ không chạy
+    WAIT_FUNCTIONS = frozenset(('wait', 'acquire', 'sleep', 'select', 'poll', 'get', 'read', 'readinto',
+                                'recv_into', 'accept', 'mainloop', '_wait_for_tstate_lock', '_worker'))
+    
+    def __init__(self, output_folder, interval=0.01, diagnostics=None, diagnostics_interval=30):
+        self.output_folder = output_folder
+        self.interval = interval  # Giây giữa hai lần lấy mẫu
+        self.diagnostics = diagnostics  # Hàm trả về dict số liệu thêm vào log chẩn đoán
+        self.diagnostics_interval = diagnostics_interval
+        self.stacks = {}  # stack đã gộp -> số mẫu
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._toggle_lock = threading.Lock()
+    
+    @property
+    def running(self):
+        return self._thread is not None
+    
+    def start(self):
+        """Bắt đầu lấy mẫu (bỏ kết quả của lần trước)"""
+        if self._thread:
+            return
+        self.stacks = {}
+        self.samples = 0
+        self.started = datetime.now()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="profiler")
+        self._thread.start()
+        app_logger.info("Bắt đầu profiling, lấy mẫu mỗi %.0f ms", self.interval * 1000)
+    
+    def stop(self):
+        """Dừng lấy mẫu, ghi file profile và trả về đường dẫn (None nếu chưa bật)"""
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return self.write()
+    
+    def toggle(self):
+        """Bật/tắt profiling, trả về đường dẫn file profile khi tắt"""
+        # Nút trên giao diện và tín hiệu có thể bật/tắt cùng lúc từ hai luồng
+        with self._toggle_lock:
+            if self.running:
+                return self.stop()
+            self.start()
+            return None
+    
+    def _run(self):
+        own = threading.get_ident()
+        next_diagnostics = time.monotonic()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stack = self._fold(names.get(ident, str(ident)), frame)
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+            
+            if self.diagnostics_interval and time.monotonic() >= next_diagnostics:
+                self.log_diagnostics()
+                next_diagnostics = time.monotonic() + self.diagnostics_interval
+    
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    def _fold(self, thread_name, frame):
+        """Stack của một luồng dạng luồng;hàm ngoài cùng;...;hàm đang chạy"""
+        names = []
+        while frame is not None:
+            names.append(self._frame_name(frame))
+            frame = frame.f_back
+        names.append(thread_name)
+        return ";".join(reversed(names))
+    
+    def write(self):
+        """Ghi các stack đã gộp ra file .folded trong output_folder"""
+        os.makedirs(self.output_folder, exist_ok=True)
+        path = os.path.join(self.output_folder, f"profile_{self.started:%Y%m%d_%H%M%S}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        app_logger.info("Đã ghi profile %d mẫu vào %s", self.samples, path)
+        return path
+    
+    def log_diagnostics(self):
+        """Ghi trạng thái các luồng và số liệu hàng đợi/HTTP vào log chẩn đoán"""
+        frames = sys._current_frames()
+        threads = {}
+        for thread in threading.enumerate():
+            frame = frames.get(thread.ident)
+            if frame is None or thread is threading.current_thread():
+                continue
+            state = "waiting" if frame.f_code.co_name in self.WAIT_FUNCTIONS else "running"
+            threads[thread.name] = f"{state}: {self._frame_name(frame)}"
+        
+        data = {'threads': threads}
+        if self.diagnostics:
+            try:
+                data.update(self.diagnostics())
+            except Exception as e:
+                diag_logger.error("Lỗi khi lấy số liệu chẩn đoán: %s", e)
+        diag_logger.info("Chẩn đoán: %d luồng", len(threads), extra={'diagnostics': data})
+        return data
+
+
+def install_profile_signal(profiler):
+    """Bật/tắt profiler khi nhận SIGUSR1 (POSIX) hoặc SIGBREAK (Windows, Ctrl+Break)
+
+    Trình xử lý tín hiệu chỉ đặt cờ; việc dừng luồng lấy mẫu và ghi file chạy trên luồng
+    profile-signal để không chặn luồng chính. Trả về tín hiệu đã đăng ký, None nếu hệ điều
+    hành không hỗ trợ.
+    """
+    signum = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+    if signum is None:
+        return None
+    requested = threading.Event()
+    
+    def run():
+        while True:
+            requested.wait()
+            requested.clear()
+            try:
+                profiler.toggle()
+            except Exception as e:
+                app_logger.error("Lỗi khi bật/tắt profiling: %s", e)
+    
+    threading.Thread(target=run, daemon=True, name="profile-signal").start()
+    signal.signal(signum, lambda signum, frame: requested.set())
+    return signum
+
+
+# Các chuyển động camera được mô hình Director hỗ trợ, viết trong prompt dạng [Pan left]
+CAMERA_MOVES = (
+    "Truck left", "Truck right",
+    "Pan left", "Pan right",
+    "Push in", "Pull out",
+    "Pedestal up", "Pedestal down",
+    "Tilt up", "Tilt down",
+    "Zoom in", "Zoom out",
+    "Shake", "Tracking shot", "Static shot"
+)
+
 class ConfigManager:
     def __init__(self):
         self.app_data_dir = ensure_app_dirs()
@@ -49,13 +348,37 @@ class ConfigManager:
         self.max_videos_per_image = 1
         self.model = "I2V-01-Director"
         self.max_concurrent_tasks = 3
+        self.poll_interval = 10
+        self.download_workers = 2
+        self.disk_write_mbps = 0  # 0 = không giới hạn
+        self.post_processing = "checksum,validate_mp4"  # thêm "poster" để tạo ảnh poster cho mỗi video
+        self.skip_existing = True
+        self.download_bandwidth_kbps = 0  # 0 = không giới hạn
+        self.min_free_space_mb = 1024
+        self.max_retries = 0  # Số lần gửi lại task khi lỗi tạo/xử lý trên server
+        self.retry_delay = 30  # Giây chờ trước lần gửi lại đầu tiên, tăng gấp đôi mỗi lần
+        self.service_port = 0  # Cổng dịch vụ nhận task cục bộ, 0 = tắt
+        self.upload_gzip = False  # Nén gzip body khi gửi ảnh (chỉ bật nếu endpoint chấp nhận)
+        self.model_concurrency = ""  # Giới hạn task đồng thời mỗi key theo model, ví dụ "I2V-01-Director=2, T2V-01=3"
+        self.service_input_folder = os.path.expanduser("~")  # Dịch vụ chỉ nhận ảnh nằm trong thư mục này
+        
+        # Snapshot bất biến được công bố cho các thành phần đang chạy
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.snapshot = None
+        self._file_stamp = None
+        self._watch_stop = threading.Event()
+        self._watch_thread = None
         
         # Đọc cấu hình hoặc tạo mới
         if os.path.exists(self.config_file):
             self.config.read(self.config_file)
             self.load_config()
+            self._file_stamp = self._stat_config_file()
         else:
             self.create_default_config()
+        
+        self.snapshot = self._build_snapshot()
     
     def load_config(self):
         """Tải cấu hình từ file"""
@@ -66,116 +389,1643 @@ class ConfigManager:
             self.max_videos_per_image = int(self.config['Settings'].get('max_videos_per_image', 1))
             self.model = self.config['Settings'].get('model', "I2V-01-Director")
             self.max_concurrent_tasks = int(self.config['Settings'].get('max_concurrent_tasks', 3))
+            self.poll_interval = float(self.config['Settings'].get('poll_interval', 10))
+            self.download_workers = int(self.config['Settings'].get('download_workers', 2))
+            self.disk_write_mbps = float(self.config['Settings'].get('disk_write_mbps', 0))
+            self.post_processing = self.config['Settings'].get('post_processing', "checksum,validate_mp4")
+            self.skip_existing = self.config['Settings'].getboolean('skip_existing', True)
+            self.download_bandwidth_kbps = float(self.config['Settings'].get('download_bandwidth_kbps', 0))
+            self.min_free_space_mb = float(self.config['Settings'].get('min_free_space_mb', 1024))
+            self.max_retries = int(self.config['Settings'].get('max_retries', 0))
+            self.retry_delay = float(self.config['Settings'].get('retry_delay', 30))
+            self.service_port = int(self.config['Settings'].get('service_port', 0))
+            self.model_concurrency = self.config['Settings'].get('model_concurrency', "")
+            self.upload_gzip = self.config['Settings'].getboolean('upload_gzip', False)
+            self.service_input_folder = self.config['Settings'].get('service_input_folder', os.path.expanduser("~"))
     
     def create_default_config(self):
         """Tạo cấu hình mặc định"""
-        self.config['API'] = {'key': ""}
-        self.config['Settings'] = {
-            'output_folder': self.output_folder,
-            'max_videos_per_image': str(self.max_videos_per_image),
-            'model': self.model,
-            'max_concurrent_tasks': str(self.max_concurrent_tasks)
-        }
         self.save_config()
     
     def save_config(self):
-        """Lưu cấu hình hiện tại vào file"""
-        self.config['API'] = {'key': self.api_key}
-        self.config['Settings'] = {
-            'output_folder': self.output_folder,
-            'max_videos_per_image': str(self.max_videos_per_image),
-            'model': self.model,
-            'max_concurrent_tasks': str(self.max_concurrent_tasks)
+        """Lưu cấu hình hiện tại vào file và công bố snapshot mới"""
+        with self.lock:
+            self.config['API'] = {'key': self.api_key}
+            self.config['Settings'] = {
+                'output_folder': self.output_folder,
+                'max_videos_per_image': str(self.max_videos_per_image),
+                'model': self.model,
+                'max_concurrent_tasks': str(self.max_concurrent_tasks),
+                'poll_interval': str(self.poll_interval),
+                'download_workers': str(self.download_workers),
+                'disk_write_mbps': str(self.disk_write_mbps),
+                'post_processing': self.post_processing,
+                'skip_existing': str(self.skip_existing),
+                'download_bandwidth_kbps': str(self.download_bandwidth_kbps),
+                'min_free_space_mb': str(self.min_free_space_mb),
+                'max_retries': str(self.max_retries),
+                'retry_delay': str(self.retry_delay),
+                'service_port': str(self.service_port),
+                'model_concurrency': self.model_concurrency,
+                'upload_gzip': str(self.upload_gzip),
+                'service_input_folder': self.service_input_folder
+            }
+            
+            # Ghi ra file tạm rồi đổi tên để trình theo dõi không đọc phải file dở dang
+            temp_file = self.config_file + ".tmp"
+            with open(temp_file, 'w') as f:
+                self.config.write(f)
+            os.replace(temp_file, self.config_file)
+            self._file_stamp = self._stat_config_file()
+        
+        self._publish()
+    
+    def update(self, **changes):
+        """Cập nhật một số thiết lập, lưu file và công bố snapshot mới"""
+        with self.lock:
+            for name, value in changes.items():
+                if name not in ConfigSnapshot._fields:
+                    raise KeyError(f"Thiết lập không hợp lệ: {name}")
+                setattr(self, name, value)
+            self.save_config()
+        return self.snapshot
+    
+    def subscribe(self, callback):
+        """Đăng ký nhận snapshot mỗi khi cấu hình thay đổi"""
+        self.listeners.append(callback)
+        return callback
+    
+    def _build_snapshot(self):
+        return ConfigSnapshot(*(getattr(self, name) for name in ConfigSnapshot._fields))
+    
+    def _publish(self):
+        """Thay snapshot hiện tại và thông báo nếu có thay đổi"""
+        with self.lock:
+            snapshot = self._build_snapshot()
+            if snapshot == self.snapshot:
+                return
+            self.snapshot = snapshot
+        
+        for callback in list(self.listeners):
+            try:
+                callback(snapshot)
+            except Exception as e:
+                config_logger.error("Lỗi khi áp dụng cấu hình mới: %s", e)
+    
+    def _stat_config_file(self):
+        try:
+            stat = os.stat(self.config_file)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+    
+    def reload(self):
+        """Đọc lại file cấu hình nếu đã bị sửa từ bên ngoài"""
+        stamp = self._stat_config_file()
+        if stamp is None or stamp == self._file_stamp:
+            return False
+        
+        parser = configparser.ConfigParser()
+        with self.lock:
+            previous = self._build_snapshot()
+            previous_config = self.config
+            try:
+                parser.read(self.config_file)
+                self.config = parser
+                self.load_config()
+            except (configparser.Error, ValueError) as e:
+                # Khôi phục toàn bộ giá trị cũ và parser cũ nếu file lỗi giữa chừng,
+                # để lần save_config sau không ghi lại các giá trị bị từ chối
+                self.config = previous_config
+                for name, value in previous._asdict().items():
+                    setattr(self, name, value)
+                config_logger.error("File cấu hình không hợp lệ, giữ cấu hình cũ: %s", e)
+                return False
+            finally:
+                self._file_stamp = stamp
+        
+        config_logger.info("Đã tải lại cấu hình từ file")
+        self._publish()
+        return True
+    
+    def start_watching(self, interval=2.0):
+        """Theo dõi file cấu hình và tự tải lại khi thay đổi"""
+        if self._watch_thread and self._watch_thread.is_alive():
+            return
+        
+        self._watch_stop.clear()
+        
+        def watch():
+            while not self._watch_stop.wait(interval):
+                self.reload()
+        
+        self._watch_thread = threading.Thread(target=watch, daemon=True, name="config-watcher")
+        self._watch_thread.start()
+    
+    def stop_watching(self):
+        """Dừng theo dõi file cấu hình"""
+        self._watch_stop.set()
+
+
+def parse_api_keys(value):
+    """Tách chuỗi cấu hình thành danh sách (key, trọng số)
+
+    Các key phân tách bằng dấu phẩy hoặc xuống dòng, trọng số tùy chọn
+    viết sau dấu ':' (ví dụ: "key1:3, key2").
+    """
+    if isinstance(value, (list, tuple)):
+        entries = list(value)
+    else:
+        entries = (value or "").replace("\n", ",").split(",")
+    
+    keys = []
+    for entry in entries:
+        if isinstance(entry, tuple):
+            keys.append(entry)
+            continue
+        entry = entry.strip()
+        if not entry:
+            continue
+        key, weight = entry, 1.0
+        if ":" in entry:
+            head, tail = entry.rsplit(":", 1)
+            try:
+                weight = float(tail)
+                key = head.strip()
+            except ValueError:
+                pass
+        keys.append((key, max(weight, 0.0)))
+    return keys
+
+
+def parse_model_limits(value):
+    """Tách chuỗi cấu hình thành dict model -> số task đồng thời mỗi key
+
+    Các cặp "model=số" phân tách bằng dấu phẩy hoặc xuống dòng; model không
+    có trong danh sách chỉ bị giới hạn bởi max_concurrent_tasks.
+    """
+    if isinstance(value, dict):
+        return dict(value)
+    
+    limits = {}
+    for entry in (value or "").replace("\n", ",").split(","):
+        if "=" not in entry:
+            continue
+        model, limit = entry.rsplit("=", 1)
+        try:
+            limits[model.strip()] = max(int(limit), 0)
+        except ValueError:
+            continue
+    return limits
+
+
+class SystemClock:
+    """Đồng hồ thật; hàng đợi, thống kê và key pool đều lấy thời gian qua đồng hồ được truyền vào"""
+    
+    def monotonic(self):
+        return time.monotonic()
+    
+    def now(self):
+        return datetime.now()
+    
+    def sleep(self, seconds):
+        time.sleep(seconds)
+    
+    def wait(self, event, timeout=None):
+        """Chờ event tối đa timeout giây (None = chờ tới khi được set)"""
+        return event.wait(timeout)
+
+
+class ScaledClock(SystemClock):
+    """Đồng hồ chạy nhanh hơn thời gian thật speed lần, dùng khi chạy lại trace"""
+    
+    def __init__(self, speed=100.0):
+        self.speed = speed
+        self.origin = time.monotonic()
+        self.start = datetime.now()
+    
+    def monotonic(self):
+        return self.origin + (time.monotonic() - self.origin) * self.speed
+    
+    def now(self):
+        return self.start + timedelta(seconds=self.monotonic() - self.origin)
+    
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speed)
+    
+    def wait(self, event, timeout=None):
+        return event.wait(None if timeout is None else timeout / self.speed)
+
+
+class SimulatedClock(SystemClock):
+    """Đồng hồ ảo chỉ tiến khi được gọi advance/sleep/wait (dùng trong một luồng duy nhất)"""
+    
+    def __init__(self, start=None):
+        self.start = start or datetime(2024, 1, 1)
+        self.elapsed = 0.0
+    
+    def monotonic(self):
+        return self.elapsed
+    
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+    
+    def advance(self, seconds):
+        self.elapsed += max(0.0, seconds)
+    
+    def sleep(self, seconds):
+        self.advance(seconds)
+    
+    def wait(self, event, timeout=None):
+        if not event.is_set() and timeout is not None:
+            self.advance(timeout)
+        return event.is_set()
+
+
+DEFAULT_CLOCK = SystemClock()
+
+
+class NoAvailableKeyError(Exception):
+    """Không còn API key nào có thể nhận task mới"""
+
+
+class CircuitOpenError(Exception):
+    """Endpoint đang bị ngắt do lỗi liên tiếp, chưa tới lúc thử lại"""
+    
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"Endpoint {endpoint} tạm ngắt, thử lại sau {retry_after:.0f} giây")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class LowDiskSpaceError(Exception):
+    """Video lớn hơn ước tính và không đủ chỗ trên đĩa, cần đóng kết nối để chờ rồi tải lại"""
+    
+    def __init__(self, expected_bytes):
+        super().__init__(f"Không đủ dung lượng trống cho {expected_bytes / 1024 ** 2:.0f} MB")
+        self.expected_bytes = expected_bytes
+
+
+class APIKeyPool:
+    """Phân phối task giữa nhiều API key theo trọng số và dung lượng còn lại"""
+    
+    # Mã lỗi base_resp của MiniMax
+    RATE_LIMIT_CODES = (1002, 1039)
+    FATAL_CODES = (1004, 1008)  # Sai key hoặc hết số dư
+    
+    def __init__(self, keys, max_tasks_per_key=None, cooldown=60, max_consecutive_errors=3, clock=None):
+        self.clock = clock or DEFAULT_CLOCK
+        self.max_tasks_per_key = max_tasks_per_key
+        self.cooldown = cooldown
+        self.max_consecutive_errors = max_consecutive_errors
+        self.lock = threading.Lock()
+        self.entries = {}
+        for key, weight in keys:
+            self.entries[key] = self._new_entry(key, weight)
+    
+    def _new_entry(self, key, weight):
+        return {
+            'key': key,
+            'weight': weight,
+            'in_flight': 0,
+            'submitted': 0,
+            'errors': 0,
+            'disabled': weight <= 0,
+            'failed': False,  # bị vô hiệu hóa do sai key hoặc hết số dư
+            'removed': False,
+            'cooldown_until': 0.0
         }
+    
+    def set_keys(self, keys, max_tasks_per_key=None):
+        """Cập nhật danh sách key tại chỗ, giữ số task đang chạy của key cũ
+
+        Key bị vô hiệu hóa do sai key/hết số dư vẫn bị tắt nếu không đổi; đổi trọng số để bật lại.
+        """
+        with self.lock:
+            self.max_tasks_per_key = max_tasks_per_key
+            new_keys = dict(keys)
+            for key, entry in self.entries.items():
+                if key in new_keys:
+                    if new_keys[key] != entry['weight']:
+                        entry['failed'] = False
+                    entry['weight'] = new_keys[key]
+                    entry['removed'] = False
+                    entry['disabled'] = new_keys[key] <= 0 or entry['failed']
+                else:
+                    # Key bị gỡ vẫn được giữ để các task đang chạy truy vấn tiếp
+                    entry['removed'] = True
+            for key, weight in keys:
+                if key not in self.entries:
+                    self.entries[key] = self._new_entry(key, weight)
+            
+            # Xóa hẳn key đã gỡ và không còn task nào
+            for key in [k for k, e in self.entries.items() if e['removed'] and e['in_flight'] == 0]:
+                del self.entries[key]
+    
+    def _is_available(self, entry, now):
+        if entry['disabled'] or entry['removed'] or entry['cooldown_until'] > now:
+            return False
+        if self.max_tasks_per_key and entry['in_flight'] >= self.max_tasks_per_key:
+            return False
+        return True
+    
+    def acquire(self):
+        """Chọn key có tải tương đối thấp nhất so với trọng số"""
+        now = self.clock.monotonic()
+        with self.lock:
+            candidates = [e for e in self.entries.values() if self._is_available(e, now)]
+            if not candidates:
+                raise NoAvailableKeyError("Không còn API key khả dụng")
+            
+            entry = min(candidates, key=lambda e: (e['in_flight'] / e['weight'], e['submitted'] / e['weight']))
+            entry['in_flight'] += 1
+            entry['submitted'] += 1
+            return entry['key']
+    
+    def release(self, key):
+        """Trả lại một suất xử lý cho key"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['in_flight'] > 0:
+                entry['in_flight'] -= 1
+                if entry['removed'] and entry['in_flight'] == 0:
+                    del self.entries[key]
+    
+    def report_success(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry['errors'] = 0
+    
+    def report_error(self, key, code=None):
+        """Ghi nhận lỗi, tự loại key khỏi vòng quay khi cần"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return
+            
+            entry['errors'] += 1
+            if code in self.FATAL_CODES:
+                entry['disabled'] = True
+                entry['failed'] = True
+                api_logger.warning("Vô hiệu hóa API key ...%s (mã lỗi %s)", key[-4:], code)
+            elif code in self.RATE_LIMIT_CODES or entry['errors'] >= self.max_consecutive_errors:
+                # Tạm nghỉ, thời gian tăng dần theo số lỗi liên tiếp
+                delay = self.cooldown * min(2 ** max(entry['errors'] - 1, 0), 16)
+                entry['cooldown_until'] = self.clock.monotonic() + delay
+                api_logger.warning("Tạm ngưng API key ...%s trong %d giây", key[-4:], delay)
+    
+    def available_count(self):
+        """Số key chưa bị vô hiệu hóa hoặc tạm ngưng"""
+        now = self.clock.monotonic()
+        with self.lock:
+            return sum(1 for e in self.entries.values()
+                       if not e['disabled'] and not e['removed'] and e['cooldown_until'] <= now)
+    
+    def __len__(self):
+        return len(self.entries)
+
+
+class CircuitBreaker:
+    """Bộ ngắt mạch cho một endpoint: closed -> open -> half_open -> closed
+
+    closed: ghi nhận kết quả các lượt gọi trong cửa sổ window giây, mở khi có ít nhất
+    min_calls lượt và tỷ lệ lỗi >= failure_threshold, hoặc khi min_calls lượt liên tiếp
+    đều lỗi (cửa sổ còn nhiều lượt thành công từ trước sự cố). open: từ chối mọi lượt gọi trong
+    open_seconds (tăng gấp đôi mỗi lần mở lại, tối đa max_open_seconds). half_open: cho
+    đúng một lượt thử, thành công thì đóng lại, lỗi thì mở lại.
+    """
+    
+    def __init__(self, name, window=60, min_calls=5, failure_threshold=0.5, open_seconds=30,
+                 max_open_seconds=600, clock=None):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.clock = clock or DEFAULT_CLOCK
+        self.lock = threading.Lock()
+        
+        self.calls = deque()  # (thời điểm, thành công) trong cửa sổ hiện tại
+        self.failures = 0
+        self.consecutive_failures = 0
+        self._state = 'closed'
+        self.open_seconds = open_seconds
+        self.opened_at = 0.0
+        self.trial = False  # đang có lượt thử ở trạng thái half_open
+        
+        # Callback
+        self.on_state_changed = None  # (breaker, trạng thái mới)
+    
+    @property
+    def state(self):
+        with self.lock:
+            return self._current_state()
+    
+    def _current_state(self):
+        if self._state == 'open' and self.clock.monotonic() >= self.opened_at + self.open_seconds:
+            self._state = 'half_open'
+            self.trial = False
+        return self._state
+    
+    def retry_after(self):
+        """Số giây tới lúc được thử lại (0 nếu đang đóng hoặc đã tới lượt thử)"""
+        with self.lock:
+            if self._current_state() != 'open':
+                return 0.0
+            return max(0.0, self.opened_at + self.open_seconds - self.clock.monotonic())
+    
+    def before_call(self):
+        """Báo CircuitOpenError nếu endpoint đang ngắt hoặc đang có lượt thử khác"""
+        with self.lock:
+            state = self._current_state()
+            if state == 'closed':
+                return
+            if state == 'half_open' and not self.trial:
+                self.trial = True
+                return
+            retry_after = self.opened_at + self.open_seconds - self.clock.monotonic()
+        raise CircuitOpenError(self.name, max(retry_after, 1.0))
+    
+    def record(self, success):
+        """Ghi nhận kết quả một lượt gọi"""
+        changed = None
+        with self.lock:
+            now = self.clock.monotonic()
+            state = self._current_state()
+            if state == 'half_open':
+                if success:
+                    self._close()
+                    changed = 'closed'
+                else:
+                    self._open(now, self.open_seconds * 2)
+                    changed = 'open'
+            elif state == 'closed':
+                self.calls.append((now, success))
+                if success:
+                    self.consecutive_failures = 0
+                else:
+                    self.failures += 1
+                    self.consecutive_failures += 1
+                while self.calls and self.calls[0][0] < now - self.window:
+                    if not self.calls.popleft()[1]:
+                        self.failures -= 1
+                if len(self.calls) >= self.min_calls and (self.consecutive_failures >= self.min_calls or
+                                                          self.failures / len(self.calls) >= self.failure_threshold):
+                    self._open(now, self.base_open_seconds)
+                    changed = 'open'
+        
+        if changed:
+            if changed == 'open':
+                api_logger.warning("Ngắt endpoint %s trong %.0f giây do lỗi liên tiếp", self.name, self.open_seconds)
+            else:
+                api_logger.info("Endpoint %s hoạt động lại", self.name)
+            if self.on_state_changed:
+                self.on_state_changed(self, changed)
+    
+    def _open(self, now, open_seconds):
+        self._state = 'open'
+        self.opened_at = now
+        self.open_seconds = min(open_seconds, self.max_open_seconds)
+        self.trial = False
+    
+    def _close(self):
+        self._state = 'closed'
+        self.open_seconds = self.base_open_seconds
+        self.trial = False
+        self.calls.clear()
+        self.failures = 0
+        self.consecutive_failures = 0
+
+
+class Base64File:
+    """Ảnh trên đĩa được mã hóa base64 theo từng khối khi đọc, không giữ cả file trong bộ nhớ"""
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def __len__(self):
+        return (os.path.getsize(self.path) + 2) // 3 * 4
+    
+    def chunks(self, chunk_size):
+        # Khối đọc là bội số của 3 byte để nối các đoạn base64 không cần padding ở giữa
+        chunk_size -= chunk_size % 3
+        with open(self.path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                yield base64.b64encode(data)
+
+
+class StreamingBody:
+    """Body request được đọc dần theo từng khối thay vì ghép thành một chuỗi lớn
+
+    parts gồm các đoạn bytes và Base64File; requests gửi với Content-Length từ
+    __len__ và đọc qua __iter__/read, nên mỗi request chỉ giữ khoảng chunk_size byte.
+    """
+    
+    def __init__(self, parts, chunk_size=192 * 1024):
+        self.parts = parts
+        self.chunk_size = chunk_size
+        self._chunks = None
+        # Khối đang đọc dở: memoryview và vị trí đã đọc tới, không sao chép phần còn lại
+        self._view = memoryview(b"")
+        self._offset = 0
+    
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+    
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, Base64File):
+                yield from part.chunks(self.chunk_size)
+                continue
+            view = memoryview(part)
+            for offset in range(0, len(view), self.chunk_size):
+                yield view[offset:offset + self.chunk_size]
+    
+    def read(self, size=-1):
+        """Đọc tối đa size byte (size < 0: đọc hết phần còn lại)"""
+        if self._chunks is None:
+            self._chunks = iter(self)
+        
+        pieces = []
+        length = 0
+        while size < 0 or length < size:
+            if self._offset >= len(self._view):
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._view, self._offset = memoryview(chunk), 0
+            
+            available = len(self._view) - self._offset
+            take = available if size < 0 else min(available, size - length)
+            pieces.append(self._view[self._offset:self._offset + take])
+            self._offset += take
+            length += take
         
-        with open(self.config_file, 'w') as f:
-            self.config.write(f)
+        # Chỉ ghép khi lượt đọc trải qua nhiều khối
+        if len(pieces) == 1:
+            return pieces[0].tobytes()
+        return b"".join(pieces)
+    
+    def gzip_chunks(self, level=6):
+        """Các khối đã nén gzip (gửi dạng chunked vì không biết trước độ dài)"""
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        for chunk in self:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class SharedImagePayload:
+    """Ảnh đầu vào đã mã hóa base64, dùng chung cho mọi biến thể video của cùng một ảnh
+
+    Ảnh chỉ được đọc và mã hóa một lần; mỗi request chỉ ghép thêm phần model/prompt.
+    Với cache=False (ảnh chỉ dùng cho một task), ảnh được mã hóa từng khối ngay khi gửi.
+    """
+    
+    def __init__(self, image_path, cache=True):
+        self.image_path = image_path
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.encoded = None
+    
+    def get(self, encode_image):
+        """Trả về ảnh đã mã hóa (bytes ASCII), mã hóa bằng encode_image ở lần gọi đầu"""
+        with self.lock:
+            if self.encoded is None:
+                self.encoded = encode_image(self.image_path).encode('ascii')
+            return self.encoded
+    
+    def request_body(self, model, prompt, encode_image):
+        """Body JSON (StreamingBody) của request tạo task, không mã hóa lại ảnh"""
+        head = json.dumps({"model": model, "prompt": prompt})
+        image = self.get(encode_image) if self.cache else Base64File(self.image_path)
+        return StreamingBody([head[:-1].encode('utf-8') + b', "first_frame_image": "', image, b'"}'])
+    
+    def release(self):
+        """Giải phóng bộ nhớ khi không còn task nào cần ảnh này"""
+        with self.lock:
+            self.encoded = None
 
 
 class MiniMaxAPI:
-    def __init__(self, api_key):
-        self.api_key = api_key
+    # Mã HTTP cho thấy endpoint không nhận body nén gzip/chunked
+    GZIP_REJECTED_CODES = (411, 415)
+    # Các endpoint có bộ ngắt mạch riêng; create/query/retrieve cùng máy chủ API nên kiểm tra được bằng thăm dò
+    ENDPOINTS = ('create', 'query', 'retrieve', 'download')
+    PROBED_ENDPOINTS = ('create', 'query', 'retrieve')
+    # Số giây chờ thăm dò lại khi endpoint đã nửa mở nhưng lượt thử đang do request khác giữ
+    PROBE_RETRY = 1.0
+    
+    def __init__(self, api_key, max_tasks_per_key=None, clock=None, upload_gzip=False):
+        self.clock = clock or DEFAULT_CLOCK
+        self.upload_gzip = upload_gzip
+        self.key_pool = APIKeyPool(parse_api_keys(api_key), max_tasks_per_key=max_tasks_per_key, clock=self.clock)
+        self.api_key = next(iter(self.key_pool.entries), "")
         self.base_url = "https://api.minimaxi.chat/v1"
-        self.headers = {
-            'authorization': f'Bearer {self.api_key}',
+        self.headers = self._headers_for(self.api_key)
+        # Timeout (connect, read) cho mọi request để vòng lặp không bị treo vô hạn
+        self.timeout = (10, 60)
+        self.download_timeout = (10, 120)
+        # task_id -> key đã tạo task, dùng lại khi truy vấn và tải xuống
+        self.task_keys = {}
+        # TraceRecorder, khi được gán sẽ ghi lại mọi request để chạy lại offline
+        self.recorder = None
+        # Số lượt gọi HTTP đang chạy theo loại (create/query/retrieve/download), dùng cho log chẩn đoán
+        self.http_lock = threading.Lock()
+        self.in_flight = {}
+        self.breakers = {name: CircuitBreaker(name, clock=self.clock) for name in self.ENDPOINTS}
+    
+    def _headers_for(self, api_key):
+        return {
+            'authorization': f'Bearer {api_key}',
             'content-type': 'application/json'
         }
     
+    def _send(self, op, method, url, api_key, task_id=None, extra_headers=None, **kwargs):
+        """Gửi request tới API, ghi vào trace nếu đang bật"""
+        headers = self._headers_for(api_key)
+        if extra_headers:
+            headers.update(extra_headers)
+        start = time.monotonic()
+        self._track_call(op, 1)
+        try:
+            response = requests.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            if self.recorder:
+                self.recorder.record(op, start, task_id=task_id, error=str(e))
+            raise
+        finally:
+            self._track_call(op, -1)
+        
+        if self.recorder:
+            self.recorder.record(op, start, task_id=task_id, status=response.status_code, body=response.text)
+        return response
+    
+    def _call(self, op, method, url, api_key, task_id=None, **kwargs):
+        """Gửi request qua bộ ngắt mạch của endpoint: lỗi mạng và HTTP 5xx tính là lỗi endpoint"""
+        breaker = self.breakers[op]
+        breaker.before_call()
+        try:
+            response = self._send(op, method, url, api_key, task_id=task_id, **kwargs)
+        except requests.RequestException:
+            breaker.record(False)
+            raise
+        breaker.record(response.status_code < 500)
+        return response
+    
+    def endpoint_ready(self, op):
+        """Endpoint đang hoạt động bình thường (bộ ngắt mạch đóng)"""
+        return self.breakers[op].state == 'closed'
+    
+    def check_health(self):
+        """Thăm dò các endpoint đã hết thời gian ngắt, trả về True nếu máy chủ API không còn endpoint nào bị ngắt
+
+        Endpoint tải video (CDN) không được tính: nó tự hồi phục qua lượt tải kế tiếp
+        và không liên quan tới việc gửi task mới.
+
+        Lượt thăm dò là request truy vấn một task không tồn tại: máy chủ trả lời
+        (kể cả báo lỗi) là đủ, chỉ lỗi mạng hoặc HTTP 5xx mới tính là chưa hồi phục.
+        """
+        for name in self.PROBED_ENDPOINTS:
+            breaker = self.breakers[name]
+            if breaker.state != 'half_open':
+                continue
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                continue
+            breaker.record(self._probe())
+        return all(self.breakers[name].state == 'closed' for name in self.PROBED_ENDPOINTS)
+    
+    def _probe(self):
+        url = f"{self.base_url}/query/video_generation?task_id=health-check"
+        try:
+            response = self._send('health', 'GET', url, self.api_key)
+        except requests.RequestException:
+            return False
+        return response.status_code < 500
+    
+    def health_retry_after(self):
+        """Số giây tới lượt thăm dò kế tiếp (None nếu không có endpoint nào bị ngắt)"""
+        waits = []
+        for name in self.PROBED_ENDPOINTS:
+            breaker = self.breakers[name]
+            if breaker.state != 'closed':
+                # half_open còn lại sau check_health nghĩa là lượt thử đang bận: chờ rồi thăm dò lại
+                waits.append(breaker.retry_after() or self.PROBE_RETRY)
+        return min(waits) if waits else None
+    
+    def breaker_states(self):
+        """Trạng thái bộ ngắt mạch của từng endpoint"""
+        return {name: breaker.state for name, breaker in self.breakers.items()}
+    
+    def _track_call(self, op, delta):
+        with self.http_lock:
+            self.in_flight[op] = self.in_flight.get(op, 0) + delta
+    
+    def http_in_flight(self):
+        """Số lượt gọi HTTP đang chạy theo loại"""
+        with self.http_lock:
+            return {op: count for op, count in self.in_flight.items() if count}
+    
+    def _check_response(self, api_key, response, action):
+        """Kiểm tra phản hồi, báo lỗi cho key pool và trả về JSON"""
+        if response.status_code != 200:
+            self.key_pool.report_error(api_key, 1002 if response.status_code == 429 else None)
+            if response.status_code >= 500:
+                # Lỗi phía máy chủ, cùng loại với lỗi mạng (requests.RequestException)
+                raise requests.HTTPError(f"Lỗi khi {action}: {response.text}", response=response)
+            raise Exception(f"Lỗi khi {action}: {response.text}")
+        
+        data = response.json()
+        code = (data.get('base_resp') or {}).get('status_code', 0)
+        if code in APIKeyPool.RATE_LIMIT_CODES or code in APIKeyPool.FATAL_CODES:
+            self.key_pool.report_error(api_key, code)
+        else:
+            self.key_pool.report_success(api_key)
+        return data
+    
+    def update_keys(self, api_key, max_tasks_per_key=None):
+        """Thay danh sách key, giữ nguyên key của các task đang xử lý"""
+        keys = parse_api_keys(api_key)
+        self.key_pool.set_keys(keys, max_tasks_per_key=max_tasks_per_key)
+        self.api_key = keys[0][0] if keys else ""
+        self.headers = self._headers_for(self.api_key)
+    
+    def key_count(self):
+        """Số API key đang trong vòng quay"""
+        return self.key_pool.available_count()
+    
+    def key_for_task(self, task_id):
+        """Key đã dùng để tạo task"""
+        return self.task_keys.get(task_id, self.api_key)
+    
+    def release_task(self, task_id):
+        """Giải phóng suất xử lý của key khi task kết thúc"""
+        api_key = self.task_keys.pop(task_id, None)
+        if api_key is not None:
+            self.key_pool.release(api_key)
+    
     def encode_image(self, image_path):
         """Mã hóa image thành base64"""
         with open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode('utf-8')
     
-    def create_video_task(self, image_path, prompt, model="I2V-01-Director"):
-        """Tạo task tạo video từ hình ảnh và prompt"""
-        encoded_image = self.encode_image(image_path)
-        
-        payload = json.dumps({
-            "model": model,
-            "prompt": prompt,
-            "first_frame_image": encoded_image
-        })
-        
-        url = f"{self.base_url}/video_generation"
-        response = requests.post(url, headers=self.headers, data=payload)
-        
-        if response.status_code != 200:
-            raise Exception(f"Lỗi khi tạo task: {response.text}")
+    def create_video_task(self, image_path, prompt, model="I2V-01-Director", image_payload=None):
+        """Tạo task tạo video từ hình ảnh và prompt (image_payload: SharedImagePayload dùng chung)"""
+        api_key = self.key_pool.acquire()
+        try:
+            if image_payload is None:
+                image_payload = SharedImagePayload(image_path, cache=False)
+            
+            url = f"{self.base_url}/video_generation"
+            body = image_payload.request_body(model, prompt, self.encode_image)
+            if self.upload_gzip:
+                response = self._call('create', 'POST', url, api_key, data=body.gzip_chunks(),
+                                      extra_headers={'content-encoding': 'gzip'})
+                if response.status_code in self.GZIP_REJECTED_CODES:
+                    api_logger.warning("Endpoint không nhận body nén gzip (HTTP %d), tắt nén khi gửi ảnh",
+                                       response.status_code)
+                    self.upload_gzip = False
+                    body = image_payload.request_body(model, prompt, self.encode_image)
+            if not self.upload_gzip:
+                response = self._call('create', 'POST', url, api_key, data=body)
+            result = self._check_response(api_key, response, "tạo task")
+        except Exception:
+            self.key_pool.release(api_key)
+            raise
         
-        return response.json()
+        task_id = result.get('task_id')
+        if task_id:
+            self.task_keys[task_id] = api_key
+        else:
+            self.key_pool.release(api_key)
+        return result
     
     def query_task_status(self, task_id):
         """Truy vấn trạng thái của task tạo video"""
+        api_key = self.key_for_task(task_id)
         url = f"{self.base_url}/query/video_generation?task_id={task_id}"
-        response = requests.get(url, headers=self.headers)
-        
-        if response.status_code != 200:
-            raise Exception(f"Lỗi khi truy vấn task: {response.text}")
+        response = self._call('query', 'GET', url, api_key, task_id=task_id)
         
-        return response.json()
+        return self._check_response(api_key, response, "truy vấn task")
     
-    def retrieve_video(self, file_id):
+    def retrieve_video(self, file_id, task_id=None):
         """Lấy URL tải video đã tạo"""
+        api_key = self.key_for_task(task_id)
         url = f"{self.base_url}/files/retrieve?file_id={file_id}"
-        response = requests.get(url, headers=self.headers)
+        response = self._call('retrieve', 'GET', url, api_key, task_id=task_id)
         
-        if response.status_code != 200:
-            raise Exception(f"Lỗi khi truy xuất file: {response.text}")
+        return self._check_response(api_key, response, "truy xuất file")
+    
+    def download_video(self, download_url, output_path, throttle=None, should_stop=None, before_write=None,
+                       task_id=None):
+        """Tải video từ URL đã cung cấp (ghi từng phần, có thể giới hạn tốc độ)
+
+        before_write(số byte dự kiến) được gọi trước khi ghi, ví dụ để chờ đủ dung lượng đĩa.
+        """
+        breaker = self.breakers['download']
+        breaker.before_call()
+        start = time.monotonic()
+        self._track_call('download', 1)
+        try:
+            self._download(download_url, output_path, throttle, should_stop, before_write)
+        except Exception as e:
+            # Chỉ lỗi mạng mới tính là lỗi của máy chủ tải xuống
+            breaker.record(not isinstance(e, requests.RequestException))
+            if self.recorder:
+                self.recorder.record('download', start, task_id=task_id, error=str(e))
+            raise
+        finally:
+            self._track_call('download', -1)
+        breaker.record(True)
         
-        return response.json()
+        if self.recorder:
+            self.recorder.record('download', start, task_id=task_id, size=os.path.getsize(output_path))
+        return output_path
     
-    def download_video(self, download_url, output_path):
-        """Tải video từ URL đã cung cấp"""
-        response = requests.get(download_url)
+    def _download(self, download_url, output_path, throttle, should_stop, before_write):
+        response = requests.get(download_url, timeout=self.download_timeout, stream=True)
         
         if response.status_code != 200:
+            response.close()
+            if response.status_code >= 500:
+                # Lỗi máy chủ tải xuống: tính vào bộ ngắt mạch như lỗi mạng
+                raise requests.HTTPError(f"Lỗi khi tải file: {response.status_code}", response=response)
             raise Exception(f"Lỗi khi tải file: {response.status_code}")
         
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
+        if before_write:
+            try:
+                before_write(int(response.headers.get('content-length') or 0))
+            except Exception:
+                response.close()
+                raise
         
-        return output_path
+        # Ghi vào file tạm rồi đổi tên để không để lại file dở dang
+        temp_path = output_path + ".part"
+        try:
+            with response, open(temp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=256 * 1024):
+                    if should_stop and should_stop():
+                        raise Exception("Đã dừng tải xuống")
+                    if throttle:
+                        throttle.consume(len(chunk))
+                    f.write(chunk)
+            os.replace(temp_path, output_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
 
-class ExcelProcessor:
-    def __init__(self):
-        self.data = None
-        self.excel_path = None
+class TraceRecorder:
+    """Ghi lại request/response tới API kèm thời gian (JSON lines, nén gzip nếu đuôi .gz)
+
+    Không ghi header hay nội dung ảnh gửi đi, chỉ ghi phản hồi và thời gian để chạy lại offline.
+    """
     
-    def load_excel(self, excel_path):
-        """Tải dữ liệu prompt từ file Excel"""
-        try:
-            self.data = pd.read_excel(excel_path)
-            self.excel_path = excel_path
-            return True
-        except Exception as e:
-            logging.error(f"Lỗi khi tải file Excel: {e}")
-            return False
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        opener = gzip.open if path.endswith(".gz") else open
+        self.file = opener(path, 'wt', encoding='utf-8')
+        self.count = 0
     
-    def get_prompt_for_image(self, image_name):
-        """Tìm prompt cho tên file ảnh cụ thể"""
+    def record(self, op, start, **fields):
+        """Ghi một lượt gọi bắt đầu tại start (time.monotonic) và vừa kết thúc"""
+        entry = {
+            'op': op,
+            't': round(start - self.started, 3),
+            'dur': round(time.monotonic() - start, 3)
+        }
+        entry.update((name, value) for name, value in fields.items() if value is not None)
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n"
+        
+        with self.lock:
+            if self.file:
+                self.file.write(line)
+                self.count += 1
+    
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+        api_logger.info("Đã ghi %d lượt gọi API vào %s", self.count, self.path)
+
+
+def load_trace(path):
+    """Đọc file trace do TraceRecorder ghi"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayResponse:
+    """Phản hồi HTTP dựng lại từ trace hoặc từ API giả lập"""
+    
+    def __init__(self, status_code, text="", data=None):
+        self.status_code = status_code
+        self.text = text
+        self.data = data
+    
+    def json(self):
+        if self.data is not None:
+            return self.data
+        return json.loads(self.text)
+
+
+class TraceReplayAPI(MiniMaxAPI):
+    """MiniMaxAPI phát lại một trace đã ghi theo đồng hồ được truyền vào (thường là ScaledClock)
+
+    Task thứ n được tạo sẽ nhận phản hồi tạo task thứ n trong trace (quay vòng khi hết).
+    Trạng thái trả về khi truy vấn phụ thuộc thời gian kể từ lúc tạo task, không phụ thuộc
+    số lần truy vấn, nên có thể so sánh các poll_interval khác nhau.
+    """
+    
+    def __init__(self, entries, max_tasks_per_key=None, clock=None):
+        super().__init__("replay", max_tasks_per_key=max_tasks_per_key, clock=clock)
+        self.started = self.clock.monotonic()
+        self.replay_lock = threading.Lock()
+        
+        self.creates = []
+        self.queries = {}  # task_id gốc -> danh sách lượt truy vấn
+        self.retrieves = {}
+        self.downloads = {}
+        for entry in entries:
+            op = entry.get('op')
+            if op == 'create':
+                self.creates.append(entry)
+            elif op == 'query':
+                self.queries.setdefault(entry.get('task_id'), []).append(entry)
+            elif op == 'retrieve':
+                self.retrieves[entry.get('task_id')] = entry
+            elif op == 'download':
+                self.downloads[entry.get('task_id')] = entry
+        
+        self.next_create = 0
+        # task_id phát lại -> (task_id gốc, thời điểm tạo trong trace, thời điểm tạo khi phát lại)
+        self.replayed = {}
+        self.calls = {}
+    
+    def now(self):
+        """Thời gian (giây, theo đồng hồ của API) kể từ lúc bắt đầu phát lại"""
+        return self.clock.monotonic() - self.started
+    
+    def encode_image(self, image_path):
+        return ""
+    
+    def _lookup(self, op, task_id):
+        """Tìm bản ghi trong trace cho lượt gọi hiện tại"""
+        if op == 'create':
+            if not self.creates:
+                return {'status': 500, 'body': "Trace không có lượt tạo task nào"}
+            entry = dict(self.creates[self.next_create % len(self.creates)])
+            self.next_create += 1
+            try:
+                body = json.loads(entry.get('body') or "{}")
+            except ValueError:
+                return entry
+            original_id = body.get('task_id')
+            if original_id:
+                body['task_id'] = f"{original_id}-{self.next_create}"
+                entry['body'] = json.dumps(body)
+                self.replayed[body['task_id']] = (original_id, entry['t'] + entry['dur'],
+                                                  self.now() + entry['dur'])
+            return entry
+        
+        original_id, recorded_created, replay_created = self.replayed.get(task_id, (None, 0, 0))
+        if op == 'query':
+            elapsed = self.now() - replay_created
+            records = self.queries.get(original_id, [])
+            seen = [record for record in records if record['t'] - recorded_created <= elapsed]
+            if seen:
+                return seen[-1]
+            # Chưa tới lượt truy vấn đầu tiên trong trace: task vẫn đang xử lý
+            return {
+                'status': 200,
+                'dur': records[0]['dur'] if records else 0,
+                'body': json.dumps({'task_id': task_id, 'status': 'Processing', 'base_resp': {'status_code': 0}})
+            }
+        
+        source = self.retrieves if op == 'retrieve' else self.downloads
+        return source.get(original_id) or {'status': 404, 'body': f"Không có {op} cho task {task_id} trong trace"}
+    
+    def _send(self, op, method, url, api_key, task_id=None, **kwargs):
+        with self.replay_lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+            entry = self._lookup(op, task_id)
+        
+        self.clock.sleep(entry.get('dur', 0))
+        if 'error' in entry:
+            raise requests.ConnectionError(entry['error'])
+        return ReplayResponse(entry.get('status', 200), entry.get('body', ""))
+    
+    def download_video(self, download_url, output_path, throttle=None, should_stop=None, before_write=None,
+                       task_id=None):
+        with self.replay_lock:
+            self.calls['download'] = self.calls.get('download', 0) + 1
+            entry = self._lookup('download', task_id)
+        
+        if before_write:
+            before_write(entry.get('size', 0))
+        self.clock.sleep(entry.get('dur', 0))
+        if 'error' in entry or 'size' not in entry:
+            raise Exception(f"Lỗi khi tải file: {entry.get('error') or entry.get('body')}")
+        
+        # Chỉ tạo file rỗng, kích thước thật nằm trong trace
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        open(output_path, 'wb').close()
+        return output_path
+
+
+class SimulatedAPI(MiniMaxAPI):
+    """MiniMaxAPI giả lập: thời gian tạo video và tỷ lệ lỗi sinh ngẫu nhiên theo seed cố định"""
+    
+    def __init__(self, clock, keys=1, max_tasks_per_key=None, generation_time=240, jitter=0.5,
+                 failure_rate=0.0, request_latency=0.0, download_time=0.0, seed=1):
+        super().__init__(",".join(f"sim{i}" for i in range(keys)), max_tasks_per_key=max_tasks_per_key, clock=clock)
+        self.generation_time = generation_time
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.request_latency = request_latency
+        self.download_time = download_time
+        self.random = random.Random(seed)
+        self.tasks = {}  # task_id -> (thời điểm xong, thành công)
+        self.calls = {}
+    
+    def encode_image(self, image_path):
+        return ""
+    
+    def _send(self, op, method, url, api_key, task_id=None, **kwargs):
+        self.calls[op] = self.calls.get(op, 0) + 1
+        self.clock.sleep(self.request_latency)
+        now = self.clock.monotonic()
+        ok = {'status_code': 0}
+        
+        if op == 'create':
+            task_id = f"sim{len(self.tasks) + 1}"
+            duration = self.generation_time * (1 + self.random.uniform(-self.jitter, self.jitter))
+            self.tasks[task_id] = (now + duration, self.random.random() >= self.failure_rate)
+            return ReplayResponse(200, data={'task_id': task_id, 'base_resp': ok})
+        
+        if op == 'query':
+            ready_at, success = self.tasks[task_id]
+            status = 'Processing' if now < ready_at else ('Success' if success else 'Fail')
+            return ReplayResponse(200, data={'task_id': task_id, 'status': status,
+                                             'file_id': f"file-{task_id}", 'base_resp': ok})
+        
+        return ReplayResponse(200, data={'file': {'download_url': f"sim://{task_id}"}, 'base_resp': ok})
+    
+    def download_video(self, download_url, output_path, throttle=None, should_stop=None, before_write=None,
+                       task_id=None):
+        self.calls['download'] = self.calls.get('download', 0) + 1
+        if before_write:
+            before_write(0)
+        self.clock.sleep(self.download_time)
+        open(output_path, 'wb').close()
+        return output_path
+
+
+class TokenBucket:
+    """Giới hạn tốc độ theo số byte/giây (token bucket), rate = 0 là không giới hạn"""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def consume(self, amount):
+        """Chờ tới khi đủ token cho amount byte"""
+        if not self.rate:
+            return
+        
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                
+                # Cho phép chunk lớn hơn capacity đi qua khi bucket đầy
+                needed = min(amount, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait_time = (needed - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def read_mp4_boxes(path):
+    """Đọc danh sách box cấp cao nhất của file MP4 (chỉ đọc header)"""
+    boxes = []
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"Header box bị cắt tại vị trí {offset}")
+            
+            size = int.from_bytes(header[:4], 'big')
+            box_type = header[4:8].decode('latin-1')
+            if size == 1:
+                largesize = f.read(8)
+                if len(largesize) < 8:
+                    raise ValueError(f"Header box '{box_type}' bị cắt")
+                size = int.from_bytes(largesize, 'big')
+            elif size == 0:
+                size = file_size - offset
+            
+            if size < 8 or offset + size > file_size:
+                raise ValueError(f"Box '{box_type}' có kích thước không hợp lệ ({size} byte)")
+            
+            boxes.append((box_type, offset, size))
+            offset += size
+    return boxes
+
+
+def validate_mp4(path):
+    """Kiểm tra cấu trúc MP4 không cần ffprobe, trả về (hợp lệ, thông báo)"""
+    try:
+        boxes = read_mp4_boxes(path)
+    except (OSError, ValueError) as e:
+        return False, str(e)
+    
+    types = [box[0] for box in boxes]
+    if not types or types[0] != 'ftyp':
+        return False, "Thiếu box 'ftyp' ở đầu file"
+    for required in ('moov', 'mdat'):
+        if required not in types:
+            return False, f"Thiếu box '{required}'"
+    return True, "OK"
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Tính SHA-256 của file theo từng phần"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def checksum_step(task_info):
+    """Bước hậu xử lý: tính checksum video"""
+    return {'sha256': file_sha256(task_info['output_filename'])}
+
+
+def validate_mp4_step(task_info):
+    """Bước hậu xử lý: kiểm tra cấu trúc MP4"""
+    valid, message = validate_mp4(task_info['output_filename'])
+    if not valid:
+        raise Exception(f"File MP4 không hợp lệ: {message}")
+    return {}
+
+
+def poster_step(task_info, max_size=(640, 640)):
+    """Bước hậu xử lý: tạo ảnh poster từ ảnh khung đầu tiên"""
+    # Video được tạo từ ảnh khung đầu nên dùng chính ảnh này làm poster,
+    # tránh phải giải mã video
+    poster_path = os.path.splitext(task_info['output_filename'])[0] + "_poster.jpg"
+    with Image.open(task_info['image_path']) as img:
+        img = img.convert('RGB')
+        img.thumbnail(max_size)
+        img.save(poster_path, 'JPEG', quality=85)
+    return {'poster_path': poster_path}
+
+
+POST_PROCESSORS = {
+    'checksum': checksum_step,
+    'validate_mp4': validate_mp4_step,
+    'poster': poster_step
+}
+
+
+class DownloadManager:
+    """Pool tải xuống và hậu xử lý video, tách khỏi vòng lặp theo dõi trạng thái"""
+    
+    DEFAULT_VIDEO_BYTES = 5 * 1024 * 1024
+    SPACE_CHECK_INTERVAL = 10  # Giây giữa các lần kiểm tra lại dung lượng khi tạm dừng
+    
+    def __init__(self, max_workers=2, disk_write_mbps=0, post_processing=(),
+                 bandwidth_kbps=0, min_free_space_mb=1024, clock=None, inline=False):
+        self.clock = clock or DEFAULT_CLOCK
+        # inline: tải ngay trên luồng gọi (dùng khi giả lập với SimulatedClock)
+        self.inline = inline
+        self.max_workers = max(1, max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="download")
+        self.post_executor = ThreadPoolExecutor(max_workers=self.max_workers * 2, thread_name_prefix="postprocess")
+        self.throttle = TokenBucket(int(disk_write_mbps * 1024 * 1024))
+        # Giới hạn băng thông mạng dùng chung cho mọi luồng tải
+        self.bandwidth = TokenBucket(int(bandwidth_kbps * 1024))
+        self.min_free_bytes = int(min_free_space_mb * 1024 * 1024)
+        self.post_processing = [name for name in post_processing if name in POST_PROCESSORS]
+        
+        self.lock = threading.Lock()
+        # Khóa bảo vệ trạng thái task, TaskQueueManager gán khóa hàng đợi để không chen ngang lúc hủy
+        self.status_lock = threading.Lock()
+        self.in_progress = {}  # job_id -> task_info
+        self.recent_sizes = deque(maxlen=50)
+        self.space_paused = False
+        self.stopped = False
+        self._stop_event = threading.Event()
+        
+        # Callbacks
+        self.on_download_stats = None  # (số byte, số giây)
+        self.on_space_low = None  # (đang tạm dừng: bool)
+    
+    def apply_config(self, snapshot):
+        """Áp dụng cấu hình mới, các lượt tải đang chạy không bị ảnh hưởng"""
+        for bucket, rate in ((self.throttle, snapshot.disk_write_mbps * 1024 * 1024),
+                             (self.bandwidth, snapshot.download_bandwidth_kbps * 1024)):
+            bucket.rate = int(rate)
+            bucket.capacity = max(bucket.rate, 1)
+        self.min_free_bytes = int(snapshot.min_free_space_mb * 1024 * 1024)
+        self.post_processing = [name.strip() for name in snapshot.post_processing.split(",")
+                                if name.strip() in POST_PROCESSORS]
+        
+        max_workers = max(1, snapshot.download_workers)
+        if max_workers != self.max_workers:
+            # Executor mới nhận lượt tải mới, executor cũ tự kết thúc khi xong việc
+            old_executor = self.executor
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+            self.max_workers = max_workers
+            old_executor.shutdown(wait=False)
+    
+    def submit(self, task_info, api_client, callback):
+        """Đưa task đã hoàn thành trên server vào hàng đợi tải xuống"""
+        with self.lock:
+            self.in_progress[task_info['job_id']] = task_info
+        if self.inline:
+            self._run(task_info, api_client, callback)
+        else:
+            self.executor.submit(self._run, task_info, api_client, callback)
+    
+    def pending_count(self):
+        """Số task đang chờ tải hoặc hậu xử lý"""
+        return len(self.in_progress)
+    
+    def shutdown(self):
+        """Dừng các lượt tải đang chạy"""
+        self.stopped = True
+        self._stop_event.set()
+        self.executor.shutdown(wait=False)
+        self.post_executor.shutdown(wait=False)
+    
+    def _should_stop(self, task_info):
+        return self.stopped or task_info['status'] == 'cancelled'
+    
+    def consume(self, amount):
+        """Chờ đủ hạn mức băng thông mạng và tốc độ ghi đĩa cho một chunk"""
+        self.bandwidth.consume(amount)
+        self.throttle.consume(amount)
+    
+    def expected_size(self):
+        """Ước tính kích thước video khi máy chủ không trả Content-Length"""
+        if not self.recent_sizes:
+            return self.DEFAULT_VIDEO_BYTES
+        return sum(self.recent_sizes) / len(self.recent_sizes)
+    
+    def wait_for_space(self, folder, expected_bytes, task_info, block=True):
+        """Tạm dừng tải cho tới khi đĩa còn đủ dung lượng dự trữ
+
+        block=False chỉ kiểm tra một lần, trả về False thay vì chờ.
+        """
+        expected_bytes = expected_bytes or self.expected_size()
+        while True:
+            free = shutil.disk_usage(folder).free
+            if free - expected_bytes >= self.min_free_bytes:
+                if self.space_paused:
+                    self.space_paused = False
+                    download_logger.info("Đã đủ dung lượng trống, tiếp tục tải xuống")
+                    if self.on_space_low:
+                        self.on_space_low(False)
+                return True
+            
+            if not self.space_paused:
+                self.space_paused = True
+                download_logger.warning(
+                    "Dung lượng trống thấp (%.0f MB, cần giữ %.0f MB), tạm dừng tải xuống",
+                    free / 1024 ** 2, self.min_free_bytes / 1024 ** 2
+                )
+                if self.on_space_low:
+                    self.on_space_low(True)
+            
+            if not block:
+                return False
+            if self._stop_event.wait(self.SPACE_CHECK_INTERVAL) or self._should_stop(task_info):
+                raise Exception("Đã dừng tải xuống khi chờ dung lượng trống")
+    
+    def _run(self, task_info, api_client, callback):
+        error = None
+        expected_bytes = None
+        try:
+            while True:
+                try:
+                    self._fetch(task_info, api_client, expected_bytes)
+                    break
+                except LowDiskSpaceError as e:
+                    # Kết nối đã đóng, lượt sau chờ đủ chỗ cho kích thước thật rồi lấy URL mới
+                    expected_bytes = e.expected_bytes
+                except CircuitOpenError as e:
+                    # Endpoint đang bị ngắt: giữ task chờ tới lượt thử lại thay vì đánh dấu thất bại
+                    if self.clock.wait(self._stop_event, e.retry_after) or self._should_stop(task_info):
+                        raise Exception("Đã dừng tải xuống khi chờ endpoint hoạt động lại")
+            
+            # Các bước hậu xử lý chạy song song
+            with self.status_lock:
+                post_processing = self.post_processing and not self._should_stop(task_info)
+                if post_processing:
+                    task_info['status'] = 'postprocessing'
+            if post_processing:
+                futures = [self.post_executor.submit(POST_PROCESSORS[name], task_info)
+                           for name in self.post_processing]
+                for future in futures:
+                    task_info.update(future.result())
+        
+        except Exception as e:
+            error = str(e)
+        
+        finally:
+            with self.lock:
+                self.in_progress.pop(task_info['job_id'], None)
+            callback(task_info, error)
+    
+    def _fetch(self, task_info, api_client, expected_bytes=None):
+        """Chờ đủ dung lượng đĩa, truy xuất URL rồi tải video của task"""
+        # Chờ trước khi lấy URL và mở kết nối: URL có chữ ký và kết nối đang mở đều có thể hết hạn khi chờ lâu
+        output_folder = os.path.dirname(task_info['output_filename'])
+        os.makedirs(output_folder, exist_ok=True)
+        self.wait_for_space(output_folder, expected_bytes, task_info)
+        
+        file_resp = api_client.retrieve_video(task_info['file_id'], task_info['task_id'])
+        download_url = file_resp.get('file', {}).get('download_url')
+        
+        if not download_url:
+            raise Exception(f"Không nhận được download_url: {file_resp}")
+        
+        # Tải video, bắt đầu tính giờ khi bắt đầu ghi
+        download_start = [self.clock.monotonic()]
+        
+        def before_write(expected_bytes):
+            # Kết nối đã mở nên không chờ ở đây: video lớn hơn ước tính thì bỏ lượt này
+            if not self.wait_for_space(output_folder, expected_bytes, task_info, block=False):
+                raise LowDiskSpaceError(expected_bytes)
+            download_start[0] = self.clock.monotonic()
+        
+        api_client.download_video(
+            download_url,
+            task_info['output_filename'],
+            throttle=self,
+            should_stop=lambda: self._should_stop(task_info),
+            before_write=before_write,
+            task_id=task_info['task_id']
+        )
+        duration = self.clock.monotonic() - download_start[0]
+        size = os.path.getsize(task_info['output_filename'])
+        self.recent_sizes.append(size)
+        task_info['download_bytes'] = size
+        task_info['download_seconds'] = duration
+        download_logger.info("Đã tải %s", task_info['output_filename'], extra={
+            'task_id': task_info['task_id'], 'job_id': task_info['job_id'],
+            'stage': 'download', 'duration': round(duration, 3)
+        })
+        if self.on_download_stats:
+            self.on_download_stats(size, duration)
+
+
+class OutputManifest:
+    """Chỉ mục các video đã tạo trong thư mục đầu ra, dùng để bỏ qua khi chạy lại"""
+    
+    FILENAME = "manifest.jsonl"
+    
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, self.FILENAME)
+        self.entries = {}  # tên file video -> bản ghi
+        self.digest_cache = {}  # (đường dẫn ảnh, kích thước, mtime) -> sha256
+        self.lock = threading.Lock()
+        self.load()
+    
+    def load(self):
+        """Đọc manifest, bản ghi sau ghi đè bản ghi trước"""
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return
+        
+        line_count = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line_count += 1
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry['file']] = entry
+                except (ValueError, KeyError):
+                    # Dòng cuối có thể bị cắt nếu ứng dụng dừng đột ngột
+                    continue
+                self._cache_digest(entry)
+        
+        # Gộp lại file khi có nhiều bản ghi trùng lặp
+        if line_count > 2 * len(self.entries) + 100:
+            self.compact()
+    
+    def compact(self):
+        """Ghi lại manifest chỉ với bản ghi mới nhất của mỗi file"""
+        with self.lock:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(temp_path, self.path)
+    
+    def _cache_digest(self, entry):
+        """Nạp digest ảnh nguồn đã lưu trong bản ghi vào cache"""
+        if entry.get('source_path') and entry.get('source_digest'):
+            cache_key = (entry['source_path'], entry.get('source_size'), entry.get('source_mtime_ns'))
+            self.digest_cache[cache_key] = entry['source_digest']
+    
+    def source_digest(self, image_path, stat=None):
+        """SHA-256 của ảnh nguồn, có cache theo (đường dẫn, kích thước, thời gian sửa) lưu cùng manifest"""
+        image_path = os.path.abspath(image_path)
+        stat = stat or os.stat(image_path)
+        cache_key = (image_path, stat.st_size, stat.st_mtime_ns)
+        digest = self.digest_cache.get(cache_key)
+        if digest is None:
+            digest = file_sha256(image_path)
+            self.digest_cache[cache_key] = digest
+        return digest
+    
+    def is_done(self, output_filename, image_path, prompt, model):
+        """Kiểm tra video đã được tạo với cùng ảnh, prompt và mô hình
+
+        Chỉ tính digest ảnh khi các điều kiện rẻ hơn (bản ghi, prompt, model, kích thước video) đã khớp.
+        """
+        entry = self.entries.get(os.path.basename(output_filename))
+        if not entry:
+            return False
+        if entry.get('prompt') != prompt or entry.get('model') != model:
+            return False
+        
+        try:
+            if os.path.getsize(output_filename) != entry.get('size'):
+                return False
+            return self.source_digest(image_path) == entry.get('source_digest')
+        except OSError:
+            return False
+    
+    def record(self, task_info):
+        """Thêm bản ghi cho video vừa tải xong"""
+        output_filename = task_info['output_filename']
+        source_path = os.path.abspath(task_info['image_path'])
+        source_stat = os.stat(source_path)
+        entry = {
+            'file': os.path.basename(output_filename),
+            'size': os.path.getsize(output_filename),
+            'sha256': task_info.get('sha256') or file_sha256(output_filename),
+            'source_image': os.path.basename(source_path),
+            'source_path': source_path,
+            'source_size': source_stat.st_size,
+            'source_mtime_ns': source_stat.st_mtime_ns,
+            'source_digest': task_info.get('source_digest') or self.source_digest(source_path, source_stat),
+            'prompt': task_info['prompt'],
+            'model': task_info['model'],
+            'task_id': task_info.get('task_id'),
+            'created': datetime.now().isoformat(timespec='seconds')
+        }
+        
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self.entries[entry['file']] = entry
+            self._cache_digest(entry)
+        return entry
+    
+    def average_size(self):
+        """Kích thước trung bình của video đã tạo, None nếu chưa có"""
+        sizes = [entry.get('size') or 0 for entry in self.entries.values()]
+        if not sizes:
+            return None
+        return sum(sizes) / len(sizes)
+    
+    def verify(self, max_workers=8):
+        """Kiểm tra song song kích thước và cấu trúc MP4 của các video trong manifest
+
+        Trả về danh sách (tên file, hợp lệ, thông báo).
+        """
+        def check(entry):
+            path = os.path.join(self.output_folder, entry['file'])
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return entry['file'], False, "Không tìm thấy file"
+            if size != entry.get('size'):
+                return entry['file'], False, f"Kích thước khác manifest ({size} != {entry.get('size')})"
+            valid, message = validate_mp4(path)
+            return entry['file'], valid, message
+        
+        entries = list(self.entries.values())
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(check, entries))
+    
+    def remove(self, filenames):
+        """Xóa bản ghi khỏi manifest để các video này được tạo lại"""
+        with self.lock:
+            for filename in filenames:
+                self.entries.pop(filename, None)
+        self.compact()
+
+
+class PromptTemplate:
+    """Mẫu prompt có biến dạng {ten_cot}, được biên dịch một lần và điền theo cột"""
+    
+    FORMATTER = string.Formatter()
+    
+    def __init__(self, text):
+        self.text = text
+        self.parts = []  # Danh sách (chuỗi cố định, tên biến hoặc None, !chuyển đổi, :định dạng)
+        for literal, field, spec, conversion in self.FORMATTER.parse(text):
+            if field is not None and not field.strip():
+                raise ValueError("Biến trong mẫu prompt không được để trống")
+            if conversion not in (None, 'r', 's', 'a'):
+                raise ValueError(f"Chuyển đổi không hợp lệ cho biến {field}: !{conversion}")
+            if spec and "{" in spec:
+                raise ValueError(f"Định dạng của biến {field} không được chứa biến lồng nhau")
+            self.parts.append((literal, field.strip() if field else None, conversion, spec))
+        self.fields = [field for _, field, _, _ in self.parts if field]
+    
+    @staticmethod
+    def has_placeholders(text):
+        """Kiểm tra chuỗi có chứa biến {ten_cot} hay không"""
+        try:
+            return any(field for _, field, _, _ in string.Formatter().parse(text or ""))
+        except ValueError:
+            return False
+    
+    def expand(self, data):
+        """Điền mẫu cho toàn bộ DataFrame, trả về Series prompt"""
+        missing = [field for field in self.fields if field not in data.columns]
+        if missing:
+            raise KeyError(f"Thiếu cột cho biến: {', '.join(missing)}")
+        
+        # Nối chuỗi theo cột (mảng object của numpy) thay vì dựng từng prompt
+        result = np.full(len(data), "", dtype=object)
+        for literal, field, conversion, spec in self.parts:
+            if literal:
+                result = result + literal
+            if not field:
+                continue
+            if conversion or spec:
+                # Ô trống vẫn điền chuỗi rỗng, không áp định dạng
+                values = data[field].map(lambda value: "" if pd.isna(value) else
+                                         self._format(field, value, conversion, spec))
+            else:
+                values = data[field].fillna("").astype(str)
+            result = result + values.to_numpy(dtype=object)
+        return pd.Series(result, index=data.index).str.strip()
+    
+    def render(self, values):
+        """Điền mẫu cho một bộ giá trị"""
+        return "".join(literal + (self._format(field, values[field], conversion, spec) if field else "")
+                       for literal, field, conversion, spec in self.parts).strip()
+    
+    def _format(self, field, value, conversion, spec):
+        """Áp dụng !chuyển đổi và :định dạng của biến giống str.format"""
+        try:
+            return self.FORMATTER.format_field(self.FORMATTER.convert_field(value, conversion), spec)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Không định dạng được biến {field} với giá trị {value!r}: {e}")
+
+
+class ExcelProcessor:
+    def __init__(self):
+        self.data = None
+        self.excel_path = None
+    
+    def load_excel(self, excel_path):
+        """Tải dữ liệu prompt từ file Excel"""
+        try:
+            self.data = pd.read_excel(excel_path)
+            self.excel_path = excel_path
+            return True
+        except Exception as e:
+            data_logger.error("Lỗi khi tải file Excel: %s", e)
+            return False
+    
+    def get_prompt_for_image(self, image_name):
+        """Tìm prompt cho tên file ảnh cụ thể"""
         if self.data is None:
             return None
         
@@ -219,6 +2069,65 @@ class ExcelProcessor:
         
         return False
     
+    def expand_tasks(self, image_names, template=None, videos_per_image=1,
+                     mode="cartesian", separator="|"):
+        """Sinh danh sách task (image, prompt, index) từ dữ liệu Excel
+
+        Giá trị chứa dấu phân tách trong các cột biến (trừ cột 'prompt') tạo
+        ra nhiều biến thể: "cartesian" lấy mọi tổ hợp, "zip" ghép theo thứ tự.
+        Mỗi biến thể được lặp lại videos_per_image lần. Nếu Excel có cột
+        'model', kết quả có thêm cột 'model' (ô trống = dùng model mặc định).
+        """
+        if self.data is None or 'image' not in self.data.columns:
+            return pd.DataFrame(columns=['image', 'prompt', 'index'])
+        
+        template = template or PromptTemplate("{prompt}")
+        
+        # Mỗi ảnh dùng dòng đầu tiên khớp tên, giống get_prompt_for_image
+        data = self.data[self.data['image'].isin(pd.Index(image_names))]
+        data = data.drop_duplicates(subset='image', keep='first')
+        
+        # Bỏ các dòng thiếu giá trị cho biến (ví dụ ảnh chưa có prompt)
+        fields = [field for field in dict.fromkeys(template.fields) if field in data.columns]
+        for field in fields:
+            data = data[data[field].notna() & (data[field].astype(str).str.strip() != "")]
+        
+        variant_columns = [field for field in fields if field != 'prompt']
+        if variant_columns:
+            data = data.copy()
+            for column in variant_columns:
+                values = data[column].astype(str)
+                # Chỉ tách những ô thực sự có nhiều giá trị
+                has_variants = values.str.contains(separator, regex=False)
+                if has_variants.any():
+                    values = values.where(~has_variants, values.str.split(separator))
+                data[column] = values
+            if mode == "zip":
+                data = data.explode(variant_columns, ignore_index=True)
+            else:
+                for column in variant_columns:
+                    data = data.explode(column, ignore_index=True)
+            for column in variant_columns:
+                data[column] = data[column].str.strip()
+        
+        if videos_per_image > 1:
+            data = data.loc[data.index.repeat(videos_per_image)]
+        
+        images = data['image'].to_numpy(dtype=object)
+        prompts = template.expand(data).to_numpy(dtype=object)
+        
+        # Đánh số thứ tự trong từng ảnh; các dòng của một ảnh luôn liền nhau
+        positions = np.arange(len(images))
+        starts = np.ones(len(images), dtype=bool)
+        starts[1:] = images[1:] != images[:-1]
+        index = positions - np.maximum.accumulate(np.where(starts, positions, 0)) + 1
+        
+        tasks = pd.DataFrame({'image': images, 'prompt': prompts, 'index': index})
+        if 'model' in data.columns:
+            models = data['model'].astype(str).str.strip().to_numpy(dtype=object)
+            tasks['model'] = np.where(data['model'].notna().to_numpy(), models, "")
+        return tasks
+    
     def save_excel(self, excel_path=None):
         """Lưu dữ liệu vào file Excel"""
         if self.data is None:
@@ -233,51 +2142,491 @@ class ExcelProcessor:
             self.data.to_excel(excel_path, index=False)
             return True
         except Exception as e:
-            logging.error(f"Lỗi khi lưu file Excel: {e}")
+            data_logger.error("Lỗi khi lưu file Excel: %s", e)
             return False
 
 
+class InotifyWatcher:
+    """Nhận thông báo tạo/ghi xong/đổi tên file trong các thư mục qua inotify (Linux, dùng ctypes)"""
+    
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct("iIII")
+    
+    def __init__(self, folders):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Không khởi tạo được inotify")
+        
+        self.watches = {}  # watch descriptor -> thư mục
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for folder in folders:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                self.close()
+                raise OSError(error, f"Không theo dõi được thư mục {folder}")
+            self.watches[wd] = folder
+    
+    def read(self, timeout):
+        """Chờ tối đa timeout giây, trả về danh sách đường dẫn vừa thay đổi"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        
+        paths = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name and wd in self.watches:
+                paths.append(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return paths
+    
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class FolderWatcher:
+    """Theo dõi thư mục ảnh và file Excel, sinh task mới khi có ảnh hoặc dòng prompt mới
+
+    Dùng inotify khi có, ngược lại quét định kỳ (chỉ stat các file, không đọc lại nội dung).
+    File chỉ được xử lý khi kích thước và thời gian sửa không đổi trong stable_seconds giây.
+    """
+    
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+    
+    def __init__(self, image_folder, excel_path, template=None, videos_per_image=1, mode="cartesian",
+                 interval=2.0, stable_seconds=2.0, clock=None):
+        self.image_folder = os.path.abspath(image_folder)
+        self.excel_path = os.path.abspath(excel_path)
+        self.template = template
+        self.videos_per_image = videos_per_image
+        self.mode = mode
+        self.interval = interval
+        self.stable_seconds = stable_seconds
+        self.clock = clock or DEFAULT_CLOCK
+        
+        self.processor = ExcelProcessor()
+        self.images = {}  # tên ảnh -> (đường dẫn, (size, mtime)) của các ảnh đã ghi xong
+        self.listing = {}  # đường dẫn -> (size, mtime) ở lần quét trước
+        self.candidates = {}  # đường dẫn -> [(size, mtime), thời điểm bắt đầu không đổi]
+        self.submitted = set()  # (ảnh, prompt, index) đã đưa vào hàng đợi
+        self.backend = None
+        self._stop = threading.Event()
+        self._thread = None
+        
+        # Callback (DataFrame image/prompt/index, {tên ảnh: đường dẫn}), gọi từ luồng theo dõi
+        self.on_tasks = None
+    
+    def start(self):
+        """Bắt đầu theo dõi trong luồng riêng"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="folder-watcher")
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def _is_relevant(self, path):
+        if path == self.excel_path:
+            return True
+        return os.path.dirname(path) == self.image_folder and path.lower().endswith(self.IMAGE_EXTENSIONS)
+    
+    def _scan(self):
+        """Liệt kê ảnh và file Excel, trả về các file mới hoặc đã đổi so với lần trước"""
+        listing = {}
+        try:
+            with os.scandir(self.image_folder) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(self.IMAGE_EXTENSIONS) and entry.is_file():
+                        stat = entry.stat()
+                        listing[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            stat = os.stat(self.excel_path)
+            listing[self.excel_path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+        
+        changed = [path for path, stamp in listing.items() if self.listing.get(path) != stamp]
+        self.listing = listing
+        return changed
+    
+    def _run(self):
+        notifier = None
+        if sys.platform.startswith("linux"):
+            try:
+                notifier = InotifyWatcher({self.image_folder, os.path.dirname(self.excel_path)})
+            except (OSError, AttributeError) as e:
+                data_logger.warning("Không dùng được inotify, chuyển sang quét định kỳ: %s", e)
+        self.backend = "inotify" if notifier else "polling"
+        data_logger.info("Bắt đầu theo dõi %s (%s)", self.image_folder, self.backend)
+        
+        changed = self._scan()
+        try:
+            while True:
+                for path in changed:
+                    if self._is_relevant(path):
+                        self.candidates.setdefault(path, [None, 0.0])
+                if self.candidates:
+                    try:
+                        self._process_candidates()
+                    except Exception as e:
+                        data_logger.error("Lỗi khi xử lý file mới: %s", e)
+                
+                if notifier:
+                    if self._stop.is_set():
+                        break
+                    changed = notifier.read(self.interval)
+                else:
+                    if self._stop.wait(self.interval):
+                        break
+                    changed = self._scan()
+        finally:
+            if notifier:
+                notifier.close()
+    
+    def _process_candidates(self):
+        """Xử lý các file đã ghi xong, sinh task cho ảnh mới hoặc toàn bộ ảnh khi Excel đổi"""
+        now = self.clock.monotonic()
+        new_images = []
+        excel_changed = False
+        
+        for path, state in list(self.candidates.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.candidates[path]
+                continue
+            
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            if state[0] != stamp:
+                state[0] = stamp
+                state[1] = now
+                continue
+            if now - state[1] < self.stable_seconds or stat.st_size == 0:
+                continue
+            
+            del self.candidates[path]
+            if path == self.excel_path:
+                excel_changed = self.processor.load_excel(path) or excel_changed
+                continue
+            
+            name = os.path.basename(path)
+            previous = self.images.get(name)
+            self.images[name] = (path, stamp)
+            if previous is None or previous[1] != stamp:
+                if previous is not None:
+                    # Ảnh bị thay nội dung: cho phép tạo lại các biến thể của nó
+                    self.submitted = {key for key in self.submitted if key[0] != name}
+                new_images.append(name)
+        
+        names = list(self.images) if excel_changed else new_images
+        if names and self.processor.data is not None:
+            self._emit(names)
+    
+    def _emit(self, names):
+        """Gửi các task chưa từng gửi của những ảnh đã cho"""
+        tasks = self.processor.expand_tasks(names, template=self.template,
+                                            videos_per_image=self.videos_per_image, mode=self.mode)
+        keys = list(zip(tasks['image'], tasks['prompt'], tasks['index']))
+        fresh = np.array([key not in self.submitted for key in keys], dtype=bool)
+        if not fresh.any():
+            return
+        
+        tasks = tasks[fresh].reset_index(drop=True)
+        self.submitted.update(key for key, is_new in zip(keys, fresh) if is_new)
+        image_paths = {name: self.images[name][0] for name in set(tasks['image'])}
+        data_logger.info("Phát hiện %d task mới từ thư mục theo dõi", len(tasks))
+        if self.on_tasks:
+            self.on_tasks(tasks, image_paths)
+
+
+class ValidationReport:
+    """Kết quả kiểm tra lô task trước khi gửi"""
+    
+    def __init__(self):
+        self.errors = []  # (đối tượng, thông báo)
+        self.warnings = []
+        self.invalid_tasks = set()  # chỉ số các task không thể gửi
+        self.task_count = 0
+        self.image_count = 0
+        self.estimated_bytes = 0
+        self.free_bytes = None
+        self.elapsed = 0.0
+    
+    @property
+    def ok(self):
+        return not self.errors
+    
+    def summary(self):
+        text = (f"Đã kiểm tra {self.task_count} task ({self.image_count} ảnh) trong {self.elapsed:.1f} giây: "
+                f"{len(self.errors)} lỗi, {len(self.warnings)} cảnh báo, "
+                f"{len(self.invalid_tasks)} task không hợp lệ.")
+        if self.free_bytes is not None:
+            text += (f" Dung lượng cần khoảng {self.estimated_bytes / 1024 ** 2:.0f} MB, "
+                     f"còn trống {self.free_bytes / 1024 ** 2:.0f} MB.")
+        return text
+
+
+class BatchValidator:
+    """Kiểm tra song song toàn bộ lô trước khi gửi để không tốn credit cho task chắc chắn lỗi"""
+    
+    SUPPORTED_FORMATS = ('JPEG', 'PNG')
+    MAX_IMAGE_BYTES = 20 * 1024 * 1024
+    MIN_SHORT_SIDE = 300
+    MAX_ASPECT_RATIO = 2.5  # Từ 2:5 tới 5:2
+    MAX_PROMPT_LENGTH = 2000
+    DEFAULT_VIDEO_BYTES = 5 * 1024 * 1024
+    
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self.known_moves = {move.lower() for move in CAMERA_MOVES}
+    
+    def check_image(self, image_path):
+        """Kiểm tra ảnh chỉ bằng header, trả về danh sách lỗi"""
+        errors = []
+        try:
+            file_size = os.path.getsize(image_path)
+        except OSError:
+            return ["Không đọc được file ảnh"]
+        
+        if file_size > self.MAX_IMAGE_BYTES:
+            errors.append(f"Ảnh quá lớn ({file_size / 1024 ** 2:.1f} MB > {self.MAX_IMAGE_BYTES // 1024 ** 2} MB)")
+        
+        try:
+            # Image.open chỉ đọc header, chưa giải mã dữ liệu ảnh
+            with Image.open(image_path) as img:
+                image_format = img.format
+                width, height = img.size
+        except Exception as e:
+            return errors + [f"Không đọc được ảnh: {e}"]
+        
+        if image_format not in self.SUPPORTED_FORMATS:
+            errors.append(f"Định dạng không hỗ trợ: {image_format}")
+        if min(width, height) < self.MIN_SHORT_SIDE:
+            errors.append(f"Cạnh ngắn nhỏ hơn {self.MIN_SHORT_SIDE}px ({width}x{height})")
+        if max(width, height) > self.MAX_ASPECT_RATIO * min(width, height):
+            errors.append(f"Tỷ lệ khung hình ngoài khoảng 2:5 - 5:2 ({width}x{height})")
+        return errors
+    
+    def check_prompt(self, prompt):
+        """Kiểm tra prompt, trả về (lỗi, cảnh báo)"""
+        errors, warnings = [], []
+        prompt = (prompt or "").strip() if isinstance(prompt, str) else str(prompt or "").strip()
+        if not prompt:
+            errors.append("Prompt trống")
+        elif len(prompt) > self.MAX_PROMPT_LENGTH:
+            errors.append(f"Prompt dài quá {self.MAX_PROMPT_LENGTH} ký tự ({len(prompt)})")
+        
+        for tag in re.findall(r'\[([^\]]*)\]', prompt):
+            for move in tag.split(","):
+                if move.strip() and move.strip().lower() not in self.known_moves:
+                    warnings.append(f"Chuyển động camera không xác định: [{move.strip()}]")
+        if prompt.count("[") != prompt.count("]"):
+            warnings.append("Dấu ngoặc vuông không cân bằng")
+        return errors, warnings
+    
+    def validate(self, tasks, output_folder, average_output_size=None):
+        """Kiểm tra danh sách task (image_path, prompt)"""
+        start = time.monotonic()
+        report = ValidationReport()
+        tasks = list(tasks)
+        report.task_count = len(tasks)
+        
+        # Mỗi ảnh chỉ kiểm tra một lần, song song theo luồng (chủ yếu là I/O)
+        images = list(dict.fromkeys(image_path for image_path, _ in tasks))
+        report.image_count = len(images)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            image_errors = dict(zip(images, executor.map(self.check_image, images)))
+        
+        for image_path, errors in image_errors.items():
+            for error in errors:
+                report.errors.append((os.path.basename(image_path), error))
+        
+        prompt_results = {}
+        for i, (image_path, prompt) in enumerate(tasks):
+            if prompt not in prompt_results:
+                prompt_results[prompt] = self.check_prompt(prompt)
+                errors, warnings = prompt_results[prompt]
+                label = os.path.basename(image_path)
+                report.errors.extend((label, error) for error in errors)
+                report.warnings.extend((label, warning) for warning in warnings)
+            
+            if image_errors[image_path] or prompt_results[prompt][0]:
+                report.invalid_tasks.add(i)
+        
+        # Thư mục đầu ra và dung lượng đĩa: chỉ kiểm tra, không tạo thư mục khi người dùng còn có thể hủy
+        existing = os.path.abspath(output_folder)
+        while not os.path.exists(existing) and os.path.dirname(existing) != existing:
+            # Thư mục chưa có: kiểm tra thư mục cha gần nhất, nơi sẽ tạo thư mục đầu ra
+            existing = os.path.dirname(existing)
+        if not os.path.isdir(existing) or not os.access(existing, os.W_OK):
+            report.errors.append((output_folder, f"Không thể ghi vào thư mục đầu ra: không có quyền ghi {existing}"))
+        else:
+            valid_count = report.task_count - len(report.invalid_tasks)
+            report.estimated_bytes = valid_count * (average_output_size or self.DEFAULT_VIDEO_BYTES)
+            report.free_bytes = shutil.disk_usage(existing).free
+            if report.estimated_bytes > report.free_bytes:
+                report.errors.append((output_folder, "Không đủ dung lượng trống cho toàn bộ video"))
+        
+        report.elapsed = time.monotonic() - start
+        return report
+
+
 class TaskQueueManager:
-    def __init__(self, api_client, max_concurrent_tasks=3, poll_interval=10):
+    RAMP_INTERVAL = 15  # Giây giữa các lần tăng số task được gửi sau khi endpoint hồi phục
+    
+    def __init__(self, api_client, max_concurrent_tasks=3, poll_interval=10, download_manager=None,
+                 max_retries=0, retry_delay=30, clock=None, model_limits=None):
         self.api_client = api_client
+        self.clock = clock or DEFAULT_CLOCK
         self.max_concurrent_tasks = max_concurrent_tasks
+        self.model_limits = parse_model_limits(model_limits)  # model -> số task đồng thời mỗi key
         self.poll_interval = poll_interval  # Giây
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay  # Giây, tăng gấp đôi sau mỗi lần thử lại
+        self.downloads = download_manager or DownloadManager()
+        self.manifests = {}  # thư mục đầu ra -> OutputManifest
         
-        self.task_queue = queue.Queue()
+        # Mỗi model một hàng đợi riêng, lần lượt xoay vòng khi gửi để model chậm không chặn model khác
+        self.pending = {}  # model -> deque các task đang chờ gửi lên API
+        self.model_order = deque()  # thứ tự xoay vòng các model
+        self.active_by_model = {}  # model -> số task đang xử lý trên server
+        self.retry_waiting = []  # (thời điểm gửi lại, task_info) của các task chờ thử lại
         self.active_tasks = {}  # task_id -> task_info
         self.completed_tasks = []
         self.failed_tasks = []
+        self.cancelled_tasks = []
+        self.jobs = {}  # job_id -> task_info, dùng để hủy task theo job/lô
+        self.groups = {}  # group_id -> tiến độ các biến thể của cùng một ảnh
+        self.history = None  # RunHistory, ghi mọi task đã kết thúc nếu được gán
         
         self.running = False
+        self.paused = False
+        self.draining = False
+        # Ngừng gửi task mới khi có endpoint bị ngắt; sau khi hồi phục số task chạy đồng thời
+        # tối đa là ramp_limit, tăng dần mỗi RAMP_INTERVAL giây cho tới khi đạt giới hạn thường
+        self.endpoint_paused = False
+        self.ramp_limit = None
+        self._ramp_step = 1
+        self._ramp_at = 0.0
         self.queue_thread = None
         self.lock = threading.Lock()
+        self.downloads.status_lock = self.lock
+        # Đánh thức vòng lặp thay cho sleep để dừng/tạm dừng có hiệu lực ngay
+        self._wakeup = threading.Event()
+        self._next_poll = 0.0
+        self.version = 0
+        self.groups_done = 0
+        with self.lock:
+            self._publish_locked()
         
         # Callbacks
         self.on_task_completed = None
         self.on_task_failed = None
         self.on_task_started = None
+        self.on_task_cancelled = None
         self.on_queue_updated = None
+        self.on_drained = None
+        self.on_group_completed = None
+        self.on_endpoint_paused = None  # (đang tạm dừng do endpoint bị ngắt: bool)
+    
+    def add_task(self, image_path, prompt, output_filename, model="I2V-01-Director", batch_id=None, source_digest=None):
+        """Thêm task mới vào hàng đợi, trả về job_id"""
+        task_info = self._new_task(image_path, prompt, output_filename, model, batch_id, source_digest)
+        self._enqueue([task_info])
+        return task_info['job_id']
     
-    def add_task(self, image_path, prompt, output_filename, model="I2V-01-Director"):
-        """Thêm task mới vào hàng đợi"""
-        task_info = {
+    def add_task_group(self, image_path, variants, model="I2V-01-Director", batch_id=None, source_digest=None):
+        """Thêm nhiều biến thể (prompt, output_filename) cho cùng một ảnh, trả về group_id
+
+        Các task dùng chung một SharedImagePayload nên ảnh chỉ được đọc và mã hóa một lần.
+        """
+        group_id = uuid.uuid4().hex[:12]
+        payload = SharedImagePayload(image_path)
+        tasks = [self._new_task(image_path, prompt, output_filename, model, batch_id, source_digest,
+                                group_id=group_id, image_payload=payload)
+                 for prompt, output_filename in variants]
+        
+        with self.lock:
+            self.groups[group_id] = {
+                'group_id': group_id,
+                'batch_id': batch_id,
+                'image_path': image_path,
+                'job_ids': [task['job_id'] for task in tasks],
+                'total': len(tasks),
+                'completed': 0,
+                'failed': 0,
+                'cancelled': 0,
+                'payload': payload
+            }
+        self._enqueue(tasks)
+        return group_id
+    
+    def _new_task(self, image_path, prompt, output_filename, model, batch_id, source_digest,
+                  group_id=None, image_payload=None):
+        return {
+            'job_id': uuid.uuid4().hex[:12],
+            'batch_id': batch_id,
+            'group_id': group_id,
+            'image_payload': image_payload,
             'image_path': image_path,
+            'source_digest': source_digest,
             'prompt': prompt,
             'output_filename': output_filename,
             'model': model,
             'status': 'queued',
-            'added_time': datetime.now(),
+            'added_time': self.clock.now(),
             'task_id': None,
             'file_id': None
         }
-        
-        self.task_queue.put(task_info)
+    
+    def _enqueue(self, tasks):
+        with self.lock:
+            for task_info in tasks:
+                self.jobs[task_info['job_id']] = task_info
+                self._push_locked(task_info)
+            self._publish_locked()
         
         if self.on_queue_updated:
             self.on_queue_updated()
             
         if not self.running:
             self.start_processing()
+        else:
+            self._wakeup.set()
+    
+    def apply_config(self, snapshot):
+        """Áp dụng cấu hình mới mà không dừng hàng đợi"""
+        self.max_concurrent_tasks = snapshot.max_concurrent_tasks
+        self.max_retries = snapshot.max_retries
+        self.retry_delay = snapshot.retry_delay
+        self.model_limits = parse_model_limits(snapshot.model_concurrency)
+        if snapshot.poll_interval != self.poll_interval:
+            self.poll_interval = snapshot.poll_interval
+            self._next_poll = min(self._next_poll, self.clock.monotonic() + self.poll_interval)
+        self.api_client.update_keys(snapshot.api_key, max_tasks_per_key=snapshot.max_concurrent_tasks)
+        self.api_client.upload_gzip = snapshot.upload_gzip
+        self.downloads.apply_config(snapshot)
+        self._wakeup.set()
+    
+    def wake(self):
+        """Đánh thức vòng lặp xử lý để kiểm tra lại ngay"""
+        self._wakeup.set()
     
     def start_processing(self):
         """Bắt đầu xử lý hàng đợi task"""
@@ -285,208 +2634,1170 @@ class TaskQueueManager:
             return
         
         self.running = True
-        self.queue_thread = threading.Thread(target=self._process_queue)
+        self.draining = False
+        self._wakeup.clear()
+        self.queue_thread = threading.Thread(target=self._process_queue, name="task-queue")
         self.queue_thread.daemon = True
         self.queue_thread.start()
     
-    def stop_processing(self):
-        """Dừng xử lý hàng đợi task"""
+    def stop_processing(self, timeout=5.0):
+        """Dừng xử lý hàng đợi task, trả về True nếu luồng đã dừng hẳn"""
         self.running = False
+        self._wakeup.set()
         if self.queue_thread and self.queue_thread.is_alive():
-            self.queue_thread.join(timeout=2.0)
+            self.queue_thread.join(timeout=timeout)
+            if self.queue_thread.is_alive():
+                queue_logger.warning("Luồng xử lý hàng đợi chưa dừng sau %.1f giây", timeout)
+                return False
+        
+        # Task đang xử lý trên server vẫn được giữ lại để tiếp tục theo dõi khi chạy lại
+        if self.active_tasks:
+            queue_logger.warning("Dừng hàng đợi khi còn %d task đang xử lý trên server", len(self.active_tasks))
+        return True
+    
+    def pause(self):
+        """Tạm dừng gửi và theo dõi task"""
+        with self.lock:
+            self.paused = True
+            self._publish_locked()
+        self._wakeup.set()
+    
+    def resume(self):
+        """Tiếp tục xử lý sau khi tạm dừng"""
+        with self.lock:
+            self.paused = False
+            self._publish_locked()
+        self._next_poll = 0.0
+        self._wakeup.set()
+        if not self.running:
+            self.start_processing()
+    
+    def drain(self):
+        """Ngừng gửi task mới, hoàn tất các task đang xử lý rồi dừng"""
+        with self.lock:
+            self.draining = True
+            self.paused = False
+            self._publish_locked()
+        self._wakeup.set()
+    
+    def cancel_task(self, job_id):
+        """Hủy một task theo job_id"""
+        with self.lock:
+            task_info = self.jobs.get(job_id)
+            if task_info is None or task_info['status'] in ('completed', 'failed', 'cancelled'):
+                return False
+            
+            if task_info['status'] == 'queued':
+                try:
+                    self.pending[task_info['model']].remove(task_info)
+                except (KeyError, ValueError):
+                    self.retry_waiting = [item for item in self.retry_waiting if item[1] is not task_info]
+            elif task_info['status'] == 'submitting':
+                # Đang gửi lên API, luồng xử lý sẽ bỏ task sau khi gửi xong
+                task_info['cancel_requested'] = True
+                return True
+            elif task_info['task_id'] in self.active_tasks:
+                # API không hỗ trợ hủy từ xa, chỉ ngừng theo dõi và tải xuống
+                self._deactivate_locked(task_info['task_id'])
+                self.api_client.release_task(task_info['task_id'])
+            
+            task_info['status'] = 'cancelled'
+            task_info['finish_time'] = self.clock.now()
+            self.cancelled_tasks.append(task_info)
+            self._publish_locked()
+        
+        if self.on_task_cancelled:
+            self.on_task_cancelled(task_info)
+        self._task_finished(task_info)
+        if self.on_queue_updated:
+            self.on_queue_updated()
+        return True
+    
+    def cancel_batch(self, batch_id):
+        """Hủy toàn bộ task thuộc một lô, trả về số task đã hủy"""
+        with self.lock:
+            job_ids = [job_id for job_id, task in self.jobs.items() if task.get('batch_id') == batch_id]
+        return sum(1 for job_id in job_ids if self.cancel_task(job_id))
+    
+    def cancel_all(self):
+        """Hủy tất cả task chưa kết thúc"""
+        with self.lock:
+            job_ids = list(self.jobs.keys())
+        return sum(1 for job_id in job_ids if self.cancel_task(job_id))
     
     def _process_queue(self):
         """Vòng lặp xử lý hàng đợi chính"""
         while self.running:
-            # Bắt đầu task mới nếu còn dung lượng
-            while len(self.active_tasks) < self.max_concurrent_tasks and not self.task_queue.empty():
-                task_info = self.task_queue.get()
-                try:
-                    response = self.api_client.create_video_task(
-                        task_info['image_path'],
-                        task_info['prompt'],
-                        task_info['model']
-                    )
-                    
-                    task_id = response.get('task_id')
-                    if not task_id:
-                        raise Exception(f"Không nhận được task_id: {response}")
-                    
-                    task_info['task_id'] = task_id
-                    task_info['status'] = 'processing'
-                    task_info['start_time'] = datetime.now()
-                    
-                    with self.lock:
+            self._wakeup.clear()
+            wait_time = self.run_once()
+            if not self.running:
+                break
+            # Chờ tới lượt kiểm tra tiếp theo hoặc tới khi được đánh thức
+            self.clock.wait(self._wakeup, wait_time)
+    
+    def run_once(self):
+        """Chạy một vòng xử lý, trả về số giây cần chờ tới vòng sau (None = chờ được đánh thức)"""
+        if self.paused:
+            return None
+        
+        self._check_endpoints()
+        if not self.draining:
+            self._release_due_retries()
+            if not self.endpoint_paused:
+                self._submit_pending()
+        
+        if self.clock.monotonic() >= self._next_poll:
+            # Endpoint truy vấn bị ngắt: giữ nguyên các task đang chạy, truy vấn lại khi hồi phục
+            if self.api_client.endpoint_ready('query'):
+                self._poll_active_tasks()
+            self._next_poll = self.clock.monotonic() + self.poll_interval
+        
+        if self.draining and not self.in_flight_count():
+            self.running = False
+            with self.lock:
+                self.draining = False
+                self._publish_locked()
+            queue_logger.info("Đã hoàn tất các task đang xử lý, dừng hàng đợi")
+            if self.on_drained:
+                self.on_drained()
+            return None
+        
+        next_check = self._next_poll
+        if self.retry_waiting and not self.draining:
+            next_check = min(next_check, min(item[0] for item in self.retry_waiting))
+        if self.endpoint_paused:
+            retry_after = self.api_client.health_retry_after()
+            if retry_after is not None:
+                next_check = min(next_check, self.clock.monotonic() + retry_after)
+        elif self.ramp_limit is not None:
+            next_check = min(next_check, self._ramp_at)
+        return max(0.0, next_check - self.clock.monotonic())
+    
+    def _check_endpoints(self):
+        """Tạm dừng gửi task khi có endpoint bị ngắt, tăng dần lại sau khi hồi phục"""
+        healthy = self.api_client.check_health()
+        now = self.clock.monotonic()
+        if healthy and not self.endpoint_paused:
+            if self.ramp_limit is not None and now >= self._ramp_at:
+                self._ramp_step *= 2
+                self.ramp_limit += self._ramp_step
+                self._ramp_at = now + self.RAMP_INTERVAL
+                if self.ramp_limit >= self._capacity():
+                    self.ramp_limit = None
+                    queue_logger.info("Đã trở lại số task đồng thời bình thường")
+            return
+        if not healthy and self.endpoint_paused:
+            return
+        
+        with self.lock:
+            self.endpoint_paused = not healthy
+            if healthy:
+                # Khởi động chậm: thêm 1 task, sau đó số task thêm tăng gấp đôi mỗi RAMP_INTERVAL
+                self.ramp_limit = len(self.active_tasks) + 1
+                self._ramp_step = 1
+                self._ramp_at = now + self.RAMP_INTERVAL
+            self._publish_locked()
+        
+        if healthy:
+            queue_logger.info("Các endpoint đã hoạt động lại, tăng dần số task gửi đi")
+        else:
+            states = self.api_client.breaker_states()
+            queue_logger.warning("Tạm dừng gửi task mới do endpoint bị ngắt: %s",
+                                 ", ".join(name for name, state in states.items() if state != 'closed'))
+        if self.on_endpoint_paused:
+            self.on_endpoint_paused(self.endpoint_paused)
+    
+    def _release_due_retries(self):
+        """Đưa các task đã hết thời gian chờ thử lại về hàng đợi"""
+        now = self.clock.monotonic()
+        with self.lock:
+            if not any(due <= now for due, _ in self.retry_waiting):
+                return
+            for due, task_info in self.retry_waiting:
+                if due <= now:
+                    self._push_locked(task_info)
+            self.retry_waiting = [item for item in self.retry_waiting if item[0] > now]
+            self._publish_locked()
+    
+    def _submit_pending(self):
+        """Gửi task mới nếu còn dung lượng"""
+        while self.running and not self.paused and not self.draining:
+            with self.lock:
+                if len(self.active_tasks) >= self._admission_limit():
+                    return
+                # Không gửi thêm khi đĩa sắp đầy, tránh dồn video chờ tải
+                if self.downloads.space_paused:
+                    return
+                task_info = self._next_task_locked()
+                if task_info is None:
+                    return
+                task_info['status'] = 'submitting'
+                self._publish_locked()
+            
+            try:
+                submit_start = self.clock.monotonic()
+                response = self.api_client.create_video_task(
+                    task_info['image_path'],
+                    task_info['prompt'],
+                    task_info['model'],
+                    image_payload=task_info['image_payload']
+                )
+                
+                task_id = response.get('task_id')
+                if not task_id:
+                    raise Exception(f"Không nhận được task_id: {response}")
+                
+                task_info['task_id'] = task_id
+                task_info['start_time'] = self.clock.now()
+                queue_logger.info("Đã gửi task %s", task_id, extra={
+                    'task_id': task_id, 'job_id': task_info['job_id'],
+                    'stage': 'submit', 'duration': round(self.clock.monotonic() - submit_start, 3)
+                })
+                
+                with self.lock:
+                    cancelled = task_info.pop('cancel_requested', False)
+                    if cancelled:
+                        task_info['status'] = 'cancelled'
+                        task_info['finish_time'] = self.clock.now()
+                        self.cancelled_tasks.append(task_info)
+                        self.api_client.release_task(task_id)
+                    else:
+                        task_info['status'] = 'processing'
                         self.active_tasks[task_id] = task_info
-                    
-                    if self.on_task_started:
-                        self.on_task_started(task_info)
-                    
-                except Exception as e:
-                    task_info['status'] = 'failed'
-                    task_info['error'] = str(e)
-                    self.failed_tasks.append(task_info)
-                    
-                    if self.on_task_failed:
-                        self.on_task_failed(task_info)
+                        model = task_info['model']
+                        self.active_by_model[model] = self.active_by_model.get(model, 0) + 1
+                    self._publish_locked()
+                
+                if cancelled:
+                    if self.on_task_cancelled:
+                        self.on_task_cancelled(task_info)
+                    self._task_finished(task_info)
+                elif self.on_task_started:
+                    self.on_task_started(task_info)
                 
-                finally:
-                    self.task_queue.task_done()
-                    if self.on_queue_updated:
-                        self.on_queue_updated()
+            except (NoAvailableKeyError, CircuitOpenError):
+                # Tất cả key đang bận/tạm ngưng hoặc endpoint bị ngắt, giữ task trong hàng đợi
+                self._requeue_front(task_info)
+                return
             
-            # Kiểm tra trạng thái của các task đang hoạt động
-            completed_tasks = []
-            for task_id, task_info in list(self.active_tasks.items()):
-                try:
-                    status_resp = self.api_client.query_task_status(task_id)
-                    current_status = status_resp.get('status')
-                    
-                    if current_status == 'Success':
-                        file_id = status_resp.get('file_id')
-                        if not file_id:
-                            raise Exception(f"Không nhận được file_id cho task đã hoàn thành: {status_resp}")
-                        
-                        task_info['file_id'] = file_id
-                        task_info['status'] = 'downloading'
-                        
-                        # Truy xuất URL tải xuống
-                        file_resp = self.api_client.retrieve_video(file_id)
-                        download_url = file_resp.get('file', {}).get('download_url')
-                        
-                        if not download_url:
-                            raise Exception(f"Không nhận được download_url: {file_resp}")
-                        
-                        # Tải video
-                        output_path = task_info['output_filename']
-                        self.api_client.download_video(download_url, output_path)
-                        
-                        task_info['status'] = 'completed'
-                        task_info['completion_time'] = datetime.now()
-                        
-                        completed_tasks.append(task_id)
-                        self.completed_tasks.append(task_info)
-                        
-                        if self.on_task_completed:
-                            self.on_task_completed(task_info)
-                    
-                    elif current_status == 'Fail':
-                        task_info['status'] = 'failed'
-                        task_info['error'] = f"Task thất bại: {status_resp}"
-                        
-                        completed_tasks.append(task_id)
-                        self.failed_tasks.append(task_info)
-                        
-                        if self.on_task_failed:
-                            self.on_task_failed(task_info)
-                    
-                    # Các trạng thái khác vẫn đang xử lý
-                    
-                except Exception as e:
-                    task_info['status'] = 'failed'
-                    task_info['error'] = str(e)
+            except Exception as e:
+                if not self.api_client.endpoint_ready('create'):
+                    # Lỗi này làm endpoint bị ngắt: không tính là một lần thử của task
+                    self._requeue_front(task_info)
+                    return
+                self._retry_or_fail(task_info, str(e))
+            
+            finally:
+                if self.on_queue_updated:
+                    self.on_queue_updated()
+    
+    def _requeue_front(self, task_info):
+        """Đưa task đang gửi về đầu hàng đợi của model, hoặc kết thúc task nếu đã bị hủy trong lúc gửi"""
+        with self.lock:
+            cancelled = task_info.pop('cancel_requested', False)
+            if cancelled:
+                task_info['status'] = 'cancelled'
+                task_info['finish_time'] = self.clock.now()
+                self.cancelled_tasks.append(task_info)
+            else:
+                task_info['status'] = 'queued'
+                self._push_locked(task_info, front=True)
+            self._publish_locked()
+        
+        if cancelled:
+            if self.on_task_cancelled:
+                self.on_task_cancelled(task_info)
+            self._task_finished(task_info)
+    
+    def _capacity(self):
+        """Số task tối đa chạy đồng thời, tăng theo số API key khả dụng"""
+        return self.max_concurrent_tasks * max(1, self.api_client.key_count())
+    
+    def _admission_limit(self):
+        """Giới hạn số task đang chạy khi gửi task mới (thấp hơn khi đang tăng dần sau sự cố)"""
+        if self.ramp_limit is None:
+            return self._capacity()
+        return min(self.ramp_limit, self._capacity())
+    
+    def _model_capacity(self, model):
+        """Số task tối đa chạy đồng thời của một model (không vượt quá giới hạn chung)"""
+        capacity = self._capacity()
+        limit = self.model_limits.get(model)
+        if limit is None:
+            return capacity
+        return min(capacity, limit * max(1, self.api_client.key_count()))
+    
+    def _push_locked(self, task_info, front=False):
+        """Đưa task vào hàng đợi của model tương ứng (gọi khi đang giữ self.lock)"""
+        model = task_info['model']
+        tasks = self.pending.get(model)
+        if tasks is None:
+            tasks = self.pending[model] = deque()
+            self.model_order.append(model)
+        if front:
+            tasks.appendleft(task_info)
+        else:
+            tasks.append(task_info)
+    
+    def _next_task_locked(self):
+        """Lấy task kế tiếp theo vòng xoay giữa các model còn suất chạy, None nếu không có"""
+        for _ in range(len(self.model_order)):
+            model = self.model_order[0]
+            self.model_order.rotate(-1)
+            tasks = self.pending[model]
+            if tasks and self.active_by_model.get(model, 0) < self._model_capacity(model):
+                return tasks.popleft()
+        return None
+    
+    def _deactivate_locked(self, task_id):
+        """Xóa task khỏi danh sách đang xử lý, trả về task_info hoặc None (gọi khi đang giữ self.lock)"""
+        task_info = self.active_tasks.pop(task_id, None)
+        if task_info is not None:
+            self.active_by_model[task_info['model']] -= 1
+        return task_info
+    
+    def _poll_active_tasks(self):
+        """Kiểm tra trạng thái của các task đang hoạt động"""
+        with self.lock:
+            active = list(self.active_tasks.items())
+        
+        for task_id, task_info in active:
+            if not self.running or self.paused:
+                break
+            if task_info['status'] == 'cancelled':
+                continue
+            
+            try:
+                status_resp = self.api_client.query_task_status(task_id)
+                current_status = status_resp.get('status')
+                
+                if current_status == 'Success':
+                    file_id = status_resp.get('file_id')
+                    if not file_id:
+                        raise Exception(f"Không nhận được file_id cho task đã hoàn thành: {status_resp}")
                     
-                    completed_tasks.append(task_id)
-                    self.failed_tasks.append(task_info)
+                    task_info['file_id'] = file_id
                     
-                    if self.on_task_failed:
-                        self.on_task_failed(task_info)
+                    # Chuyển sang pool tải xuống, giải phóng suất xử lý cho task mới.
+                    # Key vẫn được giữ tới khi tải xong vì cần dùng để truy xuất file.
+                    with self.lock:
+                        if self._deactivate_locked(task_id) is None:
+                            continue
+                        task_info['status'] = 'downloading'
+                    task_info['generated_time'] = self.clock.now()
+                    queue_logger.info("Task %s đã tạo xong video", task_id, extra={
+                        'task_id': task_id, 'job_id': task_info['job_id'], 'stage': 'generate',
+                        'duration': (task_info['generated_time'] - task_info['start_time']).total_seconds()
+                    })
+                    self.downloads.submit(task_info, self.api_client, self._on_download_finished)
+                    with self.lock:
+                        self._publish_locked()
+                
+                elif current_status == 'Fail':
+                    if self._finish_active(task_id):
+                        self._retry_or_fail(task_info, f"Task thất bại: {status_resp}")
+                
+                # Các trạng thái khác vẫn đang xử lý
             
-            # Xóa các task đã hoàn thành khỏi danh sách task đang hoạt động
-            with self.lock:
-                for task_id in completed_tasks:
-                    if task_id in self.active_tasks:
-                        del self.active_tasks[task_id]
+            except CircuitOpenError:
+                break
             
-            if self.on_queue_updated:
-                self.on_queue_updated()
+            except requests.RequestException as e:
+                # Lỗi mạng/máy chủ khi truy vấn không có nghĩa task thất bại: giữ task, truy vấn lại lượt sau
+                queue_logger.warning("Lỗi khi truy vấn task %s: %s", task_id, e, extra={
+                    'task_id': task_id, 'job_id': task_info['job_id'], 'stage': 'poll'
+                })
+                if not self.api_client.endpoint_ready('query'):
+                    break
             
-            # Ngủ trước khi kiểm tra tiếp
-            time.sleep(self.poll_interval)
+            except Exception as e:
+                if self._finish_active(task_id):
+                    self._retry_or_fail(task_info, str(e))
+        
+        if self.on_queue_updated:
+            self.on_queue_updated()
+    
+    def _on_download_finished(self, task_info, error):
+        """Callback từ pool tải xuống"""
+        self.api_client.release_task(task_info['task_id'])
+        
+        # Kiểm tra và chuyển trạng thái trong cùng một lần giữ khóa để không chen ngang lúc hủy task
+        with self.lock:
+            cancelled = task_info['status'] == 'cancelled'
+            if cancelled:
+                # Task bị hủy khi đang tải: chỉ cần cập nhật số task đang tải
+                self._publish_locked()
+            elif not error:
+                task_info['status'] = 'completed'
+                task_info['completion_time'] = self.clock.now()
+                self.completed_tasks.append(task_info)
+                self._publish_locked()
+        
+        if error and not cancelled:
+            self._fail_task(task_info, error)
+        elif not cancelled:
+            try:
+                self.get_manifest(os.path.dirname(task_info['output_filename'])).record(task_info)
+            except Exception as e:
+                queue_logger.error("Lỗi khi ghi manifest: %s", e)
+            
+            if self.on_task_completed:
+                self.on_task_completed(task_info)
+            self._task_finished(task_info)
+        
+        if self.on_queue_updated:
+            self.on_queue_updated()
+        # Đánh thức vòng lặp để kiểm tra điều kiện kết thúc chế độ drain
+        self._wakeup.set()
+    
+    def get_manifest(self, output_folder):
+        """Lấy manifest của thư mục đầu ra (tạo mới nếu chưa có)"""
+        output_folder = os.path.abspath(output_folder)
+        with self.lock:
+            manifest = self.manifests.get(output_folder)
+            if manifest is None:
+                manifest = OutputManifest(output_folder)
+                self.manifests[output_folder] = manifest
+            return manifest
+    
+    def in_flight_count(self):
+        """Số task đang xử lý trên server hoặc đang tải xuống"""
+        return len(self.active_tasks) + self.downloads.pending_count()
+    
+    def unfinished_count(self):
+        """Số task chưa kết thúc (kể cả task đang gửi lên API)"""
+        with self.lock:
+            return len(self.jobs) - len(self.completed_tasks) - len(self.failed_tasks) - len(self.cancelled_tasks)
+    
+    def _finish_active(self, task_id):
+        """Xóa task khỏi danh sách đang hoạt động, trả về False nếu task đã bị hủy"""
+        with self.lock:
+            finished = self._deactivate_locked(task_id) is not None
+            if finished:
+                self._publish_locked()
+        if finished:
+            self.api_client.release_task(task_id)
+        return finished
+    
+    def _retry_or_fail(self, task_info, error):
+        """Gửi lại task sau retry_delay (tăng gấp đôi mỗi lần) hoặc đánh dấu thất bại khi hết lượt"""
+        attempts = task_info.get('attempts', 0)
+        if attempts >= self.max_retries or task_info.get('cancel_requested'):
+            self._fail_task(task_info, error)
+            return
+        
+        delay = self.retry_delay * 2 ** attempts
+        queue_logger.warning("Thử lại task sau %.0f giây (lần %d/%d): %s", delay, attempts + 1,
+                             self.max_retries, error, extra={
+                                 'task_id': task_info.get('task_id'), 'job_id': task_info['job_id'],
+                                 'stage': 'retry'
+                             })
+        with self.lock:
+            task_info['attempts'] = attempts + 1
+            task_info['last_error'] = error
+            task_info['status'] = 'queued'
+            task_info['task_id'] = None
+            task_info['file_id'] = None
+            self.retry_waiting.append((self.clock.monotonic() + delay, task_info))
+            self._publish_locked()
+        self._wakeup.set()
+    
+    def _fail_task(self, task_info, error):
+        """Đánh dấu task thất bại"""
+        queue_logger.warning("Task thất bại: %s", error, extra={
+            'task_id': task_info.get('task_id'), 'job_id': task_info['job_id'], 'stage': task_info['status']
+        })
+        with self.lock:
+            if task_info['status'] == 'cancelled':
+                # Task đã bị hủy trong lúc chờ khóa, đã được tính là task bị hủy
+                return
+            task_info['status'] = 'failed'
+            task_info['error'] = error
+            task_info['finish_time'] = self.clock.now()
+            self.failed_tasks.append(task_info)
+            self._publish_locked()
+        
+        if self.on_task_failed:
+            self.on_task_failed(task_info)
+        self._task_finished(task_info)
+    
+    def _task_finished(self, task_info):
+        """Ghi lịch sử và cập nhật nhóm biến thể khi task kết thúc"""
+        if self.history:
+            try:
+                self.history.record(task_info)
+            except Exception as e:
+                queue_logger.error("Lỗi khi ghi lịch sử task: %s", e)
+        self._update_group(task_info)
+    
+    def _update_group(self, task_info):
+        """Cập nhật tiến độ nhóm biến thể khi một task kết thúc"""
+        group_id = task_info.get('group_id')
+        if group_id is None:
+            return
+        
+        with self.lock:
+            group = self.groups.get(group_id)
+            if group is None:
+                return
+            group[task_info['status']] += 1
+            finished = group['completed'] + group['failed'] + group['cancelled'] == group['total']
+            if finished:
+                self.groups_done += 1
+                self._publish_locked()
+        
+        if finished:
+            group['payload'].release()
+            queue_logger.info("Đã xong %d/%d biến thể của ảnh %s", group['completed'], group['total'],
+                              os.path.basename(group['image_path']))
+            if self.on_group_completed:
+                self.on_group_completed(group)
+    
+    def _publish_locked(self):
+        """Thay snapshot trạng thái bằng bản mới (gọi khi đang giữ self.lock)"""
+        self.version += 1
+        waiting = {}
+        for _, task_info in self.retry_waiting:
+            waiting[task_info['model']] = waiting.get(task_info['model'], 0) + 1
+        # (model, số task chờ, số task đang xử lý) theo thứ tự model xuất hiện
+        models = tuple((model, len(self.pending[model]) + waiting.get(model, 0), self.active_by_model.get(model, 0))
+                       for model in self.pending)
+        self.snapshot = QueueSnapshot(
+            version=self.version,
+            queued=sum(queued for _, queued, _ in models),
+            active=len(self.active_tasks),
+            downloading=self.downloads.pending_count(),
+            completed=len(self.completed_tasks),
+            failed=len(self.failed_tasks),
+            cancelled=len(self.cancelled_tasks),
+            total=len(self.jobs),
+            paused=self.paused,
+            draining=self.draining,
+            groups_done=self.groups_done,
+            groups_total=len(self.groups),
+            active_starts=tuple(task.get('start_time') for task in self.active_tasks.values()),
+            models=models,
+            endpoint_paused=self.endpoint_paused
+        )
+    
+    def diagnostics(self):
+        """Số liệu cho log chẩn đoán: độ sâu hàng đợi theo model và số lượt HTTP đang chạy"""
+        snapshot = self.snapshot
+        return {
+            'queue_version': snapshot.version,
+            'queued': snapshot.queued,
+            'retry_waiting': len(self.retry_waiting),
+            'active': snapshot.active,
+            'downloading': snapshot.downloading,
+            'models': {model: {'queued': queued, 'active': active} for model, queued, active in snapshot.models},
+            'http_in_flight': self.api_client.http_in_flight(),
+            'endpoints': self.api_client.breaker_states(),
+            'ramp_limit': self.ramp_limit
+        }
+
+
+def replay_trace(path, max_concurrent_tasks=3, poll_interval=10, max_retries=0, retry_delay=30,
+                 speed=100.0, download_workers=2, timeout=600):
+    """Chạy lại trace qua TaskQueueManager với thiết lập cho trước, trả về thống kê (giây ảo)"""
+    clock = ScaledClock(speed)
+    api = TraceReplayAPI(load_trace(path), max_tasks_per_key=max_concurrent_tasks, clock=clock)
+    downloads = DownloadManager(max_workers=download_workers, min_free_space_mb=0, clock=clock)
+    task_queue = TaskQueueManager(api, max_concurrent_tasks=max_concurrent_tasks,
+                                  poll_interval=poll_interval, download_manager=downloads,
+                                  max_retries=max_retries, retry_delay=retry_delay, clock=clock)
+    output_folder = tempfile.mkdtemp(prefix="minimax_replay_")
+    
+    try:
+        for i in range(len(api.creates)):
+            task_queue.add_task("replay.png", "replay", os.path.join(output_folder, f"replay_{i}.mp4"),
+                                source_digest="replay")
+        
+        deadline = time.monotonic() + timeout
+        while task_queue.unfinished_count():
+            if time.monotonic() > deadline:
+                queue_logger.warning("Hết thời gian chờ khi chạy lại trace %s", path)
+                break
+            time.sleep(0.005)
+        makespan = api.now()
+    finally:
+        task_queue.stop_processing()
+        downloads.shutdown()
+        shutil.rmtree(output_folder, ignore_errors=True)
+    
+    result = summarize_run(task_queue, makespan)
+    result['api_calls'] = api.calls
+    return result
+
+
+def run_simulation(task_queue, clock, max_seconds=None):
+    """Chạy hàng đợi trên SimulatedClock trong luồng hiện tại cho tới khi mọi task kết thúc"""
+    start = clock.monotonic()
+    task_queue.running = True
+    try:
+        while task_queue.unfinished_count():
+            if max_seconds is not None and clock.monotonic() - start >= max_seconds:
+                break
+            wait_time = task_queue.run_once()
+            clock.advance(max(wait_time if wait_time is not None else task_queue.poll_interval, 0.001))
+    finally:
+        task_queue.running = False
+    return clock.monotonic() - start
+
+
+def summarize_run(task_queue, makespan):
+    """Thống kê một lượt chạy: thông lượng, độ trễ và thứ tự bắt đầu task (FIFO)"""
+    jobs = list(task_queue.jobs.values())
+    latencies = [(task['completion_time'] - task['added_time']).total_seconds()
+                 for task in task_queue.completed_tasks]
+    waits = [(task['start_time'] - task['added_time']).total_seconds() for task in jobs if 'start_time' in task]
+    
+    # Số task được gửi trước một task thêm vào sớm hơn nó (không tính task thử lại)
+    started = sorted((task['start_time'], order) for order, task in enumerate(jobs)
+                     if 'start_time' in task and not task.get('attempts'))
+    out_of_order = sum(1 for (_, previous), (_, current) in zip(started, started[1:]) if current < previous)
+    
+    return {
+        'tasks': len(jobs),
+        'completed': len(task_queue.completed_tasks),
+        'failed': len(task_queue.failed_tasks),
+        'retries': sum(task.get('attempts', 0) for task in jobs),
+        'makespan': round(makespan, 1),
+        'throughput_per_hour': round(len(task_queue.completed_tasks) / makespan * 3600, 1) if makespan else None,
+        'avg_latency': round(sum(latencies) / len(latencies), 1) if latencies else None,
+        'max_queue_wait': round(max(waits), 1) if waits else None,
+        'out_of_order_starts': out_of_order
+    }
+
+
+def simulate_queue(tasks=10000, max_concurrent_tasks=3, keys=1, poll_interval=10, max_retries=0,
+                   retry_delay=30, generation_time=240, failure_rate=0.0, max_hours=24, seed=1):
+    """Giả lập một lô task trên đồng hồ ảo, trả về thống kê (giây ảo) trong vài giây chạy thật"""
+    clock = SimulatedClock()
+    api = SimulatedAPI(clock, keys=keys, max_tasks_per_key=max_concurrent_tasks,
+                       generation_time=generation_time, failure_rate=failure_rate, seed=seed)
+    downloads = DownloadManager(post_processing=(), min_free_space_mb=0, clock=clock, inline=True)
+    task_queue = TaskQueueManager(api, max_concurrent_tasks=max_concurrent_tasks, poll_interval=poll_interval,
+                                  download_manager=downloads, max_retries=max_retries,
+                                  retry_delay=retry_delay, clock=clock)
+    statistics = TaskStatisticsManager(task_queue)
+    output_folder = tempfile.mkdtemp(prefix="minimax_sim_")
+    
+    try:
+        # Đánh dấu đang chạy để add_task không mở luồng xử lý riêng
+        task_queue.running = True
+        for i in range(tasks):
+            task_queue.add_task("sim.png", "sim", os.path.join(output_folder, f"sim_{i}.mp4"),
+                                batch_id=i % 10, source_digest="sim")
+        makespan = run_simulation(task_queue, clock, max_seconds=max_hours * 3600)
+        stats = statistics.update_stats()
+    finally:
+        downloads.shutdown()
+        shutil.rmtree(output_folder, ignore_errors=True)
+    
+    result = summarize_run(task_queue, makespan)
+    result['api_calls'] = api.calls
+    result['queries_per_task'] = round(api.calls.get('query', 0) / max(1, api.calls.get('create', 0)), 2)
+    result['estimated_remaining'] = stats['estimated_completion_time']
+    return result
+
+
+class EwmaStat:
+    """Trung bình và phương sai trượt mũ (EWMA), cập nhật tăng dần"""
+    
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.mean = None
+        self.var = 0.0
+        self.count = 0
+    
+    def update(self, value):
+        self.count += 1
+        if self.mean is None:
+            self.mean = value
+            return
+        diff = value - self.mean
+        increment = self.alpha * diff
+        self.mean += increment
+        self.var = (1 - self.alpha) * (self.var + diff * increment)
+    
+    @property
+    def sd(self):
+        return self.var ** 0.5
+
+
+class ThroughputEstimator:
+    """Ước tính tốc độ hoàn thành task bằng EWMA trên các cửa sổ thời gian cố định
+
+    Thời gian truyền vào dạng số giây (timestamp), nên có thể chạy lại trên dữ
+    liệu đã ghi để kiểm tra độ chính xác.
+    """
+    
+    def __init__(self, bucket_seconds=60.0, alpha=0.3, min_buckets=2):
+        self.bucket_seconds = bucket_seconds
+        self.min_buckets = min_buckets
+        self.rate = EwmaStat(alpha)  # task/giây của mỗi cửa sổ
+        self.bucket_start = None
+        self.bucket_count = 0
+        self.total = 0
+    
+    def _advance(self, now):
+        """Đóng các cửa sổ đã kết thúc trước thời điểm now"""
+        if self.bucket_start is None:
+            self.bucket_start = now
+            return
+        
+        closed = int((now - self.bucket_start) // self.bucket_seconds)
+        if closed <= 0:
+            return
+        self.rate.update(self.bucket_count / self.bucket_seconds)
+        # Các cửa sổ trống liên tiếp (giới hạn để khoảng nghỉ dài không tốn vòng lặp)
+        for _ in range(min(closed - 1, 60)):
+            self.rate.update(0.0)
+        self.bucket_count = 0
+        self.bucket_start += closed * self.bucket_seconds
+    
+    def observe(self, timestamp, count=1):
+        """Ghi nhận count task kết thúc tại timestamp"""
+        self._advance(timestamp)
+        self.bucket_count += count
+        self.total += count
+    
+    def rate_per_second(self, now):
+        """Tốc độ hoàn thành hiện tại (task/giây), None nếu chưa đủ dữ liệu"""
+        if self.bucket_start is None:
+            return None
+        self._advance(now)
+        if self.rate.count < self.min_buckets:
+            return None
+        return self.rate.mean
+    
+    def eta(self, remaining, now, z=1.96):
+        """Ước tính (giây, cận dưới, cận trên) để hoàn thành remaining task"""
+        rate = self.rate_per_second(now)
+        if not rate or rate <= 0:
+            return None
+        spread = z * self.rate.sd
+        fast = rate + spread
+        slow = max(rate - spread, rate * 0.1)
+        return remaining / rate, remaining / fast, remaining / slow
 
 
 class TaskStatisticsManager:
-    def __init__(self, task_queue_manager):
+    def __init__(self, task_queue_manager, clock=None):
         self.task_queue_manager = task_queue_manager
+        self.clock = clock or task_queue_manager.clock
         self.processing_times = []  # Danh sách thời gian xử lý của các task đã hoàn thành
-        self.last_update_time = datetime.now()
+        self.last_update_time = self.clock.now()
+        
+        # Thống kê tải xuống (số byte, số giây) của các lượt tải gần đây
+        self.download_lock = threading.Lock()
+        self.recent_downloads = deque(maxlen=100)
+        self.downloaded_bytes = 0
+        
+        # Ước tính theo tốc độ thực tế, cập nhật dần từ các task vừa kết thúc
+        self.throughput = ThroughputEstimator()
+        self.generation_time = EwmaStat()  # Gửi -> video tạo xong trên server
+        self.download_time = EwmaStat()  # Tải xuống + hậu xử lý
+        self.failure_rate = EwmaStat(alpha=0.05)
+        self.models = {}  # model -> thống kê riêng (tốc độ, thời gian tạo, số task kết thúc)
+        self._seen = {'completed_tasks': 0, 'failed_tasks': 0, 'cancelled_tasks': 0}
+        
+    def record_download(self, size, duration):
+        """Ghi nhận một lượt tải xuống (gọi từ luồng tải)"""
+        with self.download_lock:
+            self.recent_downloads.append((size, duration))
+            self.downloaded_bytes += size
+    
+    def _calculate_download_throughput(self):
+        """Tốc độ tải trung bình của các lượt tải gần đây (byte/giây)"""
+        with self.download_lock:
+            total_bytes = sum(size for size, _ in self.recent_downloads)
+            total_time = sum(duration for _, duration in self.recent_downloads)
+        if total_time <= 0:
+            return None
+        return total_bytes / total_time
+    
+    def _ingest_finished_tasks(self, snapshot):
+        """Đưa các task mới kết thúc vào bộ ước tính (chỉ xử lý phần mới)"""
+        # Danh sách kết quả chỉ được nối thêm nên phần trước vị trí trong snapshot luôn nhất quán
+        ends = {'completed_tasks': snapshot.completed, 'failed_tasks': snapshot.failed,
+                'cancelled_tasks': snapshot.cancelled}
+        events = []
+        for name in self._seen:
+            tasks = getattr(self.task_queue_manager, name)
+            end = ends[name]
+            for task in tasks[self._seen[name]:end]:
+                finished = task.get('completion_time') or task.get('finish_time') or self.clock.now()
+                events.append((finished.timestamp(), name, task))
+            self._seen[name] = end
         
+        events.sort(key=lambda event: event[0])
+        for timestamp, name, task in events:
+            # Task bị hủy không phải là năng lực xử lý, không tính vào thông lượng
+            if name == 'cancelled_tasks':
+                continue
+            model_stats = self._model_stats(task['model'])
+            self.throughput.observe(timestamp)
+            model_stats['throughput'].observe(timestamp)
+            
+            self.failure_rate.update(1.0 if name == 'failed_tasks' else 0.0)
+            if name != 'completed_tasks':
+                model_stats['failed'] += 1
+                continue
+            
+            model_stats['completed'] += 1
+            if 'start_time' in task:
+                self.processing_times.append((task['completion_time'] - task['start_time']).total_seconds())
+                if 'generated_time' in task:
+                    generation = (task['generated_time'] - task['start_time']).total_seconds()
+                    self.generation_time.update(generation)
+                    model_stats['generation_time'].update(generation)
+                    self.download_time.update((task['completion_time'] - task['generated_time']).total_seconds())
+    
+    def _model_stats(self, model):
+        model_stats = self.models.get(model)
+        if model_stats is None:
+            model_stats = self.models[model] = {
+                'throughput': ThroughputEstimator(),
+                'generation_time': EwmaStat(),
+                'completed': 0,
+                'failed': 0
+            }
+        return model_stats
+    
     def update_stats(self):
-        """Cập nhật thống kê dựa trên dữ liệu hiện tại"""
+        """Cập nhật thống kê từ snapshot hiện tại của hàng đợi (không cần lock)"""
+        snapshot = self.task_queue_manager.snapshot
+        self._ingest_finished_tasks(snapshot)
+        estimate = self._estimate_completion_time(snapshot)
+        rate = self.throughput.rate_per_second(self.clock.now().timestamp())
+        
         stats = {
-            'total_tasks': (len(self.task_queue_manager.task_queue.queue) + 
-                          len(self.task_queue_manager.active_tasks) + 
-                          len(self.task_queue_manager.completed_tasks) + 
-                          len(self.task_queue_manager.failed_tasks)),
-            'queued_tasks': len(self.task_queue_manager.task_queue.queue),
-            'active_tasks': len(self.task_queue_manager.active_tasks),
-            'completed_tasks': len(self.task_queue_manager.completed_tasks),
-            'failed_tasks': len(self.task_queue_manager.failed_tasks),
-            'success_rate': self._calculate_success_rate(),
+            'snapshot_version': snapshot.version,
+            'total_tasks': snapshot.total,
+            'queued_tasks': snapshot.queued,
+            'endpoint_paused': snapshot.endpoint_paused,
+            'active_tasks': snapshot.active,
+            'downloading_tasks': snapshot.downloading,
+            'download_throughput': self._calculate_download_throughput(),
+            'downloaded_bytes': self.downloaded_bytes,
+            'download_space_paused': self.task_queue_manager.downloads.space_paused,
+            'completed_tasks': snapshot.completed,
+            'failed_tasks': snapshot.failed,
+            'cancelled_tasks': snapshot.cancelled,
+            'image_groups': (snapshot.groups_done, snapshot.groups_total),
+            'success_rate': self._calculate_success_rate(snapshot),
             'avg_processing_time': self._calculate_avg_processing_time(),
-            'estimated_completion_time': self._estimate_completion_time()
+            'throughput_per_minute': rate * 60 if rate is not None else None,
+            'recent_failure_rate': self.failure_rate.mean,
+            'estimated_completion_time': estimate[0] if estimate else None,
+            'estimated_completion_range': estimate[1:] if estimate else None,
+            'models': self._model_breakdown(snapshot)
         }
         return stats
     
-    def _calculate_success_rate(self):
+    def _model_breakdown(self, snapshot):
+        """Số task, tốc độ và ước tính thời gian còn lại của từng model"""
+        now = self.clock.now().timestamp()
+        breakdown = {}
+        for model, queued, active in snapshot.models:
+            model_stats = self._model_stats(model)
+            rate = model_stats['throughput'].rate_per_second(now)
+            generation = model_stats['generation_time'].mean
+            
+            estimate = None
+            if queued + active == 0:
+                estimate = 0
+            elif rate:
+                estimate = (queued + active) / rate
+            elif generation is not None:
+                # Chưa đủ dữ liệu tốc độ: số lượt chạy còn lại trong pool của model
+                per_task = generation + (self.download_time.mean or 0)
+                estimate = (queued / max(1, self.task_queue_manager._model_capacity(model)) + min(active, 1)) * per_task
+            
+            breakdown[model] = {
+                'queued': queued,
+                'active': active,
+                'completed': model_stats['completed'],
+                'failed': model_stats['failed'],
+                'avg_generation_time': generation,
+                'throughput_per_minute': rate * 60 if rate is not None else None,
+                'estimated_completion_time': estimate
+            }
+        return breakdown
+    
+    def _calculate_success_rate(self, snapshot):
         """Tính tỷ lệ thành công"""
-        total_completed = len(self.task_queue_manager.completed_tasks) + len(self.task_queue_manager.failed_tasks)
+        total_completed = snapshot.completed + snapshot.failed
         if total_completed == 0:
             return 0
-        return (len(self.task_queue_manager.completed_tasks) / total_completed) * 100
+        return (snapshot.completed / total_completed) * 100
     
     def _calculate_avg_processing_time(self):
         """Tính thời gian xử lý trung bình (giây)"""
-        if not self.processing_times:
-            # Tính từ các task đã hoàn thành
-            for task in self.task_queue_manager.completed_tasks:
-                if 'start_time' in task and 'completion_time' in task:
-                    time_diff = (task['completion_time'] - task['start_time']).total_seconds()
-                    self.processing_times.append(time_diff)
-        
         if not self.processing_times:
             return None
             
         return sum(self.processing_times) / len(self.processing_times)
     
-    def _estimate_completion_time(self):
-        """Ước tính thời gian hoàn thành tất cả task (giây)"""
-        avg_time = self._calculate_avg_processing_time()
-        if avg_time is None:
+    def _active_remaining_time(self, now, snapshot):
+        """Thời gian còn lại lâu nhất của các task đang chạy, theo thời gian đo từng giai đoạn"""
+        generation = self.generation_time.mean or 0
+        download = self.download_time.mean or 0
+        longest = 0
+        for start_time in snapshot.active_starts:
+            if start_time is not None:
+                elapsed = (now - start_time).total_seconds()
+                longest = max(longest, max(0, generation - elapsed) + download)
+        if snapshot.downloading:
+            longest = max(longest, download)
+        return longest
+    
+    def _estimate_completion_time(self, snapshot):
+        """Ước tính thời gian hoàn thành tất cả task: (giây, cận dưới, cận trên)"""
+        remaining_tasks = snapshot.queued
+        in_flight = snapshot.active + snapshot.downloading
+        
+        if remaining_tasks == 0 and in_flight == 0:
+            return 0, 0, 0
+        
+        now = self.clock.now()
+        active_time = self._active_remaining_time(now, snapshot)
+        
+        # Ưu tiên tốc độ hoàn thành quan sát được (đã gồm giới hạn tốc độ, lỗi, thời gian tải)
+        estimate = self.throughput.eta(remaining_tasks + in_flight, now.timestamp())
+        if estimate:
+            return tuple(max(value, active_time) for value in estimate)
+        
+        # Chưa đủ dữ liệu: dựa trên thời gian từng giai đoạn và số task chạy đồng thời
+        if self.generation_time.mean is None:
             return None
-            
-        remaining_tasks = len(self.task_queue_manager.task_queue.queue)
-        active_tasks = len(self.task_queue_manager.active_tasks)
+        concurrent_tasks = max(1, self.task_queue_manager._capacity())
+        per_task = self.generation_time.mean + (self.download_time.mean or 0)
+        spread = 1.96 * (self.generation_time.sd + self.download_time.sd)
+        batches = remaining_tasks / concurrent_tasks
+        return (active_time + batches * per_task,
+                active_time + batches * max(per_task - spread, 0),
+                active_time + batches * (per_task + spread))
+
+
+def classify_error(error):
+    """Nhóm thông báo lỗi thành loại lỗi ngắn gọn để thống kê"""
+    if not error:
+        return None
+    text = str(error).lower()
+    if re.search(r"\b(1002|1039|429)\b", text) or "rate limit" in text:
+        return "rate_limit"
+    if re.search(r"\b(1004|1008)\b", text):
+        return "auth_or_balance"
+    if "timed out" in text or "timeout" in text:
+        return "timeout"
+    if "connection" in text:
+        return "connection"
+    if "task thất bại" in text:
+        return "generation_failed"
+    if "tải" in text or "download" in text or "dung lượng" in text:
+        return "download"
+    if "mp4" in text or "box" in text:
+        return "invalid_output"
+    return "other"
+
+
+class RunHistory:
+    """Lịch sử các task đã kết thúc, lưu dạng cột (Parquet khi có pyarrow/fastparquet, ngược lại CSV nén)
+
+    Các dòng được gom trong bộ nhớ và ghi thành từng file part mới, không sửa file cũ.
+    """
+    
+    COLUMNS = [
+        'job_id', 'batch_id', 'group_id', 'task_id', 'model', 'status', 'error_class', 'error',
+        'image', 'image_bytes', 'prompt', 'prompt_chars', 'attempts', 'output_bytes',
+        'added_time', 'start_time', 'generated_time', 'finish_time',
+        'queue_seconds', 'generation_seconds', 'download_seconds', 'total_seconds'
+    ]
+    TIME_COLUMNS = ['added_time', 'start_time', 'generated_time', 'finish_time']
+    CATEGORY_COLUMNS = ['model', 'status', 'error_class']
+    
+    def __init__(self, folder, batch_rows=500, flush_interval=30.0):
+        self.folder = folder
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        self.part = 0
+        self._flush_timer = None
+        self.format = "parquet" if self.parquet_available() else "csv.gz"
+        os.makedirs(folder, exist_ok=True)
+    
+    @staticmethod
+    def parquet_available():
+        for engine in ("pyarrow", "fastparquet"):
+            try:
+                __import__(engine)
+                return True
+            except ImportError:
+                pass
+        return False
+    
+    @staticmethod
+    def _seconds(start, end):
+        if start is None or end is None:
+            return None
+        return (end - start).total_seconds()
+    
+    def record(self, task_info):
+        """Thêm một task đã kết thúc (hoàn thành, thất bại hoặc bị hủy)"""
+        finish = task_info.get('completion_time') or task_info.get('finish_time')
+        start = task_info.get('start_time')
+        generated = task_info.get('generated_time')
+        try:
+            image_bytes = os.path.getsize(task_info['image_path'])
+        except OSError:
+            image_bytes = None
+        
+        row = {
+            'job_id': task_info['job_id'],
+            'batch_id': task_info.get('batch_id'),
+            'group_id': task_info.get('group_id'),
+            'task_id': task_info.get('task_id'),
+            'model': task_info.get('model'),
+            'status': task_info['status'],
+            'error_class': classify_error(task_info.get('error')),
+            'error': task_info.get('error'),
+            'image': os.path.basename(task_info['image_path']),
+            'image_bytes': image_bytes,
+            'prompt': task_info.get('prompt'),
+            'prompt_chars': len(task_info.get('prompt') or ""),
+            'attempts': task_info.get('attempts', 0),
+            'output_bytes': task_info.get('download_bytes'),
+            'added_time': task_info.get('added_time'),
+            'start_time': start,
+            'generated_time': generated,
+            'finish_time': finish,
+            'queue_seconds': self._seconds(task_info.get('added_time'), start),
+            'generation_seconds': self._seconds(start, generated),
+            'download_seconds': task_info.get('download_seconds'),
+            'total_seconds': self._seconds(task_info.get('added_time'), finish)
+        }
+        
+        with self.lock:
+            self.buffer.append(row)
+            full = len(self.buffer) >= self.batch_rows
+            if not full and self._flush_timer is None:
+                # Ghi muộn nhất sau flush_interval giây kể cả khi lô chưa đầy
+                self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if full:
+            self.flush()
+    
+    def flush(self):
+        """Ghi các dòng đang chờ thành một file part mới"""
+        with self.lock:
+            rows, self.buffer = self.buffer, []
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        if not rows:
+            return
+        
+        frame = pd.DataFrame(rows, columns=self.COLUMNS)
+        for column in self.TIME_COLUMNS:
+            frame[column] = pd.to_datetime(frame[column])
         
-        if remaining_tasks == 0 and active_tasks == 0:
-            return 0
-            
-        concurrent_tasks = max(1, self.task_queue_manager.max_concurrent_tasks)
+        with self.write_lock:
+            self.part += 1
+            name = f"part-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{self.part}.{self.format}"
+            path = os.path.join(self.folder, name)
+            temp_path = path + ".tmp"
+            try:
+                if self.format == "parquet":
+                    frame.to_parquet(temp_path, index=False)
+                else:
+                    frame.to_csv(temp_path, index=False, compression="gzip")
+                os.replace(temp_path, path)
+            except Exception as e:
+                data_logger.error("Lỗi khi ghi lịch sử chạy: %s", e)
+    
+    def load(self, columns=None):
+        """Đọc toàn bộ lịch sử thành một DataFrame"""
+        frames = []
+        for name in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, name)
+            if name.endswith(".parquet"):
+                frames.append(pd.read_parquet(path, columns=columns))
+            elif name.endswith(".csv.gz"):
+                frames.append(pd.read_csv(path, usecols=columns, compression="gzip"))
         
-        # Thời gian để hoàn thành các task đang chạy (lấy task lâu nhất)
-        active_time = 0
-        for task_id, task in self.task_queue_manager.active_tasks.items():
-            if 'start_time' in task:
-                elapsed = (datetime.now() - task['start_time']).total_seconds()
-                remaining = max(0, avg_time - elapsed)
-                active_time = max(active_time, remaining)
+        if not frames:
+            return pd.DataFrame(columns=columns or self.COLUMNS)
+        data = pd.concat(frames, ignore_index=True)
+        for column in self.TIME_COLUMNS:
+            if column in data.columns:
+                data[column] = pd.to_datetime(data[column])
+        for column in self.CATEGORY_COLUMNS:
+            if column in data.columns:
+                data[column] = data[column].astype('category')
+        return data
+    
+    def report(self, data=None):
+        """Tổng hợp: thông lượng theo giờ, độ trễ theo model, tỷ lệ lỗi theo loại lỗi ({} nếu chưa có lịch sử)"""
+        if data is None:
+            data = self.load(columns=['model', 'status', 'error_class', 'finish_time',
+                                      'total_seconds', 'generation_seconds', 'download_seconds'])
+        if data.empty:
+            return {}
+        completed = data[data['status'] == 'completed']
+        finished = data[data['status'] != 'cancelled']
         
-        # Thời gian để xử lý các task còn lại trong hàng đợi
-        queue_time = (remaining_tasks / concurrent_tasks) * avg_time
+        # Cột thời gian toàn giá trị trống được đọc ra dạng số, resample cần DatetimeIndex
+        throughput = (completed.set_index(pd.DatetimeIndex(pd.to_datetime(completed['finish_time'])))
+                      .resample('1h')['status'].count()
+                      .rename('completed'))
+        latency = completed.groupby('model', observed=True).agg(
+            tasks=('total_seconds', 'size'),
+            mean_seconds=('total_seconds', 'mean'),
+            p50_seconds=('total_seconds', 'median'),
+            p90_seconds=('total_seconds', lambda values: values.quantile(0.9)),
+            generation_seconds=('generation_seconds', 'mean'),
+            download_seconds=('download_seconds', 'mean')
+        )
+        failures = (finished[finished['status'] == 'failed']
+                    .groupby('error_class', observed=True).size()
+                    .rename('tasks').to_frame())
+        failures['rate'] = failures['tasks'] / max(len(finished), 1)
         
-        return active_time + queue_time
+        return {
+            'throughput_per_hour': throughput,
+            'latency_by_model': latency,
+            'failures_by_error': failures.sort_values('tasks', ascending=False)
+        }
 
 
 class PromptLibrary:
-    def __init__(self):
+    def __init__(self, save_delay=2.0):
         self.app_data_dir = ensure_app_dirs()
         self.library_file = os.path.join(self.app_data_dir, 'prompt_library.json')
+        # Nhật ký ghi thêm (write-ahead log), gộp vào file chính theo lịch
+        self.wal_file = os.path.join(self.app_data_dir, 'prompt_library.wal')
+        self.save_delay = save_delay
         self.categories = []
         self.prompts = {}
+        
+        self.index = {}  # (category, name) -> vị trí trong self.prompts[category]
+        self.token_index = {}  # token -> tập (category, name)
+        self.sorted_tokens = []
+        self._tokens_dirty = False
+        
+        self.lock = threading.RLock()
+        self._save_timer = None
+        self._dirty = False
         self.load_library()
     
     def load_library(self):
         """Tải thư viện prompt từ file"""
+        created = False
         if os.path.exists(self.library_file):
             try:
                 with open(self.library_file, 'r', encoding='utf-8') as f:
@@ -494,13 +3805,21 @@ class PromptLibrary:
                     self.categories = data.get('categories', [])
                     self.prompts = data.get('prompts', {})
             except Exception as e:
-                logging.error(f"Lỗi khi tải thư viện prompt: {e}")
+                data_logger.error("Lỗi khi tải thư viện prompt: %s", e)
                 self._create_default_library()
+                created = True
         else:
             self._create_default_library()
+            created = True
+        
+        # Áp dụng nhật ký trước khi ghi file chính, vì lưu file sẽ xóa nhật ký
+        self._rebuild_index()
+        replayed = self._replay_wal()
+        if created or replayed:
+            self.save_library()
     
     def _create_default_library(self):
-        """Tạo thư viện mặc định nếu không tìm thấy file"""
+        """Tạo thư viện mặc định trong bộ nhớ nếu không tìm thấy file (load_library sẽ lưu lại)"""
         self.categories = ["Phong cảnh", "Chân dung", "Sản phẩm", "Động vật", "Chuyển động camera"]
         
         self.prompts = {
@@ -518,49 +3837,181 @@ class PromptLibrary:
                 {"name": "Truck và Zoom", "prompt": "[Truck right, Zoom in] Di chuyển sang phải đồng thời zoom vào chủ thể."}
             ]
         }
+    
+    def _replay_wal(self):
+        """Áp dụng các thay đổi chưa được gộp vào file chính, trả về số dòng đã áp dụng"""
+        if not os.path.exists(self.wal_file):
+            return 0
         
-        self.save_library()
+        replayed = 0
+        with open(self.wal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Dòng cuối có thể bị cắt nếu ứng dụng dừng đột ngột
+                    continue
+                self._put(entry['category'], entry['name'], entry['prompt'])
+                replayed += 1
+        return replayed
+    
+    def _rebuild_index(self):
+        """Dựng lại chỉ mục tên và token"""
+        self.index = {}
+        self.token_index = {}
+        for category, prompts in self.prompts.items():
+            if category not in self.categories:
+                self.categories.append(category)
+            for i, prompt in enumerate(prompts):
+                self.index[(category, prompt["name"])] = i
+                self._index_tokens(category, prompt)
+        self._tokens_dirty = True
+    
+    @staticmethod
+    def _tokenize(text):
+        return set(re.findall(r'\w+', text.lower()))
+    
+    def _index_tokens(self, category, prompt):
+        key = (category, prompt["name"])
+        for token in self._tokenize(prompt["name"] + " " + prompt["prompt"]):
+            self.token_index.setdefault(token, set()).add(key)
+    
+    def _unindex_tokens(self, category, prompt):
+        key = (category, prompt["name"])
+        for token in self._tokenize(prompt["name"] + " " + prompt["prompt"]):
+            keys = self.token_index.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.token_index[token]
+                    self._tokens_dirty = True
     
     def save_library(self):
-        """Lưu thư viện prompt vào file"""
-        data = {
-            'categories': self.categories,
-            'prompts': self.prompts
-        }
-        
-        try:
-            with open(self.library_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logging.error(f"Lỗi khi lưu thư viện prompt: {e}")
+        """Lưu thư viện prompt vào file và xóa nhật ký đã gộp"""
+        with self.lock:
+            if self._save_timer:
+                self._save_timer.cancel()
+                self._save_timer = None
+            
+            data = {
+                'categories': self.categories,
+                'prompts': self.prompts
+            }
+            
+            try:
+                temp_file = self.library_file + ".tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+                os.replace(temp_file, self.library_file)
+                
+                if os.path.exists(self.wal_file):
+                    os.remove(self.wal_file)
+                self._dirty = False
+            except Exception as e:
+                data_logger.error("Lỗi khi lưu thư viện prompt: %s", e)
     
-    def add_prompt(self, category, name, prompt_text):
-        """Thêm prompt mới vào thư viện"""
+    def flush(self):
+        """Gộp ngay các thay đổi đang chờ vào file chính"""
+        with self.lock:
+            if self._dirty:
+                self.save_library()
+    
+    def _schedule_save(self):
+        """Gộp nhật ký vào file chính sau một khoảng trễ (debounce)"""
+        if self._save_timer:
+            self._save_timer.cancel()
+        self._save_timer = threading.Timer(self.save_delay, self.flush)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+    
+    def _put(self, category, name, prompt_text):
+        """Thêm hoặc cập nhật prompt trong bộ nhớ và chỉ mục"""
         if category not in self.categories:
             self.categories.append(category)
-            self.prompts[category] = []
+        prompts = self.prompts.setdefault(category, [])
         
-        # Kiểm tra xem prompt đã tồn tại chưa
-        for i, prompt in enumerate(self.prompts[category]):
-            if prompt["name"] == name:
-                # Cập nhật prompt hiện có
-                self.prompts[category][i] = {"name": name, "prompt": prompt_text}
-                self.save_library()
-                return
+        new_prompt = {"name": name, "prompt": prompt_text}
+        position = self.index.get((category, name))
+        if position is not None:
+            # Cập nhật prompt hiện có
+            self._unindex_tokens(category, prompts[position])
+            prompts[position] = new_prompt
+        else:
+            self.index[(category, name)] = len(prompts)
+            prompts.append(new_prompt)
         
-        # Thêm prompt mới
-        self.prompts[category].append({"name": name, "prompt": prompt_text})
-        self.save_library()
+        self._index_tokens(category, new_prompt)
+        self._tokens_dirty = True
+    
+    def add_prompt(self, category, name, prompt_text):
+        """Thêm prompt mới vào thư viện"""
+        with self.lock:
+            self._put(category, name, prompt_text)
+            
+            # Chỉ ghi thêm một dòng vào nhật ký thay vì ghi lại toàn bộ file
+            try:
+                with open(self.wal_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({"category": category, "name": name, "prompt": prompt_text}, ensure_ascii=False) + "\n")
+            except Exception as e:
+                data_logger.error("Lỗi khi ghi nhật ký thư viện prompt: %s", e)
+            
+            self._dirty = True
+            self._schedule_save()
+    
+    def get_prompt(self, category, name):
+        """Lấy prompt theo danh mục và tên"""
+        position = self.index.get((category, name))
+        if position is None:
+            return None
+        return self.prompts[category][position]
     
     def get_prompts_by_category(self, category):
         """Lấy danh sách prompt theo category"""
         if category in self.prompts:
             return self.prompts[category]
         return []
+    
+    def search(self, query, limit=200):
+        """Tìm prompt theo từ khóa, trả về danh sách (category, prompt)
+
+        Mỗi từ trong truy vấn khớp với tiền tố của một từ trong tên hoặc nội
+        dung; nếu không có kết quả thì tìm chuỗi con.
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+        
+        with self.lock:
+            if self._tokens_dirty:
+                self.sorted_tokens = sorted(self.token_index)
+                self._tokens_dirty = False
+            
+            matches = None
+            for term in self._tokenize(query):
+                keys = set()
+                # Duyệt theo chỉ số từ vị trí bisect, không cắt bản sao phần đuôi danh sách
+                index = bisect.bisect_left(self.sorted_tokens, term)
+                while index < len(self.sorted_tokens) and self.sorted_tokens[index].startswith(term):
+                    keys |= self.token_index.get(self.sorted_tokens[index], set())
+                    index += 1
+                matches = keys if matches is None else matches & keys
+                if not matches:
+                    break
+            
+            if matches:
+                results = [(category, self.get_prompt(category, name)) for category, name in matches]
+            else:
+                results = [(category, prompt)
+                           for category, prompts in self.prompts.items()
+                           for prompt in prompts
+                           if query in prompt["name"].lower() or query in prompt["prompt"].lower()]
+        
+        results.sort(key=lambda item: (item[0], item[1]["name"]))
+        return results[:limit]
 
 
 class PromptEditorWindow:
-    def __init__(self, parent, prompt_library, initial_prompt="", callback=None):
+    def __init__(self, parent, prompt_library, initial_prompt="", callback=None, placeholders=()):
         self.top = tk.Toplevel(parent)
         self.top.title("Soạn thảo Prompt nâng cao")
         self.top.geometry("800x600")
@@ -569,16 +4020,9 @@ class PromptEditorWindow:
         self.prompt_library = prompt_library
         self.initial_prompt = initial_prompt
         self.callback = callback
+        self.placeholders = list(placeholders)
         
-        self.camera_moves = [
-            "Truck left", "Truck right",
-            "Pan left", "Pan right",
-            "Push in", "Pull out",
-            "Pedestal up", "Pedestal down",
-            "Tilt up", "Tilt down",
-            "Zoom in", "Zoom out",
-            "Shake", "Tracking shot", "Static shot"
-        ]
+        self.camera_moves = list(CAMERA_MOVES)
         
         self.create_widgets()
     
@@ -608,6 +4052,16 @@ class PromptEditorWindow:
                 col = 0
                 row += 1
         
+        # Chèn biến lấy từ cột Excel, ví dụ {subject} hoặc [{camera_move}]
+        if self.placeholders:
+            placeholder_frame = ttk.Frame(camera_frame)
+            placeholder_frame.pack(fill="x", padx=5, pady=(0, 5))
+            ttk.Label(placeholder_frame, text="Biến từ Excel:").pack(side="left")
+            self.placeholder_var = tk.StringVar(value=self.placeholders[0])
+            ttk.Combobox(placeholder_frame, textvariable=self.placeholder_var, values=self.placeholders,
+                         width=20, state="readonly").pack(side="left", padx=5)
+            ttk.Button(placeholder_frame, text="Chèn biến", command=self.insert_placeholder).pack(side="left")
+        
         # Thư viện Prompt
         library_frame = ttk.LabelFrame(main_frame, text="Thư viện Prompt")
         library_frame.pack(fill="both", expand=True, pady=(0, 10))
@@ -628,6 +4082,16 @@ class PromptEditorWindow:
         right_panel = ttk.Frame(library_frame)
         right_panel.pack(side="right", fill="both", expand=True)
         
+        # Ô tìm kiếm toàn bộ thư viện
+        search_frame = ttk.Frame(right_panel)
+        search_frame.pack(fill="x", pady=(0, 5))
+        ttk.Label(search_frame, text="Tìm kiếm:").pack(side="left")
+        self.search_var = tk.StringVar()
+        self.search_var.trace_add("write", self.on_search_changed)
+        ttk.Entry(search_frame, textvariable=self.search_var).pack(side="left", fill="x", expand=True, padx=5)
+        self._search_job = None
+        self.listed_prompts = []  # (category, name) của từng dòng trong prompt_listbox
+        
         ttk.Label(right_panel, text="Prompt:").pack(anchor="w")
         self.prompt_listbox = tk.Listbox(right_panel, height=10)
         self.prompt_listbox.pack(fill="both", expand=True)
@@ -670,6 +4134,11 @@ class PromptEditorWindow:
         self.prompt_editor.insert(tk.INSERT, f"[{move}] ")
         self.prompt_editor.focus_set()
     
+    def insert_placeholder(self):
+        """Chèn biến {ten_cot} vào mẫu prompt"""
+        self.prompt_editor.insert(tk.INSERT, "{" + self.placeholder_var.get() + "}")
+        self.prompt_editor.focus_set()
+    
     def on_category_select(self, event):
         """Xử lý khi chọn danh mục"""
         self.prompt_listbox.delete(0, tk.END)
@@ -682,31 +4151,43 @@ class PromptEditorWindow:
         category = self.category_listbox.get(index)
         
         prompts = self.prompt_library.get_prompts_by_category(category)
+        self.listed_prompts = [(category, prompt["name"]) for prompt in prompts]
         for prompt in prompts:
             self.prompt_listbox.insert(tk.END, prompt["name"])
     
+    def on_search_changed(self, *args):
+        """Tìm kiếm sau khi người dùng ngừng gõ một chút"""
+        if self._search_job:
+            self.top.after_cancel(self._search_job)
+        self._search_job = self.top.after(200, self.run_search)
+    
+    def run_search(self):
+        """Hiển thị kết quả tìm kiếm trong danh sách prompt"""
+        self._search_job = None
+        query = self.search_var.get()
+        if not query.strip():
+            self.on_category_select(None)
+            return
+        
+        results = self.prompt_library.search(query)
+        self.prompt_listbox.delete(0, tk.END)
+        self.listed_prompts = [(category, prompt["name"]) for category, prompt in results]
+        for category, prompt in results:
+            self.prompt_listbox.insert(tk.END, f"{prompt['name']} ({category})")
+    
     def on_prompt_select(self, event):
         """Xử lý khi chọn prompt từ thư viện"""
-        category_selection = self.category_listbox.curselection()
         prompt_selection = self.prompt_listbox.curselection()
-        
-        if not category_selection or not prompt_selection:
+        if not prompt_selection or prompt_selection[0] >= len(self.listed_prompts):
             return
-            
-        category_index = category_selection[0]
-        prompt_index = prompt_selection[0]
-        
-        category = self.category_listbox.get(category_index)
-        prompt_name = self.prompt_listbox.get(prompt_index)
         
-        prompts = self.prompt_library.get_prompts_by_category(category)
-        for prompt in prompts:
-            if prompt["name"] == prompt_name:
-                # Hiển thị prompt trong editor
-                self.prompt_editor.delete("1.0", tk.END)
-                self.prompt_editor.insert("1.0", prompt["prompt"])
-                self.prompt_name_var.set(prompt_name)
-                break
+        category, prompt_name = self.listed_prompts[prompt_selection[0]]
+        prompt = self.prompt_library.get_prompt(category, prompt_name)
+        if prompt:
+            # Hiển thị prompt trong editor
+            self.prompt_editor.delete("1.0", tk.END)
+            self.prompt_editor.insert("1.0", prompt["prompt"])
+            self.prompt_name_var.set(prompt_name)
     
     def save_to_library(self):
         """Lưu prompt hiện tại vào thư viện"""
@@ -758,36 +4239,544 @@ class PromptEditorWindow:
         self.top.destroy()
 
 
+def load_service_token(token_file):
+    """Đọc token của dịch vụ nhận task, tạo mới (chỉ chủ sở hữu đọc được) nếu chưa có"""
+    try:
+        with open(token_file, 'r') as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except FileNotFoundError:
+        pass
+    token = secrets.token_urlsafe(32)
+    fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+
+class JobService:
+    """Dịch vụ HTTP/JSON cục bộ (asyncio) để công cụ khác gửi và theo dõi task qua TaskQueueManager
+
+    Các truy vấn trạng thái đọc từ bản sao riêng của dịch vụ, được cập nhật định kỳ bằng cách
+    so trạng thái từng job, nên không tranh lock với vòng lặp xử lý hàng đợi.
+    Mọi request phải gửi header X-Auth-Token (token lưu trong file service_token của thư mục
+    dữ liệu) và Host trỏ về máy cục bộ, để trang web lạ không gửi task qua trình duyệt.
+    """
+    
+    REFRESH_INTERVAL = 0.25
+    KEEPALIVE_INTERVAL = 15
+    MAX_BODY = 16 * 1024 * 1024
+    MAX_HEADERS = 100
+    MAX_HEADER_BYTES = 64 * 1024
+    FINISHED = ('completed', 'failed', 'cancelled')
+    REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+               404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+               415: "Unsupported Media Type", 431: "Request Header Fields Too Large",
+               500: "Internal Server Error"}
+    TOKEN_HEADER = 'x-auth-token'
+    LOCAL_HOSTS = ('127.0.0.1', 'localhost', '[::1]')
+    
+    def __init__(self, task_queue, host="127.0.0.1", port=8765, output_folder=None, model="I2V-01-Director",
+                 input_folder=None, token_file=None):
+        self.task_queue = task_queue
+        self.host = host
+        self.port = port
+        self.output_folder = output_folder or os.path.join(os.path.expanduser("~"), "MiniMaxVideos")
+        self.input_folder = input_folder or os.path.expanduser("~")
+        self.model = model
+        self.token_file = token_file or os.path.join(ensure_app_dirs(), "service_token")
+        self.token = load_service_token(self.token_file)
+        
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.started = threading.Event()
+        
+        # Bản sao trạng thái chỉ được sửa trên luồng event loop
+        self.version = None  # phiên bản snapshot hàng đợi ở lần làm mới trước
+        self.statuses = {}  # job_id -> trạng thái lần làm mới trước
+        self.seen_jobs = 0  # số job đầu tiên của task_queue.jobs đã được theo dõi
+        self.unfinished = {}  # job_id -> task_info của các job chưa kết thúc
+        self.batches = {}  # batch_id -> {'counts': {...}, 'jobs': [job_id]}
+        self.subscribers = set()  # (asyncio.Queue, batch_id hoặc None)
+    
+    def start(self):
+        """Chạy dịch vụ trong luồng riêng, trả về khi đã mở cổng"""
+        self.thread = threading.Thread(target=self._run, daemon=True, name="job-service")
+        self.thread.start()
+        self.started.wait(5)
+    
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+    
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+        except OSError as e:
+            app_logger.error("Không mở được dịch vụ tại %s:%s: %s", self.host, self.port, e)
+            self.started.set()
+            return
+        
+        app_logger.info("Dịch vụ nhận task đang chạy tại http://%s:%d (token trong %s)",
+                        self.host, self.port, self.token_file)
+        self.loop.create_task(self._refresh_loop())
+        self.started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            # Hủy các kết nối còn mở (ví dụ luồng SSE) trước khi đóng event loop
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+    
+    # ---- Bản sao trạng thái và sự kiện
+    
+    async def _refresh_loop(self):
+        while True:
+            try:
+                self._refresh()
+            except Exception as e:
+                app_logger.error("Lỗi khi cập nhật trạng thái dịch vụ: %s", e)
+            await asyncio.sleep(self.REFRESH_INTERVAL)
+    
+    def _refresh(self):
+        """So trạng thái các job với lần trước, cập nhật số đếm theo lô và phát sự kiện"""
+        snapshot = self.task_queue.snapshot
+        if snapshot.version == self.version:
+            return
+        self.version = snapshot.version
+        
+        # Job không bao giờ bị xóa khỏi task_queue.jobs nên job mới luôn nằm cuối dict
+        if snapshot.total > self.seen_jobs:
+            with self.task_queue.lock:
+                new_jobs = list(itertools.islice(self.task_queue.jobs.values(), self.seen_jobs, None))
+            self.seen_jobs += len(new_jobs)
+            for task_info in new_jobs:
+                self.unfinished[task_info['job_id']] = task_info
+        
+        # Chỉ so lại các job chưa kết thúc, job đã kết thúc không đổi trạng thái nữa
+        for job_id, task_info in list(self.unfinished.items()):
+            if self._track(task_info) in self.FINISHED:
+                del self.unfinished[job_id]
+    
+    def _track(self, task_info):
+        """Cập nhật số đếm theo lô nếu job đổi trạng thái và phát sự kiện, trả về trạng thái đã ghi nhận"""
+        status = task_info['status']
+        job_id = task_info['job_id']
+        previous = self.statuses.get(job_id)
+        if previous == status:
+            return status
+        
+        self.statuses[job_id] = status
+        batch = self.batches.get(task_info.get('batch_id'))
+        if batch is None:
+            batch = self.batches[task_info.get('batch_id')] = {'counts': {}, 'jobs': []}
+        counts = batch['counts']
+        if previous is None:
+            batch['jobs'].append(job_id)
+        else:
+            counts[previous] -= 1
+        counts[status] = counts.get(status, 0) + 1
+        self._publish(self._job_view(task_info))
+        return status
+    
+    def _publish(self, event):
+        for queue_, batch_id in list(self.subscribers):
+            if batch_id is not None and event['batch_id'] != batch_id:
+                continue
+            try:
+                queue_.put_nowait(event)
+            except asyncio.QueueFull:
+                # Client đọc chậm bỏ lỡ sự kiện, có thể lấy lại trạng thái qua /batches/<id>
+                pass
+    
+    @staticmethod
+    def _job_view(task_info):
+        view = {name: task_info.get(name) for name in
+                ('job_id', 'batch_id', 'group_id', 'status', 'task_id', 'image_path', 'prompt',
+                 'output_filename', 'error', 'attempts')}
+        view['image_path'] = os.path.basename(view['image_path'] or "")
+        return view
+    
+    # ---- HTTP
+    
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                    if not request_line:
+                        break
+                    method, target, _ = request_line.decode('latin-1').split(" ", 2)
+                except (ValueError, asyncio.LimitOverrunError):
+                    # Dòng request sai định dạng hoặc dài quá giới hạn đệm của StreamReader
+                    self._write_json(writer, 400, {'error': "Request không hợp lệ"}, keep_alive=False)
+                    break
+                
+                headers = await self._read_headers(reader)
+                if headers is None:
+                    self._write_json(writer, 431, {'error': "Header quá lớn hoặc quá nhiều"}, keep_alive=False)
+                    break
+                
+                try:
+                    length = int(headers.get('content-length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self._write_json(writer, 400, {'error': "Content-Length không hợp lệ"}, keep_alive=False)
+                    break
+                if length > self.MAX_BODY:
+                    self._write_json(writer, 413, {'error': "Body quá lớn"}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                
+                rejected = self._check_request(method, headers, body)
+                if rejected:
+                    self._write_json(writer, *rejected, keep_alive=False)
+                    break
+                
+                path, _, query = target.partition("?")
+                params = dict(urllib.parse.parse_qsl(query))
+                if method == "GET" and path == "/events":
+                    await self._stream_events(writer, params.get('batch_id'))
+                    break
+                
+                status, payload = self._route(method, path.rstrip("/") or "/", params, body)
+                keep_alive = headers.get('connection', "").lower() != "close"
+                self._write_json(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Client ngắt kết nối hoặc dịch vụ đang dừng
+            pass
+        finally:
+            writer.close()
+    
+    async def _read_headers(self, reader):
+        """Đọc header của request, trả về None nếu vượt MAX_HEADERS dòng hoặc MAX_HEADER_BYTES byte"""
+        headers = {}
+        count = 0
+        size = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except (ValueError, asyncio.LimitOverrunError):
+                # Một dòng dài quá giới hạn đệm của StreamReader
+                return None
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            count += 1
+            size += len(line)
+            if count > self.MAX_HEADERS or size > self.MAX_HEADER_BYTES:
+                return None
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+    
+    def _check_request(self, method, headers, body):
+        """Trả về (mã HTTP, lỗi) nếu request không được phép, None nếu hợp lệ"""
+        if not self._host_allowed(headers.get('host', "")):
+            return 403, {'error': "Host không hợp lệ"}
+        if not hmac.compare_digest(headers.get(self.TOKEN_HEADER, "").encode(), self.token.encode()):
+            return 401, {'error': f"Thiếu hoặc sai token (xem {self.token_file})"}
+        if method == "POST" and body:
+            content_type = headers.get('content-type', "").split(";")[0].strip().lower()
+            if content_type != "application/json":
+                return 415, {'error': "Content-Type phải là application/json"}
+        return None
+    
+    def _host_allowed(self, host):
+        """Chỉ nhận Host trỏ về máy cục bộ đúng cổng dịch vụ (chống DNS rebinding)"""
+        host = host.lower()
+        if host.startswith("["):
+            name, _, port = host.partition("]")
+            name, port = name + "]", port[1:]
+        else:
+            name, _, port = host.partition(":")
+        return name in self.LOCAL_HOSTS and port in ("", str(self.port))
+    
+    @staticmethod
+    def _inside(path, folder):
+        path = os.path.realpath(path)
+        folder = os.path.realpath(folder)
+        try:
+            return os.path.commonpath([path, folder]) == folder
+        except ValueError:
+            # Khác ổ đĩa trên Windows
+            return False
+    
+    def _write_json(self, writer, status, payload, keep_alive=True):
+        data = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+        writer.write((
+            f"HTTP/1.1 {status} {self.REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        ).encode('latin-1') + data)
+    
+    async def _stream_events(self, writer, batch_id):
+        """Server-sent events: một sự kiện 'task' cho mỗi lần job đổi trạng thái"""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n")
+        subscriber = (asyncio.Queue(maxsize=1000), batch_id)
+        self.subscribers.add(subscriber)
+        try:
+            await writer.drain()
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber[0].get(), self.KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                else:
+                    data = json.dumps(event, ensure_ascii=False, default=str)
+                    writer.write(f"event: task\ndata: {data}\n\n".encode('utf-8'))
+                await writer.drain()
+        finally:
+            self.subscribers.discard(subscriber)
+    
+    def _route(self, method, path, params, body):
+        """Định tuyến request, trả về (mã HTTP, dữ liệu JSON)"""
+        parts = path.strip("/").split("/")
+        try:
+            if path == "/health":
+                snapshot = self.task_queue.snapshot
+                return 200, {'status': "degraded" if snapshot.endpoint_paused else "ok",
+                             'version': snapshot.version, 'queued': snapshot.queued,
+                             'in_flight': snapshot.active + snapshot.downloading,
+                             'endpoints': self.task_queue.api_client.breaker_states()}
+            if path == "/tasks":
+                if method != "POST":
+                    return 405, {'error': "Chỉ hỗ trợ POST"}
+                return self._create_tasks(body)
+            if parts[0] == "batches" and len(parts) == 2 and method == "GET":
+                batch = self.batches.get(parts[1])
+                if batch is None:
+                    return 404, {'error': f"Không có lô {parts[1]}"}
+                return 200, self._batch_view(parts[1], batch, params.get('tasks') != "0")
+            if parts[0] == "batches" and len(parts) == 3 and parts[2] == "cancel" and method == "POST":
+                return 200, {'cancelled': self.task_queue.cancel_batch(parts[1])}
+            if parts[0] == "tasks" and len(parts) == 3 and parts[2] == "cancel" and method == "POST":
+                return 200, {'cancelled': self.task_queue.cancel_task(parts[1])}
+            if path == "/results" and method == "GET":
+                return 200, {'results': self._results(params.get('batch_id'))}
+            return 404, {'error': f"Không có endpoint {method} {path}"}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            app_logger.error("Lỗi khi xử lý %s %s: %s", method, path, e)
+            return 500, {'error': str(e)}
+    
+    def _create_tasks(self, body):
+        """POST /tasks: {"tasks": [{"image_path", "prompt", "output_filename"?, "model"?}], "batch_id"?, ...}"""
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise ValueError("Body không phải JSON hợp lệ")
+        items = data.get('tasks') if isinstance(data, dict) and 'tasks' in data else [data]
+        if not items or not all(isinstance(item, dict) for item in items):
+            raise ValueError("Cần danh sách task dạng object")
+        
+        batch_id = str(data.get('batch_id') or uuid.uuid4().hex[:8])
+        for name in ('output_folder', 'model'):
+            if not isinstance(data.get(name) or "", str):
+                raise ValueError(f"{name} phải là chuỗi")
+        output_folder = os.path.join(self.output_folder, data.get('output_folder') or "")
+        if not self._inside(output_folder, self.output_folder):
+            raise ValueError(f"Thư mục lưu phải nằm trong {self.output_folder}")
+        model = data.get('model') or self.model
+        
+        # Kiểm tra toàn bộ trước khi thêm task nào; gom biến thể cùng ảnh để dùng chung ảnh đã mã hóa
+        groups = {}
+        for position, item in enumerate(items, start=1):
+            for name in ('image_path', 'prompt', 'model', 'output_filename'):
+                if not isinstance(item.get(name) or "", str):
+                    raise ValueError(f"Task {position}: {name} phải là chuỗi")
+            image_path = item.get('image_path')
+            prompt = item.get('prompt')
+            if not image_path or not os.path.isfile(image_path):
+                raise ValueError(f"Task {position}: không tìm thấy ảnh {image_path}")
+            if not self._inside(image_path, self.input_folder):
+                raise ValueError(f"Task {position}: ảnh phải nằm trong {self.input_folder}")
+            if not prompt or not prompt.strip():
+                raise ValueError(f"Task {position}: thiếu prompt")
+            stem = os.path.splitext(os.path.basename(image_path))[0]
+            output_filename = os.path.join(output_folder,
+                                           item.get('output_filename') or f"{stem}_{batch_id}_{position}.mp4")
+            if not self._inside(output_filename, output_folder):
+                raise ValueError(f"Task {position}: file kết quả phải nằm trong {output_folder}")
+            groups.setdefault((image_path, item.get('model') or model), []).append((prompt, output_filename))
+        
+        job_ids = []
+        for (image_path, task_model), variants in groups.items():
+            if len(variants) == 1:
+                prompt, output_filename = variants[0]
+                job_ids.append(self.task_queue.add_task(image_path, prompt, output_filename,
+                                                        model=task_model, batch_id=batch_id))
+            else:
+                group_id = self.task_queue.add_task_group(image_path, variants, model=task_model, batch_id=batch_id)
+                job_ids.extend(self.task_queue.groups[group_id]['job_ids'])
+        
+        # Ghi nhận lô ngay để GET /batches/<id> ngay sau khi trả 202 không bị 404
+        self.batches.setdefault(batch_id, {'counts': {}, 'jobs': []})
+        for job_id in job_ids:
+            self._track(self.task_queue.jobs[job_id])
+        return 202, {'batch_id': batch_id, 'job_ids': job_ids}
+    
+    def _batch_view(self, batch_id, batch, include_tasks):
+        counts = {status: count for status, count in batch['counts'].items() if count}
+        view = {
+            'batch_id': batch_id,
+            'total': len(batch['jobs']),
+            'counts': counts,
+            'finished': sum(counts.get(status, 0) for status in ('completed', 'failed', 'cancelled'))
+        }
+        if include_tasks:
+            jobs = self.task_queue.jobs
+            view['tasks'] = [self._job_view(jobs[job_id]) for job_id in batch['jobs'] if job_id in jobs]
+        return view
+    
+    def _results(self, batch_id=None):
+        results = []
+        completed = self.task_queue.completed_tasks[:self.task_queue.snapshot.completed]
+        for task_info in completed:
+            if batch_id is not None and task_info.get('batch_id') != batch_id:
+                continue
+            results.append({
+                'job_id': task_info['job_id'],
+                'batch_id': task_info.get('batch_id'),
+                'output_filename': task_info['output_filename'],
+                'size': task_info.get('download_bytes'),
+                'sha256': task_info.get('sha256'),
+                'completed': task_info['completion_time'].isoformat(timespec='seconds')
+            })
+        return results
+
+
+def run_service(port, profiler=None):
+    """Chạy hàng đợi và dịch vụ nhận task không cần giao diện, dừng bằng Ctrl+C"""
+    config = ConfigManager()
+    api_client = MiniMaxAPI(config.api_key, max_tasks_per_key=config.max_concurrent_tasks,
+                            upload_gzip=config.upload_gzip)
+    download_manager = DownloadManager(
+        max_workers=config.download_workers,
+        disk_write_mbps=config.disk_write_mbps,
+        post_processing=[step.strip() for step in config.post_processing.split(",") if step.strip()],
+        bandwidth_kbps=config.download_bandwidth_kbps,
+        min_free_space_mb=config.min_free_space_mb
+    )
+    task_queue = TaskQueueManager(api_client, max_concurrent_tasks=config.max_concurrent_tasks,
+                                  poll_interval=config.poll_interval, download_manager=download_manager,
+                                  max_retries=config.max_retries, retry_delay=config.retry_delay,
+                                  model_limits=config.model_concurrency)
+    task_queue.history = RunHistory(os.path.join(config.app_data_dir, "history"))
+    config.subscribe(task_queue.apply_config)
+    config.start_watching()
+    if profiler:
+        profiler.diagnostics = task_queue.diagnostics
+    
+    service = JobService(task_queue, port=port, output_folder=config.output_folder, model=config.model,
+                         input_folder=config.service_input_folder)
+    service.start()
+    task_queue.start_processing()
+    try:
+        while service.thread.is_alive():
+            service.thread.join(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        config.stop_watching()
+        task_queue.stop_processing()
+        download_manager.shutdown()
+        task_queue.history.flush()
+
+
 class MiniMaxVideoGeneratorApp:
-    def __init__(self, root):
+    MAX_LOG_LINES = 5000
+    
+    def __init__(self, root, trace_path=None, profiler=None):
         self.root = root
+        self.log_queue = queue.SimpleQueue()
         self.root.title("MiniMax Video Generator")
         self.root.geometry("900x700")
         
         # Khởi tạo các thành phần
         self.config = ConfigManager()
-        self.api_client = MiniMaxAPI(self.config.api_key)
+        self.api_client = MiniMaxAPI(self.config.api_key, max_tasks_per_key=self.config.max_concurrent_tasks,
+                                     upload_gzip=self.config.upload_gzip)
+        if trace_path:
+            self.api_client.recorder = TraceRecorder(trace_path)
         self.excel_processor = ExcelProcessor()
+        self.download_manager = DownloadManager(
+            max_workers=self.config.download_workers,
+            disk_write_mbps=self.config.disk_write_mbps,
+            post_processing=[step.strip() for step in self.config.post_processing.split(",") if step.strip()],
+            bandwidth_kbps=self.config.download_bandwidth_kbps,
+            min_free_space_mb=self.config.min_free_space_mb
+        )
+        self.download_manager.on_space_low = self.on_space_low
         self.task_queue = TaskQueueManager(
             self.api_client, 
-            max_concurrent_tasks=self.config.max_concurrent_tasks
+            max_concurrent_tasks=self.config.max_concurrent_tasks,
+            poll_interval=self.config.poll_interval,
+            download_manager=self.download_manager,
+            max_retries=self.config.max_retries,
+            retry_delay=self.config.retry_delay,
+            model_limits=self.config.model_concurrency
         )
         
+        # Nhận cấu hình mới khi lưu từ giao diện hoặc khi file config.ini bị sửa
+        self.shown_config = self.config.snapshot  # cấu hình đang hiển thị, để nhận ra ô người dùng đã sửa
+        self.config.subscribe(self.on_config_changed)
+        self.config.start_watching()
+        
         # Thiết lập callbacks
         self.task_queue.on_task_completed = self.on_task_completed
         self.task_queue.on_task_failed = self.on_task_failed
         self.task_queue.on_task_started = self.on_task_started
+        self.task_queue.on_task_cancelled = self.on_task_cancelled
         self.task_queue.on_queue_updated = self.update_queue_stats
+        self.task_queue.on_drained = self.on_queue_drained
+        self.task_queue.on_group_completed = self.on_group_completed
+        self.task_queue.on_endpoint_paused = self.on_endpoint_paused
+        self.task_queue.history = RunHistory(os.path.join(self.config.app_data_dir, "history"))
         
         # Biến theo dõi
         self.images_list = []
         self.default_prompt = tk.StringVar(value="")
+        self.last_batch_id = None
+        self.folder_watcher = None
+        self.profiler = profiler or SamplingProfiler(os.path.join(self.config.app_data_dir, "profiles"))
+        self.profiler.diagnostics = self.task_queue.diagnostics
         
         # Tạo giao diện
         self.create_widgets()
+        self.drain_log_queue()
         
         # Bắt đầu xử lý hàng đợi
         self.task_queue.start_processing()
+        
+        # Dịch vụ HTTP cục bộ dùng chung hàng đợi với giao diện
+        self.job_service = None
+        if self.config.service_port:
+            self.job_service = JobService(self.task_queue, port=self.config.service_port,
+                                          output_folder=self.config.output_folder, model=self.config.model,
+                                          input_folder=self.config.service_input_folder)
+            self.job_service.start()
+            self.log(f"Dịch vụ nhận task: http://127.0.0.1:{self.job_service.port} "
+                     f"(token trong {self.job_service.token_file})")
+        
+        # Dừng luồng xử lý gọn gàng khi đóng cửa sổ
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
     
     def create_widgets(self):
         self.main_frame = ttk.Frame(self.root, padding=10)
@@ -798,6 +4787,7 @@ class MiniMaxVideoGeneratorApp:
         self.input_frame.pack(fill="x", expand=False, padx=10, pady=5)
         
         # API Key
+        # Có thể nhập nhiều key cách nhau bằng dấu phẩy, trọng số viết sau dấu ':'
         ttk.Label(self.input_frame, text="API Key:").grid(row=0, column=0, sticky="w", padx=5, pady=5)
         self.api_key_var = tk.StringVar(value=self.config.api_key)
         ttk.Entry(self.input_frame, textvariable=self.api_key_var, width=40, show="*").grid(row=0, column=1, columnspan=2, sticky="ew", padx=5, pady=5)
@@ -825,6 +4815,10 @@ class MiniMaxVideoGeneratorApp:
         self.videos_per_image = tk.IntVar(value=self.config.max_videos_per_image)
         ttk.Spinbox(self.input_frame, from_=1, to=5, textvariable=self.videos_per_image, width=5).grid(row=4, column=1, sticky="w", padx=5, pady=5)
         
+        # Bỏ qua video đã có trong manifest khi chạy lại
+        self.skip_existing_var = tk.BooleanVar(value=self.config.skip_existing)
+        ttk.Checkbutton(self.input_frame, text="Bỏ qua video đã tạo", variable=self.skip_existing_var).grid(row=4, column=2, sticky="w", padx=5, pady=5)
+        
         # Mô hình
         ttk.Label(self.input_frame, text="Mô hình:").grid(row=5, column=0, sticky="w", padx=5, pady=5)
         self.model_var = tk.StringVar(value=self.config.model)
@@ -848,6 +4842,28 @@ class MiniMaxVideoGeneratorApp:
         # Nút bắt đầu xử lý
         ttk.Button(self.input_frame, text="Bắt đầu tạo video", command=self.start_video_generation).grid(row=6, column=1, columnspan=2, sticky="e", padx=5, pady=5)
         
+        # Các nút điều khiển hàng đợi
+        controls_frame = ttk.Frame(self.input_frame)
+        controls_frame.grid(row=7, column=0, columnspan=3, sticky="ew", padx=5, pady=5)
+        
+        self.pause_button = ttk.Button(controls_frame, text="Tạm dừng", command=self.toggle_pause)
+        self.pause_button.pack(side="left", padx=(0, 5))
+        ttk.Button(controls_frame, text="Hoàn tất rồi dừng", command=self.drain_queue).pack(side="left", padx=5)
+        ttk.Button(controls_frame, text="Hủy lô vừa thêm", command=self.cancel_last_batch).pack(side="left", padx=5)
+        ttk.Button(controls_frame, text="Hủy tất cả", command=self.cancel_all_tasks).pack(side="left", padx=5)
+        self.watch_button = ttk.Button(controls_frame, text="Theo dõi thư mục", command=self.toggle_watch)
+        self.watch_button.pack(side="left", padx=5)
+        self.profile_button = ttk.Button(controls_frame, text="Profiling", command=self.toggle_profiling)
+        self.profile_button.pack(side="left", padx=5)
+        ttk.Button(controls_frame, text="Kiểm tra video đã tạo", command=self.verify_outputs).pack(side="right", padx=5)
+        
+        # Cách ghép các giá trị "a|b" trong cột biến của mẫu prompt
+        ttk.Label(self.input_frame, text="Biến thể:").grid(row=8, column=0, sticky="w", padx=5, pady=5)
+        self.variant_mode_var = tk.StringVar(value="Tổ hợp")
+        variant_combo = ttk.Combobox(self.input_frame, textvariable=self.variant_mode_var, width=20, state="readonly")
+        variant_combo['values'] = ("Tổ hợp", "Ghép cặp")
+        variant_combo.grid(row=8, column=1, sticky="w", padx=5, pady=5)
+        
         # Thêm panel thống kê
         self.create_statistics_panel()
         
@@ -886,7 +4902,10 @@ class MiniMaxVideoGeneratorApp:
             'failed_tasks': tk.StringVar(value="Thất bại: 0"),
             'success_rate': tk.StringVar(value="Tỷ lệ thành công: 0%"),
             'avg_processing_time': tk.StringVar(value="Thời gian trung bình: --"),
-            'estimated_completion_time': tk.StringVar(value="Ước tính hoàn thành: --")
+            'estimated_completion_time': tk.StringVar(value="Ước tính hoàn thành: --"),
+            'download_throughput': tk.StringVar(value="Tốc độ tải: --"),
+            'image_groups': tk.StringVar(value="Ảnh đã xong đủ biến thể: 0/0"),
+            'models': tk.StringVar(value="")
         }
         
         # Tạo giao diện hiển thị thống kê
@@ -906,6 +4925,9 @@ class MiniMaxVideoGeneratorApp:
         # Cột 3
         ttk.Label(stats_grid, textvariable=self.stats_vars['avg_processing_time']).grid(row=0, column=2, sticky="w", padx=5, pady=2)
         ttk.Label(stats_grid, textvariable=self.stats_vars['estimated_completion_time']).grid(row=1, column=2, sticky="w", padx=5, pady=2)
+        ttk.Label(stats_grid, textvariable=self.stats_vars['download_throughput']).grid(row=2, column=2, sticky="w", padx=5, pady=2)
+        ttk.Label(stats_grid, textvariable=self.stats_vars['image_groups']).grid(row=3, column=0, sticky="w", padx=5, pady=2)
+        ttk.Label(stats_grid, textvariable=self.stats_vars['models']).grid(row=3, column=1, columnspan=2, sticky="w", padx=5, pady=2)
         
         # Thanh tiến trình tổng thể
         ttk.Label(stats_frame, text="Tiến trình tổng thể:").pack(anchor="w", padx=5, pady=(5,0))
@@ -914,6 +4936,7 @@ class MiniMaxVideoGeneratorApp:
         
         # Khởi tạo statistic manager
         self.stats_manager = TaskStatisticsManager(self.task_queue)
+        self.download_manager.on_download_stats = self.stats_manager.record_download
         
         # Bắt đầu cập nhật thống kê
         self.schedule_stats_update()
@@ -926,13 +4949,29 @@ class MiniMaxVideoGeneratorApp:
     def update_statistics(self):
         """Cập nhật thông tin thống kê"""
         stats = self.stats_manager.update_stats()
+        # Profiler có thể được bật/tắt bằng tín hiệu hoặc --profile
+        self.update_profile_button()
         
         self.stats_vars['total_tasks'].set(f"Tổng số task: {stats['total_tasks']}")
-        self.stats_vars['queued_tasks'].set(f"Đang chờ: {stats['queued_tasks']}")
-        self.stats_vars['active_tasks'].set(f"Đang xử lý: {stats['active_tasks']}")
+        queued_text = f"Đang chờ: {stats['queued_tasks']}"
+        if stats['endpoint_paused']:
+            queued_text += " (tạm dừng: API lỗi)"
+        self.stats_vars['queued_tasks'].set(queued_text)
+        self.stats_vars['active_tasks'].set(f"Đang xử lý: {stats['active_tasks']} (đang tải: {stats['downloading_tasks']})")
         self.stats_vars['completed_tasks'].set(f"Đã hoàn thành: {stats['completed_tasks']}")
         self.stats_vars['failed_tasks'].set(f"Thất bại: {stats['failed_tasks']}")
         self.stats_vars['success_rate'].set(f"Tỷ lệ thành công: {stats['success_rate']:.1f}%")
+        self.stats_vars['image_groups'].set("Ảnh đã xong đủ biến thể: %d/%d" % stats['image_groups'])
+        
+        # Chỉ hiện chi tiết theo model khi lô có nhiều model
+        model_texts = []
+        if len(stats['models']) > 1:
+            for model, model_stats in stats['models'].items():
+                text = f"{model}: {model_stats['queued']} chờ, {model_stats['active']} chạy"
+                if model_stats['estimated_completion_time']:
+                    text += f", ~{self.format_duration(model_stats['estimated_completion_time'])}"
+                model_texts.append(text)
+        self.stats_vars['models'].set("; ".join(model_texts))
         
         avg_time = stats['avg_processing_time']
         if avg_time is not None:
@@ -943,18 +4982,37 @@ class MiniMaxVideoGeneratorApp:
         
         est_time = stats['estimated_completion_time']
         if est_time is not None:
-            if est_time > 3600:
-                self.stats_vars['estimated_completion_time'].set(f"Ước tính: {est_time/3600:.1f} giờ")
-            elif est_time > 60:
-                self.stats_vars['estimated_completion_time'].set(f"Ước tính: {est_time/60:.1f} phút")
-            else:
-                self.stats_vars['estimated_completion_time'].set(f"Ước tính: {est_time:.0f} giây")
+            text = f"Ước tính: {self.format_duration(est_time)}"
+            if stats['estimated_completion_range']:
+                low, high = stats['estimated_completion_range']
+                text += f" ({self.format_duration(low)} - {self.format_duration(high)})"
+            if stats['throughput_per_minute'] is not None:
+                text += f", {stats['throughput_per_minute']:.1f} task/phút"
+            self.stats_vars['estimated_completion_time'].set(text)
+        
+        throughput = stats['download_throughput']
+        if stats['download_space_paused']:
+            self.stats_vars['download_throughput'].set("Tốc độ tải: tạm dừng (đĩa sắp đầy)")
+        elif throughput is not None:
+            self.stats_vars['download_throughput'].set(
+                f"Tốc độ tải: {throughput / 1024 ** 2:.2f} MB/s ({stats['downloaded_bytes'] / 1024 ** 2:.0f} MB)"
+            )
         
         # Cập nhật thanh tiến trình
         if stats['total_tasks'] > 0:
-            progress = (stats['completed_tasks'] + stats['failed_tasks']) / stats['total_tasks'] * 100
+            finished = stats['completed_tasks'] + stats['failed_tasks'] + stats['cancelled_tasks']
+            progress = finished / stats['total_tasks'] * 100
             self.progress_bar['value'] = progress
     
+    @staticmethod
+    def format_duration(seconds):
+        """Hiển thị số giây dưới dạng giây/phút/giờ"""
+        if seconds > 3600:
+            return f"{seconds/3600:.1f} giờ"
+        elif seconds > 60:
+            return f"{seconds/60:.1f} phút"
+        return f"{seconds:.0f} giây"
+    
     def select_image_folder(self):
         """Chọn thư mục chứa ảnh"""
         folder = filedialog.askdirectory(title="Chọn thư mục ảnh")
@@ -1014,20 +5072,53 @@ class MiniMaxVideoGeneratorApp:
     
     def save_config(self):
         """Lưu cấu hình"""
-        self.config.api_key = self.api_key_var.get()
-        self.config.output_folder = self.output_folder.get()
-        self.config.max_videos_per_image = self.videos_per_image.get()
-        self.config.model = self.model_var.get()
-        
-        self.config.save_config()
-        
-        # Cập nhật API client với key mới
-        self.api_client = MiniMaxAPI(self.config.api_key)
-        self.task_queue.api_client = self.api_client
+        # Snapshot mới được công bố tới hàng đợi qua on_config_changed,
+        # task đang xử lý vẫn dùng key đã tạo ra nó
+        self.config.update(
+            api_key=self.api_key_var.get(),
+            output_folder=self.output_folder.get(),
+            max_videos_per_image=self.videos_per_image.get(),
+            model=self.model_var.get(),
+            skip_existing=self.skip_existing_var.get()
+        )
         
-        self.log("Đã lưu cấu hình")
+        self.log(f"Đã lưu cấu hình ({len(self.api_client.key_pool)} API key)")
         messagebox.showinfo("Thông báo", "Đã lưu cấu hình thành công!")
     
+    def on_config_changed(self, snapshot):
+        """Áp dụng snapshot cấu hình mới cho các thành phần đang chạy"""
+        self.task_queue.apply_config(snapshot)
+        # Cập nhật giao diện trên luồng Tk
+        self.root.after(0, self._refresh_config_widgets, snapshot)
+    
+    def _refresh_config_widgets(self, snapshot):
+        """Hiển thị cấu hình mới, giữ nguyên các ô người dùng đang sửa mà chưa lưu"""
+        fields = (
+            ('api_key', self.api_key_var),
+            ('output_folder', self.output_folder),
+            ('max_videos_per_image', self.videos_per_image),
+            ('model', self.model_var),
+            ('skip_existing', self.skip_existing_var)
+        )
+        kept = []
+        for name, variable in fields:
+            try:
+                value = variable.get()
+            except tk.TclError:
+                # Ô số đang nhập dở
+                kept.append(name)
+                continue
+            if value == getattr(snapshot, name):
+                continue
+            if value != getattr(self.shown_config, name):
+                kept.append(name)
+            else:
+                variable.set(getattr(snapshot, name))
+        self.shown_config = snapshot
+        if kept:
+            self.log(f"Giữ nguyên các thiết lập đang sửa chưa lưu: {', '.join(kept)}")
+        self.log(f"Đã áp dụng cấu hình mới: {snapshot.max_concurrent_tasks} task đồng thời mỗi key, kiểm tra mỗi {snapshot.poll_interval:g} giây")
+    
     def open_prompt_editor(self, prompt_text=""):
         """Mở cửa sổ soạn thảo prompt nâng cao"""
         current_prompt = prompt_text
@@ -1037,7 +5128,12 @@ class MiniMaxVideoGeneratorApp:
             if selected_image:
                 current_prompt = self.excel_processor.get_prompt_for_image(selected_image) or ""
         
-        PromptEditorWindow(self.root, self.prompt_library, current_prompt, self.apply_edited_prompt)
+        # Các cột trong Excel có thể dùng làm biến {ten_cot} trong mẫu prompt
+        placeholders = []
+        if self.excel_processor.data is not None:
+            placeholders = [str(column) for column in self.excel_processor.data.columns if column != 'image']
+        
+        PromptEditorWindow(self.root, self.prompt_library, current_prompt, self.apply_edited_prompt, placeholders)
     
     def apply_edited_prompt(self, prompt_text):
         """Áp dụng prompt đã chỉnh sửa"""
@@ -1096,35 +5192,191 @@ class MiniMaxVideoGeneratorApp:
             messagebox.showerror("Lỗi", "Không tìm thấy file ảnh trong thư mục đã chọn.")
             return
         
-        # Xử lý từng ảnh
+        # Dùng prompt mặc định làm mẫu nếu có biến, ngược lại lấy cột 'prompt'
+        try:
+            template = self.current_template()
+            image_paths = {os.path.basename(path): path for path in self.images_list}
+            tasks = self.excel_processor.expand_tasks(
+                list(image_paths),
+                template=template,
+                videos_per_image=self.videos_per_image.get(),
+                mode=self.current_variant_mode()
+            )
+        except (KeyError, ValueError) as e:
+            messagebox.showerror("Lỗi", f"Không thể tạo prompt từ mẫu: {e}")
+            return
+        
+        missing = set(image_paths) - set(tasks['image'])
+        for image_filename in sorted(missing):
+            self.log(f"Cảnh báo: Không tìm thấy prompt cho ảnh {image_filename}, bỏ qua.")
+        
+        self.enqueue_tasks(tasks, image_paths, output_folder, interactive=True)
+    
+    def current_template(self):
+        """Mẫu prompt: prompt mặc định nếu có biến, ngược lại dùng cột 'prompt'"""
+        template_text = self.default_prompt.get()
+        return PromptTemplate(template_text if PromptTemplate.has_placeholders(template_text) else "{prompt}")
+    
+    def current_variant_mode(self):
+        return "zip" if self.variant_mode_var.get() == "Ghép cặp" else "cartesian"
+    
+    def enqueue_tasks(self, tasks, image_paths, output_folder, interactive=True, model=None, skip_existing=None):
+        """Kiểm tra lô rồi đưa các task hợp lệ vào hàng đợi
+
+        interactive=True: việc kiểm tra lô và so với manifest (có thể phải băm ảnh) chạy ở luồng nền,
+        hộp thoại xác nhận và thông báo được đưa về luồng Tk bằng root.after; không trả về gì.
+        interactive=False (chế độ theo dõi thư mục, gọi từ luồng nền): tự bỏ qua task lỗi, không hỏi,
+        model/skip_existing phải truyền vào vì không đọc biến Tk ngoài luồng giao diện; trả về số task đã thêm.
+        Cột 'model' (nếu có) chọn model riêng cho từng task, ô trống dùng model mặc định.
+        """
+        if model is None:
+            model = self.model_var.get()
+        if skip_existing is None:
+            skip_existing = self.skip_existing_var.get()
+        
+        if not interactive:
+            manifest, report = self._validate_batch(tasks, image_paths, output_folder)
+            pending = self._valid_tasks(tasks, image_paths, output_folder, report, model)
+            batch_id = uuid.uuid4().hex[:8]
+            self.last_batch_id = batch_id
+            return self._add_batch(pending, manifest if skip_existing else None, batch_id)
+        
+        def validate():
+            try:
+                manifest, report = self._validate_batch(tasks, image_paths, output_folder)
+            except Exception as e:
+                self.log(f"Lỗi khi kiểm tra lô: {e}")
+                self.root.after(0, lambda: self.root.config(cursor=""))
+                return
+            self.root.after(0, lambda: confirm(manifest, report))
+        
+        def confirm(manifest, report):
+            # Chạy trên luồng Tk: hỏi người dùng rồi thêm task ở luồng nền
+            self.root.config(cursor="")
+            if not report.ok and not messagebox.askyesno(
+                "Kiểm tra lô",
+                f"{report.summary()}\n\nBỏ qua các task lỗi và tiếp tục gửi những task hợp lệ?"
+            ):
+                return
+            pending = self._valid_tasks(tasks, image_paths, output_folder, report, model)
+            batch_id = uuid.uuid4().hex[:8]
+            self.last_batch_id = batch_id
+            threading.Thread(target=add, args=(pending, manifest if skip_existing else None, batch_id),
+                             daemon=True, name="enqueue").start()
+        
+        def add(pending, manifest, batch_id):
+            tasks_count = self._add_batch(pending, manifest, batch_id)
+            self.root.after(0, lambda: messagebox.showinfo(
+                "Thành công", f"Đã thêm {tasks_count} task tạo video vào hàng đợi."))
+        
+        self.root.config(cursor="watch")
+        threading.Thread(target=validate, daemon=True, name="validate").start()
+    
+    def _validate_batch(self, tasks, image_paths, output_folder):
+        """Kiểm tra toàn bộ lô trước khi gửi task nào, ghi kết quả vào log; trả về (manifest, báo cáo)"""
+        manifest = self.task_queue.get_manifest(output_folder)
+        report = BatchValidator().validate(
+            ((image_paths[name], prompt) for name, prompt in zip(tasks['image'], tasks['prompt'])),
+            output_folder,
+            average_output_size=manifest.average_size()
+        )
+        self.log(report.summary())
+        for label, message in (report.errors + report.warnings)[:50]:
+            self.log(f"  {label}: {message}")
+        return manifest, report
+    
+    def _valid_tasks(self, tasks, image_paths, output_folder, report, model):
+        """Các task hợp lệ dạng (ảnh, prompt, file kết quả, model)"""
+        pending = []
+        task_models = tasks['model'] if 'model' in tasks.columns else [None] * len(tasks)
+        rows = zip(tasks['image'], tasks['prompt'], tasks['index'], task_models)
+        for position, (image_filename, prompt, index, task_model) in enumerate(rows):
+            if position in report.invalid_tasks:
+                continue
+            output_filename = os.path.join(
+                output_folder,
+                f"{os.path.splitext(image_filename)[0]}_video_{index}.mp4"
+            )
+            pending.append((image_paths[image_filename], prompt, output_filename, task_model or model))
+        return pending
+    
+    def _add_batch(self, pending, manifest, batch_id):
+        """Bỏ qua video đã có trong manifest (nếu truyền manifest) rồi thêm task, trả về số task đã thêm"""
         tasks_count = 0
-        for image_path in self.images_list:
-            image_filename = os.path.basename(image_path)
-            prompt = self.excel_processor.get_prompt_for_image(image_path)
-            
-            if not prompt:
-                self.log(f"Cảnh báo: Không tìm thấy prompt cho ảnh {image_filename}, bỏ qua.")
+        skipped_count = 0
+        variants = {}  # (ảnh, model) -> [(prompt, output_filename)], giữ thứ tự xuất hiện
+        for image_path, prompt, output_filename, task_model in pending:
+            if manifest is not None and manifest.is_done(output_filename, image_path, prompt, task_model):
+                skipped_count += 1
                 continue
-            
-            # Thêm task cho ảnh này dựa trên số lượng video mỗi ảnh
-            for i in range(self.videos_per_image.get()):
-                output_filename = os.path.join(
-                    output_folder,
-                    f"{os.path.splitext(image_filename)[0]}_video_{i+1}.mp4"
-                )
-                
-                self.task_queue.add_task(
-                    image_path=image_path,
-                    prompt=prompt,
-                    output_filename=output_filename,
-                    model=self.model_var.get()
-                )
-                
-                tasks_count += 1
-                self.log(f"Đã thêm task cho ảnh {image_filename} ({i+1}/{self.videos_per_image.get()})")
+            variants.setdefault((image_path, task_model), []).append((prompt, output_filename))
+            tasks_count += 1
+        
+        # Các biến thể của cùng một ảnh dùng chung ảnh đã mã hóa
+        for (image_path, task_model), image_variants in variants.items():
+            if len(image_variants) == 1:
+                prompt, output_filename = image_variants[0]
+                self.task_queue.add_task(image_path=image_path, prompt=prompt, output_filename=output_filename,
+                                         model=task_model, batch_id=batch_id)
+            else:
+                self.task_queue.add_task_group(image_path, image_variants, model=task_model, batch_id=batch_id)
+        
+        if skipped_count:
+            self.log(f"Bỏ qua {skipped_count} video đã tạo trước đó.")
+        self.log(f"Đã thêm {tasks_count} task tạo video vào hàng đợi (lô {batch_id}).")
+        return tasks_count
+    
+    def toggle_watch(self):
+        """Bật/tắt chế độ theo dõi thư mục ảnh và file Excel"""
+        if self.folder_watcher:
+            self.folder_watcher.stop()
+            self.folder_watcher = None
+            self.watch_button.config(text="Theo dõi thư mục")
+            self.log("Đã dừng theo dõi thư mục")
+            return
+        
+        image_folder = self.image_folder.get()
+        excel_file = self.excel_file.get()
+        output_folder = self.output_folder.get() or os.path.join(os.path.expanduser("~"), "MiniMaxVideos")
+        if not image_folder or not os.path.isdir(image_folder):
+            messagebox.showerror("Lỗi", "Vui lòng chọn thư mục ảnh hợp lệ.")
+            return
+        if not excel_file or not os.path.isdir(os.path.dirname(os.path.abspath(excel_file))):
+            messagebox.showerror("Lỗi", "Vui lòng chọn file Excel hợp lệ.")
+            return
+        try:
+            template = self.current_template()
+        except (KeyError, ValueError) as e:
+            messagebox.showerror("Lỗi", f"Mẫu prompt không hợp lệ: {e}")
+            return
+        os.makedirs(output_folder, exist_ok=True)
         
-        self.log(f"Đã thêm {tasks_count} task tạo video vào hàng đợi.")
-        messagebox.showinfo("Thành công", f"Đã thêm {tasks_count} task tạo video vào hàng đợi.")
+        self.folder_watcher = FolderWatcher(
+            image_folder, excel_file,
+            template=template,
+            videos_per_image=self.videos_per_image.get(),
+            mode=self.current_variant_mode()
+        )
+        model = self.model_var.get()
+        skip_existing = self.skip_existing_var.get()
+        self.folder_watcher.on_tasks = lambda tasks, image_paths: self.enqueue_tasks(
+            tasks, image_paths, output_folder, interactive=False, model=model, skip_existing=skip_existing)
+        self.folder_watcher.start()
+        self.watch_button.config(text="Dừng theo dõi")
+        self.log(f"Đang theo dõi {image_folder} và {os.path.basename(excel_file)}, task mới sẽ tự được thêm")
+    
+    
+    def toggle_profiling(self):
+        """Bật/tắt profiling lấy mẫu các luồng"""
+        path = self.profiler.toggle()
+        self.update_profile_button()
+        if path:
+            self.log(f"Đã ghi profile vào {path}")
+        elif self.profiler.running:
+            self.log("Đang profiling, bấm lần nữa để dừng và ghi file")
+    
+    def update_profile_button(self):
+        self.profile_button.config(text="Dừng profiling" if self.profiler.running else "Profiling")
     
     def on_task_started(self, task_info):
         """Xử lý khi task bắt đầu"""
@@ -1143,20 +5395,208 @@ class MiniMaxVideoGeneratorApp:
         error = task_info.get('error', 'Lỗi không xác định')
         self.log(f"Lỗi khi tạo video cho ảnh {image_basename}: {error}")
     
+    def on_task_cancelled(self, task_info):
+        """Xử lý khi task bị hủy"""
+        image_basename = os.path.basename(task_info['image_path'])
+        self.log(f"Đã hủy task cho ảnh {image_basename}")
+    
+    def on_group_completed(self, group):
+        """Xử lý khi mọi biến thể của một ảnh đã kết thúc"""
+        image_basename = os.path.basename(group['image_path'])
+        self.log(f"Đã xong tất cả biến thể của ảnh {image_basename}: "
+                 f"{group['completed']}/{group['total']} thành công, {group['failed']} lỗi")
+    
+    def on_space_low(self, paused):
+        """Xử lý khi tải xuống tạm dừng/tiếp tục do dung lượng đĩa"""
+        if paused:
+            self.log("Cảnh báo: Ổ đĩa đầu ra sắp đầy, tạm dừng tải xuống và gửi task mới.")
+        else:
+            self.log("Đã đủ dung lượng trống, tiếp tục tải xuống.")
+            self.task_queue.wake()
+    
+    def on_endpoint_paused(self, paused):
+        """Xử lý khi gửi task tạm dừng/tiếp tục do endpoint API bị ngắt"""
+        if paused:
+            self.log("Cảnh báo: API MiniMax đang lỗi, tạm dừng gửi task mới (các task vẫn giữ trong hàng đợi).")
+        else:
+            self.log("API MiniMax đã hoạt động lại, tăng dần số task gửi đi.")
+    
+    def on_queue_drained(self):
+        """Xử lý khi hàng đợi đã hoàn tất các task đang chạy"""
+        self.log(f"Đã hoàn tất các task đang xử lý. Còn {self.task_queue.snapshot.queued} task chờ trong hàng đợi.")
+    
+    def toggle_pause(self):
+        """Tạm dừng hoặc tiếp tục hàng đợi"""
+        if self.task_queue.paused:
+            self.task_queue.resume()
+            self.pause_button.config(text="Tạm dừng")
+            self.log("Tiếp tục xử lý hàng đợi")
+        else:
+            self.task_queue.pause()
+            self.pause_button.config(text="Tiếp tục")
+            self.log("Đã tạm dừng hàng đợi")
+    
+    def drain_queue(self):
+        """Ngừng gửi task mới và chờ các task đang chạy hoàn tất"""
+        self.task_queue.drain()
+        self.pause_button.config(text="Tạm dừng")
+        self.log("Ngừng gửi task mới, đang chờ các task đang xử lý hoàn tất...")
+    
+    def cancel_last_batch(self):
+        """Hủy lô task vừa thêm"""
+        if not self.last_batch_id:
+            return
+        count = self.task_queue.cancel_batch(self.last_batch_id)
+        self.log(f"Đã hủy {count} task của lô {self.last_batch_id}")
+    
+    def cancel_all_tasks(self):
+        """Hủy tất cả task chưa hoàn thành"""
+        if not messagebox.askyesno("Xác nhận", "Hủy tất cả task đang chờ và đang xử lý?"):
+            return
+        count = self.task_queue.cancel_all()
+        self.log(f"Đã hủy {count} task")
+    
+    def verify_outputs(self):
+        """Kiểm tra các video trong manifest của thư mục đầu ra"""
+        output_folder = self.output_folder.get()
+        if not output_folder or not os.path.isdir(output_folder):
+            messagebox.showerror("Lỗi", "Vui lòng chọn thư mục đầu ra hợp lệ.")
+            return
+        
+        manifest = self.task_queue.get_manifest(output_folder)
+        self.log(f"Đang kiểm tra {len(manifest.entries)} video trong manifest...")
+        
+        def run():
+            results = manifest.verify()
+            invalid = [(name, message) for name, valid, message in results if not valid]
+            for name, message in invalid:
+                self.log(f"Video lỗi {name}: {message}")
+            # Xóa bản ghi lỗi để lần chạy sau tạo lại các video này
+            if invalid:
+                manifest.remove([name for name, _ in invalid])
+            self.log(f"Kiểm tra xong: {len(results) - len(invalid)} hợp lệ, {len(invalid)} lỗi")
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    def on_close(self):
+        """Dừng hàng đợi trước khi thoát ứng dụng"""
+        self.config.stop_watching()
+        if self.folder_watcher:
+            self.folder_watcher.stop()
+        if self.job_service:
+            self.job_service.stop()
+        self.task_queue.history.flush()
+        self.prompt_library.flush()
+        self.task_queue.stop_processing(timeout=2.0)
+        self.download_manager.shutdown()
+        if self.api_client.recorder:
+            self.api_client.recorder.close()
+        self.root.destroy()
+    
     def update_queue_stats(self):
         """Cập nhật thông tin hàng đợi"""
         # Được gọi thông qua phương thức update_statistics
         pass
     
     def log(self, message):
-        """Ghi log vào console"""
+        """Ghi log vào console (gọi được từ mọi luồng, không chặn luồng gọi)"""
         timestamp = datetime.now().strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.log_text.see(tk.END)  # Cuộn xuống dòng cuối cùng
-        logging.info(message)
+        self.log_queue.put(f"[{timestamp}] {message}\n")
+        app_logger.info(message)
+    
+    def drain_log_queue(self):
+        """Đưa log đang chờ vào widget theo lô trên luồng Tk"""
+        lines = []
+        try:
+            while len(lines) < 500:
+                lines.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        
+        if lines:
+            self.log_text.insert(tk.END, "".join(lines))
+            # Giới hạn số dòng để widget không chậm dần
+            line_count = int(self.log_text.index("end-1c").split(".")[0])
+            if line_count > self.MAX_LOG_LINES:
+                self.log_text.delete("1.0", f"{line_count - self.MAX_LOG_LINES}.0")
+            self.log_text.see(tk.END)  # Cuộn xuống dòng cuối cùng
+        
+        self.root.after(100, self.drain_log_queue)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="MiniMax Video Generator")
+    parser.add_argument("--benchmark-logging", action="store_true",
+                        help="Đo chi phí ghi log ở 1000 sự kiện/giây rồi thoát")
+    parser.add_argument("--serve", type=int, nargs="?", const=8765, metavar="PORT",
+                        help="Chạy dịch vụ nhận task qua HTTP tại 127.0.0.1:PORT, không mở giao diện")
+    parser.add_argument("--history-report", action="store_true",
+                        help="In báo cáo tổng hợp từ lịch sử các lần chạy rồi thoát")
+    parser.add_argument("--record-trace", metavar="FILE",
+                        help="Ghi mọi lượt gọi API vào file trace (.jsonl hoặc .jsonl.gz)")
+    parser.add_argument("--replay-trace", metavar="FILE",
+                        help="Chạy lại file trace với thiết lập hàng đợi bên dưới, in thống kê rồi thoát")
+    parser.add_argument("--concurrency", type=int, default=3, help="Số task đồng thời mỗi key khi chạy lại/giả lập")
+    parser.add_argument("--poll-interval", type=float, default=10, help="Chu kỳ truy vấn (giây) khi chạy lại/giả lập")
+    parser.add_argument("--max-retries", type=int, default=0, help="Số lần thử lại khi chạy lại/giả lập")
+    parser.add_argument("--retry-delay", type=float, default=30, help="Thời gian chờ thử lại (giây) khi chạy lại/giả lập")
+    parser.add_argument("--speed", type=float, default=100.0, help="Hệ số tăng tốc thời gian khi chạy lại trace")
+    parser.add_argument("--simulate", type=int, metavar="TASKS",
+                        help="Giả lập TASKS task trên đồng hồ ảo với thiết lập hàng đợi ở trên, in thống kê rồi thoát")
+    parser.add_argument("--keys", type=int, default=1, help="Số API key khi giả lập")
+    parser.add_argument("--generation-time", type=float, default=240, help="Thời gian tạo video trung bình (giây) khi giả lập")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Tỷ lệ task thất bại khi giả lập")
+    parser.add_argument("--hours", type=float, default=24, help="Thời gian ảo tối đa (giờ) khi giả lập")
+    parser.add_argument("--profile", action="store_true",
+                        help="Bật profiling lấy mẫu ngay khi khởi động, ghi file khi thoát "
+                             "(cũng bật/tắt được bằng nút trên giao diện hoặc tín hiệu SIGUSR1/SIGBREAK)")
+    args = parser.parse_args()
+    
+    app_data_dir = ensure_app_dirs()
+    listener = setup_logging(app_data_dir, load_log_levels(os.path.join(app_data_dir, 'config.ini')))
+    atexit.register(listener.stop)
+    
+    profiler = SamplingProfiler(os.path.join(app_data_dir, "profiles"))
+    install_profile_signal(profiler)
+    atexit.register(profiler.stop)
+    if args.profile:
+        profiler.start()
+    
+    if args.benchmark_logging:
+        per_event = benchmark_logging()
+        print(f"Chi phí ghi log trung bình: {per_event:.1f} µs/sự kiện")
+        return
+    
+    if args.history_report:
+        history = RunHistory(os.path.join(app_data_dir, "history"))
+        report = history.report()
+        if not report:
+            print("Chưa có lịch sử chạy")
+        for title, table in report.items():
+            print(f"== {title} ==")
+            print(table.to_string())
+            print()
+        return
+    
+    if args.serve is not None:
+        run_service(args.serve, profiler=profiler)
+        return
+    
+    if args.replay_trace:
+        result = replay_trace(args.replay_trace, max_concurrent_tasks=args.concurrency,
+                              poll_interval=args.poll_interval, max_retries=args.max_retries,
+                              retry_delay=args.retry_delay, speed=args.speed)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    
+    if args.simulate:
+        result = simulate_queue(args.simulate, max_concurrent_tasks=args.concurrency, keys=args.keys,
+                                poll_interval=args.poll_interval, max_retries=args.max_retries,
+                                retry_delay=args.retry_delay, generation_time=args.generation_time,
+                                failure_rate=args.failure_rate, max_hours=args.hours)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    
     root = tk.Tk()
     
     try:
@@ -1165,9 +5605,9 @@ def main():
         if os.path.exists(icon_path):
             root.iconbitmap(icon_path)
     except Exception as e:
-        logging.warning(f"Không thể tải biểu tượng ứng dụng: {e}")
+        app_logger.warning("Không thể tải biểu tượng ứng dụng: %s", e)
     
-    app = MiniMaxVideoGeneratorApp(root)
+    app = MiniMaxVideoGeneratorApp(root, trace_path=args.record_trace, profiler=profiler)
     root.mainloop()
 
 
@@ -0,0 +1,42 @@
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    """Tạo TaskQueueManager trên SimulatedAPI, trả về (hàng đợi, api, danh sách job_id)
+
+    clock mặc định là SimulatedClock dùng chung cho api và hàng đợi; api_clock cho api đồng hồ riêng.
+    running=True đánh dấu hàng đợi đang chạy để add_task không mở luồng xử lý (giả lập trong luồng test).
+    Các tham số khác của TaskQueueManager (max_retries, retry_delay, ...) truyền qua queue_options.
+    """
+    created = []
+
+    def make(tasks=0, clock=None, api_clock=None, keys=1, max_tasks_per_key=None, generation_time=120,
+             jitter=0.5, failure_rate=0.0, seed=1, max_concurrent_tasks=2, poll_interval=10, inline=True,
+             running=True, **queue_options):
+        clock = clock or main.SimulatedClock()
+        api = main.SimulatedAPI(api_clock or clock, keys=keys, max_tasks_per_key=max_tasks_per_key,
+                                generation_time=generation_time, jitter=jitter, failure_rate=failure_rate, seed=seed)
+        downloads = main.DownloadManager(post_processing=(), min_free_space_mb=0, clock=clock, inline=inline)
+        task_queue = main.TaskQueueManager(api, max_concurrent_tasks=max_concurrent_tasks, poll_interval=poll_interval,
+                                           download_manager=downloads, clock=clock, **queue_options)
+        task_queue.running = running
+        created.append(task_queue)
+        job_ids = [task_queue.add_task("a.png", f"p{i}", str(tmp_path / f"{i}.mp4"), source_digest="d")
+                   for i in range(tasks)]
+        return task_queue, api, job_ids
+
+    yield make
+    for task_queue in created:
+        task_queue.stop_processing(timeout=2.0)
+        task_queue.downloads.shutdown()
@@ -0,0 +1,69 @@
+import pytest
+
+import main
+
+
+def trip(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record(False)
+    assert breaker.state == 'open'
+
+
+def test_download_breaker_does_not_pause_submissions(make_queue):
+    clock = main.SimulatedClock()
+    task_queue, api, _ = make_queue(tasks=1, clock=clock, max_concurrent_tasks=4, generation_time=60)
+    trip(api.breakers['download'])
+    clock.advance(api.breakers['download'].open_seconds)
+    assert api.breakers['download'].state == 'half_open'
+
+    task_queue.run_once()
+
+    assert api.check_health()
+    assert not task_queue.endpoint_paused
+    assert api.calls.get('create') == 1
+
+
+def test_paused_queue_waits_for_busy_probe(make_queue):
+    clock = main.SimulatedClock()
+    task_queue, api, _ = make_queue(tasks=1, clock=clock, max_concurrent_tasks=4, generation_time=60)
+    breaker = api.breakers['create']
+    trip(breaker)
+    clock.advance(breaker.open_seconds)
+    breaker.before_call()  # lượt thử nửa mở đang do request khác giữ
+
+    wait = task_queue.run_once()
+
+    assert task_queue.endpoint_paused
+    assert wait == main.MiniMaxAPI.PROBE_RETRY
+    breaker.record(True)
+    clock.advance(wait)
+    task_queue.run_once()
+    assert not task_queue.endpoint_paused
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+    def close(self):
+        pass
+
+
+def test_download_server_errors_open_breaker(tmp_path, monkeypatch):
+    api = main.MiniMaxAPI("key", clock=main.SimulatedClock())
+    breaker = api.breakers['download']
+    status = [404]
+    monkeypatch.setattr(main.requests, 'get', lambda *args, **kwargs: FakeResponse(status[0]))
+
+    # 4xx là lỗi của URL/task, không phải của máy chủ tải xuống
+    for _ in range(breaker.min_calls):
+        with pytest.raises(Exception):
+            api.download_video("https://cdn/x.mp4", str(tmp_path / "x.mp4"))
+    assert breaker.state == 'closed'
+
+    status[0] = 503
+    for _ in range(breaker.min_calls):
+        with pytest.raises(main.requests.HTTPError):
+            api.download_video("https://cdn/x.mp4", str(tmp_path / "x.mp4"))
+    assert breaker.state == 'open'
@@ -0,0 +1,83 @@
+import types
+
+import main
+
+
+class Variable:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+def snapshot(**changes):
+    defaults = dict(api_key="key1", output_folder="/out", max_videos_per_image=1, model="I2V-01-Director",
+                    max_concurrent_tasks=3, poll_interval=10, download_workers=2, disk_write_mbps=0,
+                    post_processing="checksum,validate_mp4", skip_existing=True, download_bandwidth_kbps=0,
+                    min_free_space_mb=1024, max_retries=0, retry_delay=30, service_port=0, model_concurrency="",
+                    upload_gzip=False, service_input_folder="/in")
+    defaults.update(changes)
+    return main.ConfigSnapshot(**defaults)
+
+
+def test_refresh_keeps_unsaved_edits():
+    shown = snapshot()
+    app = types.SimpleNamespace(
+        shown_config=shown, log=lambda message: None,
+        api_key_var=Variable(shown.api_key), output_folder=Variable("/edited"),
+        videos_per_image=Variable(shown.max_videos_per_image), model_var=Variable(shown.model),
+        skip_existing_var=Variable(shown.skip_existing))
+
+    new = snapshot(api_key="key2", output_folder="/other", max_videos_per_image=3)
+    main.MiniMaxVideoGeneratorApp._refresh_config_widgets(app, new)
+
+    assert app.output_folder.get() == "/edited"
+    assert app.api_key_var.get() == "key2"
+    assert app.videos_per_image.get() == 3
+    assert app.shown_config == new
+
+
+def test_set_keys_keeps_failed_keys_disabled():
+    pool = main.APIKeyPool(main.parse_api_keys("good, bad"))
+    pool.report_error("bad", code=pool.FATAL_CODES[0])
+    assert pool.available_count() == 1
+
+    # Lưu lại cấu hình (ví dụ đổi poll_interval) không bật lại key hỏng
+    pool.set_keys(main.parse_api_keys("good, bad"))
+    assert pool.entries["bad"]['disabled']
+    assert pool.available_count() == 1
+
+    # Đổi trọng số của key là cách bật lại chủ động
+    pool.set_keys(main.parse_api_keys("good, bad:2"))
+    assert not pool.entries["bad"]['disabled']
+    assert pool.available_count() == 2
+
+
+def test_poster_step_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    config = main.ConfigManager()
+    assert config.post_processing.split(",") == ["checksum", "validate_mp4"]
+    assert main.ConfigManager().snapshot.post_processing == config.post_processing
+
+
+def test_rejected_reload_keeps_previous_parser(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    config = main.ConfigManager()
+    parser = config.config
+    with open(config.config_file, 'a') as f:
+        f.write("\n[Logging]\nlevel = DEBUG\n")
+    with open(config.config_file) as f:
+        text = f.read()
+    with open(config.config_file, 'w') as f:
+        f.write(text.replace("poll_interval = 10", "poll_interval = abc"))
+
+    assert not config.reload()
+    assert config.config is parser
+    assert config.poll_interval == 10
+    config.save_config()
+    assert main.ConfigManager().poll_interval == 10
+    assert 'Logging' not in config.config
@@ -0,0 +1,63 @@
+import collections
+
+import main
+
+DiskUsage = collections.namedtuple('DiskUsage', 'total used free')
+MB = 1024 * 1024
+
+
+class FakeAPI:
+    """Ghi lại thứ tự lấy URL / mở kết nối so với lúc đĩa đủ chỗ"""
+
+    def __init__(self, disk, video_bytes):
+        self.disk = disk
+        self.video_bytes = video_bytes
+        self.events = []
+
+    def retrieve_video(self, file_id, task_id):
+        self.events.append(('retrieve', self.disk['free']))
+        return {'file': {'download_url': "https://cdn.example/video.mp4"}}
+
+    def download_video(self, download_url, output_path, throttle=None, should_stop=None, before_write=None,
+                       task_id=None):
+        self.events.append(('open', self.disk['free']))
+        before_write(self.video_bytes)
+        with open(output_path, 'wb') as f:
+            f.write(b"\0" * 16)
+        return output_path
+
+
+def run_download(tmp_path, monkeypatch, disk, api):
+    def disk_usage(path):
+        # Mỗi lần kiểm tra, dung lượng trống tăng thêm 10 MB (người dùng đang dọn đĩa)
+        free = disk['free']
+        disk['free'] += 10 * MB
+        return DiskUsage(0, 0, free)
+
+    monkeypatch.setattr(main.shutil, "disk_usage", disk_usage)
+    monkeypatch.setattr(main.DownloadManager, "SPACE_CHECK_INTERVAL", 0.001)
+    downloads = main.DownloadManager(post_processing=(), min_free_space_mb=100, inline=True)
+    task_info = {'job_id': "j", 'task_id': "t", 'file_id': "f", 'status': 'downloading',
+                 'output_filename': str(tmp_path / "out" / "v.mp4")}
+    results = []
+    downloads.submit(task_info, api, lambda task, error: results.append(error))
+    downloads.shutdown()
+    return results
+
+
+def test_waits_for_space_before_opening_request(tmp_path, monkeypatch):
+    disk = {'free': 50 * MB}
+    api = FakeAPI(disk, 5 * MB)
+    assert run_download(tmp_path, monkeypatch, disk, api) == [None]
+    # URL chỉ được lấy và kết nối chỉ được mở khi đã đủ 100 MB dự trữ + 5 MB video
+    assert [name for name, _ in api.events] == ['retrieve', 'open']
+    assert all(free >= 105 * MB for _, free in api.events)
+
+
+def test_larger_video_closes_connection_and_retries(tmp_path, monkeypatch):
+    disk = {'free': 110 * MB}
+    api = FakeAPI(disk, 40 * MB)
+    assert run_download(tmp_path, monkeypatch, disk, api) == [None]
+    # Lượt đầu đủ chỗ theo ước tính 5 MB nhưng video thật 40 MB: đóng kết nối, chờ rồi lấy URL mới
+    assert [name for name, _ in api.events] == ['retrieve', 'open', 'retrieve', 'open']
+    assert api.events[2][1] >= 140 * MB
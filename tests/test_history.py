@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+import main
+
+
+def finished_task(job_id, status, finish_time, model="I2V-01-Director"):
+    return {'job_id': job_id, 'status': status, 'image_path': "a.png", 'prompt': "p", 'model': model,
+            'added_time': finish_time - timedelta(seconds=300), 'start_time': finish_time - timedelta(seconds=240),
+            'completion_time': finish_time, 'error': "Lỗi tạo video" if status == 'failed' else None}
+
+
+def test_report_on_empty_history(tmp_path):
+    assert main.RunHistory(str(tmp_path)).report() == {}
+
+
+def test_report_summarises_history(tmp_path):
+    history = main.RunHistory(str(tmp_path))
+    start = datetime(2026, 1, 1, 10)
+    for i in range(6):
+        history.record(finished_task(f"job{i}", 'completed', start + timedelta(minutes=20 * i)))
+    history.record(finished_task("job-failed", 'failed', start))
+    history.record(finished_task("job-cancelled", 'cancelled', start))
+    history.flush()
+
+    report = history.report()
+    assert list(report['throughput_per_hour']) == [3, 3]
+    assert report['latency_by_model']['tasks'].sum() == 6
+    assert report['failures_by_error']['tasks'].sum() == 1
+    assert abs(report['failures_by_error']['rate'].sum() - 1 / 7) < 1e-9
+
+
+def test_report_without_completed_tasks(tmp_path):
+    history = main.RunHistory(str(tmp_path))
+    history.record(finished_task("job-cancelled", 'cancelled', datetime(2026, 1, 1)))
+    history.flush()
+
+    report = history.report()
+    assert report['throughput_per_hour'].empty
+    assert report['failures_by_error'].empty
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    image = tmp_path / "a.png"
+    image.write_bytes(b"image")
+    output = tmp_path / "a_video_1.mp4"
+    output.write_bytes(b"video")
+    manifest = main.OutputManifest(str(tmp_path))
+    manifest.record({'output_filename': str(output), 'image_path': str(image), 'prompt': "p",
+                     'model': "I2V-01-Director", 'sha256': "x"})
+    return image, output
+
+
+def no_hashing(path, *args, **kwargs):
+    raise AssertionError(f"không được băm {path}")
+
+
+def test_digest_cache_is_persisted(tmp_path, recorded, monkeypatch):
+    image, output = recorded
+    monkeypatch.setattr(main, "file_sha256", no_hashing)
+    manifest = main.OutputManifest(str(tmp_path))
+    assert manifest.is_done(str(output), str(image), "p", "I2V-01-Director")
+
+
+def test_is_done_skips_hashing_without_matching_entry(tmp_path, recorded, monkeypatch):
+    image, output = recorded
+    monkeypatch.setattr(main, "file_sha256", no_hashing)
+    manifest = main.OutputManifest(str(tmp_path))
+    assert not manifest.is_done(str(tmp_path / "other.mp4"), str(image), "p", "I2V-01-Director")
+    assert not manifest.is_done(str(output), str(image), "khác", "I2V-01-Director")
+
+
+def test_changed_image_is_hashed_again(tmp_path, recorded):
+    image, output = recorded
+    image.write_bytes(b"changed image")
+    os.utime(str(image), ns=(1, 1))
+    manifest = main.OutputManifest(str(tmp_path))
+    assert not manifest.is_done(str(output), str(image), "p", "I2V-01-Director")
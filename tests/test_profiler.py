@@ -0,0 +1,27 @@
+import os
+import signal
+import threading
+
+import pytest
+
+import main
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason="Cần SIGUSR1")
+def test_signal_toggles_profiler_off_the_main_thread():
+    toggled = threading.Event()
+    threads = []
+
+    class Profiler:
+        def toggle(self):
+            threads.append(threading.current_thread())
+            toggled.set()
+
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        assert main.install_profile_signal(Profiler()) == signal.SIGUSR1
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert toggled.wait(2)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    assert threads[0] is not threading.main_thread()
@@ -0,0 +1,21 @@
+import json
+import os
+
+import main
+
+
+def test_wal_survives_missing_library(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    library = main.PromptLibrary(save_delay=60)
+    library.add_prompt("Riêng", "Mưa", "Mưa rơi trên phố")
+    library._save_timer.cancel()
+    # Ứng dụng dừng trước khi gộp nhật ký và file chính bị mất: chỉ còn nhật ký
+    os.remove(library.library_file)
+    assert os.path.exists(library.wal_file)
+
+    reloaded = main.PromptLibrary(save_delay=60)
+    assert reloaded.get_prompt("Riêng", "Mưa") == {"name": "Mưa", "prompt": "Mưa rơi trên phố"}
+    assert reloaded.get_prompt("Phong cảnh", "Núi tuyết") is not None
+    with open(reloaded.library_file, 'r', encoding='utf-8') as f:
+        assert json.load(f)['prompts']["Riêng"] == [{"name": "Mưa", "prompt": "Mưa rơi trên phố"}]
+    assert not os.path.exists(reloaded.wal_file)
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+import main
+
+
+def test_stop_wakes_idle_loop_immediately(make_queue):
+    # Hàng đợi rỗng chờ đánh thức vô thời hạn: dừng phải trả về ngay, không đợi hết poll_interval
+    task_queue, _, _ = make_queue(clock=main.SystemClock(), api_clock=main.SimulatedClock(), poll_interval=3600,
+                                  running=False)
+    task_queue.start_processing()
+    time.sleep(0.05)
+
+    started = time.monotonic()
+    assert task_queue.stop_processing(timeout=2.0)
+    assert time.monotonic() - started < 0.5
+    assert not task_queue.queue_thread.is_alive()
+
+
+def test_drain_stops_after_in_flight_tasks(make_queue):
+    clock = main.SimulatedClock()
+    task_queue, api, _ = make_queue(jitter=0, tasks=5, clock=clock)
+    drained = threading.Event()
+    task_queue.on_drained = drained.set
+    task_queue.run_once()
+    assert task_queue.snapshot.active == 2
+
+    task_queue.drain()
+    while task_queue.running:
+        wait_time = task_queue.run_once()
+        clock.advance(wait_time if wait_time is not None else task_queue.poll_interval)
+
+    # Dừng ngay ở lượt truy vấn đầu tiên sau khi hai task đang chạy hoàn tất
+    assert clock.monotonic() <= api.generation_time + task_queue.poll_interval
+    assert drained.is_set()
+    assert api.calls['create'] == 2
+    snapshot = task_queue.snapshot
+    assert (snapshot.completed, snapshot.queued, snapshot.draining) == (2, 3, False)
+
+
+def test_pause_and_resume(make_queue):
+    task_queue, api, _ = make_queue(jitter=0, tasks=3)
+    task_queue.pause()
+    assert task_queue.run_once() is None
+    assert task_queue.snapshot.paused
+    assert 'create' not in api.calls
+
+    task_queue.resume()
+    task_queue.run_once()
+    assert not task_queue.snapshot.paused
+    assert api.calls['create'] == 2
+
+
+def test_cancel_queued_and_active_tasks(make_queue):
+    clock = main.SimulatedClock()
+    task_queue, api, job_ids = make_queue(jitter=0, tasks=4, clock=clock)
+    task_queue.run_once()
+    assert task_queue.cancel_task(job_ids[0])  # đang chạy trên server
+    assert task_queue.cancel_task(job_ids[3])  # còn trong hàng đợi
+    assert not task_queue.cancel_task(job_ids[3])
+
+    main.run_simulation(task_queue, clock)
+    statuses = [task_queue.jobs[job_id]['status'] for job_id in job_ids]
+    assert statuses == ['cancelled', 'completed', 'completed', 'cancelled']
+    assert api.calls['create'] == 3
+    assert sum(entry['in_flight'] for entry in api.key_pool.entries.values()) == 0
+
+
+def test_cancel_all(make_queue):
+    task_queue, _, _ = make_queue(jitter=0, tasks=5)
+    task_queue.run_once()
+    assert task_queue.cancel_all() == 5
+    snapshot = task_queue.snapshot
+    assert (snapshot.cancelled, snapshot.queued, snapshot.active) == (5, 0, 0)
+    assert task_queue.unfinished_count() == 0
+
+
+def test_cancel_while_submitting_survives_requeue(make_queue):
+    task_queue, api, job_ids = make_queue(jitter=0, tasks=2)
+    original = api.create_video_task
+
+    def create_video_task(*args, **kwargs):
+        # Người dùng hủy đúng lúc task đang được gửi, rồi không còn key nào nhận task
+        task_queue.cancel_task(job_ids[0])
+        api.create_video_task = original
+        raise main.NoAvailableKeyError("Không còn API key khả dụng")
+
+    api.create_video_task = create_video_task
+    task_queue.run_once()
+
+    assert task_queue.jobs[job_ids[0]]['status'] == 'cancelled'
+    snapshot = task_queue.snapshot
+    assert (snapshot.cancelled, snapshot.queued) == (1, 1)
+    task_queue.run_once()
+    assert task_queue.jobs[job_ids[1]]['status'] == 'processing'
+
+
+class HookedLock:
+    """Khóa chạy hook một lần ngay trước khi lấy khóa, để chen thao tác vào đúng khe giữa kiểm tra và khóa"""
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.hook = None
+
+    def __enter__(self):
+        hook, self.hook = self.hook, None
+        if hook:
+            hook()
+        return self.lock.__enter__()
+
+    def __exit__(self, *exc):
+        return self.lock.__exit__(*exc)
+
+
+def test_cancel_while_download_finishes_counts_once(make_queue):
+    clock = main.SimulatedClock()
+    task_queue, api, job_ids = make_queue(jitter=0, tasks=1, clock=clock)
+    task_queue.lock = HookedLock(task_queue.lock)
+    original = api.download_video
+    finished = []
+    task_queue.on_task_completed = finished.append
+    task_queue.on_task_cancelled = finished.append
+
+    def download_video(*args, **kwargs):
+        # Tải xong, người dùng hủy đúng lúc callback hoàn tất chuẩn bị lấy khóa hàng đợi
+        path = original(*args, **kwargs)
+        task_queue.lock.hook = lambda: task_queue.cancel_task(job_ids[0])
+        return path
+
+    api.download_video = download_video
+    task_queue.run_once()
+    clock.advance(api.generation_time)
+    task_queue.run_once()
+
+    task_info = task_queue.jobs[job_ids[0]]
+    assert task_info['status'] == 'cancelled'
+    assert finished == [task_info]
+    assert (task_queue.cancelled_tasks, task_queue.completed_tasks) == ([task_info], [])
+    snapshot = task_queue.snapshot
+    assert (snapshot.cancelled, snapshot.completed, snapshot.downloading) == (1, 0, 0)
+    manifest = task_queue.get_manifest(os.path.dirname(task_info['output_filename']))
+    assert not manifest.entries
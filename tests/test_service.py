@@ -0,0 +1,129 @@
+import asyncio
+import socket
+
+import pytest
+import requests
+
+import main
+
+
+@pytest.fixture
+def service(make_queue, tmp_path):
+    task_queue, _, _ = make_queue(poll_interval=5)
+    (tmp_path / "in").mkdir()
+    (tmp_path / "in" / "a.png").write_bytes(b"png")
+    (tmp_path / "secret.png").write_bytes(b"png")
+    job_service = main.JobService(task_queue, port=0, output_folder=str(tmp_path / "out"),
+                                  input_folder=str(tmp_path / "in"), token_file=str(tmp_path / "token"))
+    job_service.start()
+    job_service.base = f"http://127.0.0.1:{job_service.port}"
+    job_service.auth = {'X-Auth-Token': job_service.token}
+    yield job_service
+    job_service.stop()
+
+
+def post_tasks(service, payload, headers=None):
+    return requests.post(service.base + "/tasks", json=payload, headers=dict(service.auth, **(headers or {})))
+
+
+def test_token_is_persisted(service, tmp_path):
+    assert main.load_service_token(str(tmp_path / "token")) == service.token
+
+
+def test_rejects_missing_token(service):
+    assert requests.get(service.base + "/health").status_code == 401
+    assert requests.get(service.base + "/health", headers={'X-Auth-Token': "sai"}).status_code == 401
+    assert requests.get(service.base + "/health", headers=service.auth).status_code == 200
+
+
+def test_rejects_foreign_host(service):
+    headers = dict(service.auth, Host=f"attacker.example:{service.port}")
+    assert requests.get(service.base + "/health", headers=headers).status_code == 403
+    headers = dict(service.auth, Host=f"localhost:{service.port}")
+    assert requests.get(service.base + "/health", headers=headers).status_code == 200
+
+
+def test_requires_json_content_type(service, tmp_path):
+    body = '{"image_path": "%s", "prompt": "p"}' % (tmp_path / "in" / "a.png")
+    response = requests.post(service.base + "/tasks", data=body,
+                             headers=dict(service.auth, **{'Content-Type': "text/plain"}))
+    assert response.status_code == 415
+
+
+def test_rejects_paths_outside_allowed_folders(service, tmp_path):
+    image = str(tmp_path / "in" / "a.png")
+    assert post_tasks(service, {'image_path': str(tmp_path / "secret.png"), 'prompt': "p"}).status_code == 400
+    assert post_tasks(service, {'image_path': image, 'prompt': "p",
+                                'output_filename': "../escape.mp4"}).status_code == 400
+    assert post_tasks(service, {'image_path': image, 'prompt': "p",
+                                'output_filename': str(tmp_path / "escape.mp4")}).status_code == 400
+    assert post_tasks(service, {'tasks': [{'image_path': image, 'prompt': "p"}],
+                                'output_folder': str(tmp_path)}).status_code == 400
+    assert service.task_queue.snapshot.total == 0
+
+    response = post_tasks(service, {'tasks': [{'image_path': image, 'prompt': "p", 'output_filename': "a.mp4"}],
+                                    'output_folder': "sub"})
+    assert response.status_code == 202
+    job = service.task_queue.jobs[response.json()['job_ids'][0]]
+    assert job['output_filename'] == str(tmp_path / "out" / "sub" / "a.mp4")
+
+
+def test_rejects_malformed_content_length(service):
+    with socket.create_connection(("127.0.0.1", service.port)) as sock:
+        sock.sendall(f"POST /tasks HTTP/1.1\r\nHost: 127.0.0.1:{service.port}\r\n"
+                     f"X-Auth-Token: {service.token}\r\nContent-Length: abc\r\n\r\n".encode())
+        assert sock.recv(1024).startswith(b"HTTP/1.1 400 ")
+
+
+def test_batch_is_visible_right_after_submit(service, tmp_path):
+    service._refresh = lambda: None  # chỉ dựa vào việc ghi nhận lô khi tạo task
+    response = post_tasks(service, {'tasks': [{'image_path': str(tmp_path / "in" / "a.png"), 'prompt': "p"}] * 3})
+    assert response.status_code == 202
+    batch = requests.get(service.base + f"/batches/{response.json()['batch_id']}", headers=service.auth)
+    assert batch.status_code == 200
+    assert batch.json()['total'] == 3
+
+
+def read_headers(job_service, data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await job_service._read_headers(reader)
+    return asyncio.run(run())
+
+
+def test_limits_header_count_and_size(make_queue, tmp_path):
+    task_queue, _, _ = make_queue()
+    job_service = main.JobService(task_queue, token_file=str(tmp_path / "token"))
+    assert read_headers(job_service, b"Host: a\r\nX-A: 1\r\n\r\n") == {'host': "a", 'x-a': "1"}
+    assert read_headers(job_service, b"X-A: 1\r\n" * (job_service.MAX_HEADERS + 1) + b"\r\n") is None
+    assert read_headers(job_service, (b"X-A: " + b"a" * 1000 + b"\r\n") * 70 + b"\r\n") is None
+    # Một dòng dài hơn giới hạn đệm của StreamReader
+    assert read_headers(job_service, b"X-A: " + b"a" * 70000 + b"\r\n\r\n") is None
+
+
+def test_rejects_non_string_fields(service, tmp_path):
+    image = str(tmp_path / "in" / "a.png")
+    for task in ({'image_path': [image], 'prompt': "p"}, {'image_path': image, 'prompt': {'text': "p"}},
+                 {'image_path': image, 'prompt': "p", 'model': 1}):
+        assert post_tasks(service, {'tasks': [task]}).status_code == 400
+    assert post_tasks(service, {'tasks': [{'image_path': image, 'prompt': "p"}], 'model': ["m"]}).status_code == 400
+    assert service.task_queue.snapshot.total == 0
+
+
+def test_refresh_rescans_only_unfinished_jobs(make_queue, tmp_path):
+    task_queue, _, job_ids = make_queue(tasks=3)
+    job_service = main.JobService(task_queue, token_file=str(tmp_path / "token"))
+    job_service._refresh()
+    assert set(job_service.unfinished) == set(job_ids)
+
+    task_queue.cancel_task(job_ids[0])
+    job_service._refresh()
+    assert job_service.statuses[job_ids[0]] == 'cancelled'
+    assert set(job_service.unfinished) == set(job_ids[1:])
+
+    new_job = task_queue.add_task("a.png", "p", str(tmp_path / "new.mp4"))
+    job_service._refresh()
+    assert set(job_service.unfinished) == set(job_ids[1:] + [new_job])
+    assert job_service.batches[None]['counts'] == {'cancelled': 1, 'queued': 3}
@@ -0,0 +1,55 @@
+import main
+
+
+def test_throughput_close_to_capacity():
+    result = main.simulate_queue(300, max_concurrent_tasks=5, keys=2, poll_interval=10, generation_time=240)
+    assert result['completed'] == 300
+    assert result['failed'] == result['retries'] == 0
+    # 10 suất chạy song song, mỗi task mất khoảng generation_time cộng tối đa một chu kỳ truy vấn
+    capacity_per_hour = 10 * 3600 / (240 + 10)
+    assert result['throughput_per_hour'] >= 0.9 * capacity_per_hour
+    assert result['estimated_remaining'] == 0
+
+
+def test_api_call_counts():
+    result = main.simulate_queue(200, max_concurrent_tasks=4, keys=1, poll_interval=10, generation_time=240)
+    calls = result['api_calls']
+    assert calls['create'] == 200
+    assert calls['retrieve'] == calls['download'] == 200
+    # Mỗi task được truy vấn khoảng một lần mỗi poll_interval trong lúc tạo video
+    assert 240 / 10 <= result['queries_per_task'] <= 240 / 10 + 3
+
+
+def test_retries_are_counted_as_extra_creates():
+    result = main.simulate_queue(300, max_concurrent_tasks=5, keys=2, generation_time=240,
+                                 failure_rate=0.1, max_retries=2, seed=3)
+    assert result['completed'] + result['failed'] == 300
+    assert result['retries'] > 0
+    assert result['api_calls']['create'] == 300 + result['retries']
+    assert result['api_calls']['download'] == result['completed']
+
+
+def test_tasks_start_in_fifo_order():
+    result = main.simulate_queue(500, max_concurrent_tasks=3, keys=3, generation_time=120, failure_rate=0.05,
+                                 max_retries=1, seed=7)
+    assert result['out_of_order_starts'] == 0
+    assert result['max_queue_wait'] <= result['makespan']
+
+
+def test_simulation_is_deterministic():
+    assert main.simulate_queue(100, seed=5) == main.simulate_queue(100, seed=5)
+
+
+def test_models_share_capacity_round_robin(make_queue, tmp_path):
+    clock = main.SimulatedClock()
+    task_queue, _, _ = make_queue(clock=clock)
+    for i in range(20):
+        task_queue.add_task("a.png", "p", str(tmp_path / f"a{i}.mp4"), model="A", source_digest="d")
+    for i in range(5):
+        task_queue.add_task("b.png", "p", str(tmp_path / f"b{i}.mp4"), model="B", source_digest="d")
+    main.run_simulation(task_queue, clock)
+
+    # Lô model B thêm sau không phải chờ hết 20 task model A
+    starts = sorted(task_queue.jobs.values(), key=lambda task: task['start_time'])
+    order = [task['model'] for task in starts]
+    assert order[:10].count("B") == 5
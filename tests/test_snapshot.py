@@ -0,0 +1,67 @@
+import threading
+import time
+
+import main
+
+
+def test_snapshot_reads_during_submit_and_cancel(make_queue, tmp_path):
+    # Hàng đợi chạy thật trên luồng riêng (ScaledClock), tự khởi động ở lần add_task đầu tiên
+    task_queue, _, _ = make_queue(clock=main.ScaledClock(500), keys=4, max_tasks_per_key=5, generation_time=60,
+                                  failure_rate=0.1, seed=3, max_concurrent_tasks=20, poll_interval=1,
+                                  inline=False, running=False, max_retries=1, retry_delay=5)
+    stop = threading.Event()
+    errors = []
+    reads = [0]
+
+    def writer(number):
+        job_ids = []
+        for i in range(200):
+            job_ids.append(task_queue.add_task("sim.png", "p", str(tmp_path / f"{number}_{i}.mp4"),
+                                               source_digest="sim"))
+            if i % 7 == 0:
+                task_queue.cancel_task(job_ids[i // 2])  # hủy cả task còn chờ lẫn task đang chạy
+            time.sleep(0.0005)
+
+    def reader():
+        previous = task_queue.snapshot
+        while not stop.is_set():
+            snapshot = task_queue.snapshot
+            if snapshot.version < previous.version:
+                errors.append(("version giảm", previous.version, snapshot.version))
+            if snapshot.version == previous.version and snapshot != previous:
+                errors.append(("cùng version khác nội dung", snapshot))
+            finished = snapshot.completed + snapshot.failed + snapshot.cancelled
+            if finished < previous.completed + previous.failed + previous.cancelled:
+                errors.append(("số task đã kết thúc giảm", previous, snapshot))
+            if min(snapshot.queued, snapshot.active, snapshot.downloading) < 0:
+                errors.append(("số âm", snapshot))
+            if snapshot.queued + snapshot.active + snapshot.downloading + finished > snapshot.total:
+                errors.append(("tổng vượt total", snapshot))
+            if len(snapshot.active_starts) != snapshot.active:
+                errors.append(("active_starts lệch", snapshot))
+            previous = snapshot
+            reads[0] += 1
+            time.sleep(0)  # nhường GIL cho luồng xử lý hàng đợi
+
+    writers = [threading.Thread(target=writer, args=(number,)) for number in range(4)]
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in readers + writers:
+        thread.start()
+    try:
+        for thread in writers:
+            thread.join()
+        deadline = time.monotonic() + 30
+        while task_queue.unfinished_count() and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        for thread in readers:
+            thread.join()
+        task_queue.stop_processing()
+
+    assert not errors, errors[:3]
+    assert reads[0] > 1000
+    snapshot = task_queue.snapshot
+    assert snapshot.total == 800
+    assert snapshot.completed + snapshot.failed + snapshot.cancelled == 800
+    assert snapshot.cancelled == sum(1 for task in task_queue.jobs.values() if task['status'] == 'cancelled')
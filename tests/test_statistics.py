@@ -0,0 +1,16 @@
+import main
+
+
+def test_cancelled_tasks_do_not_count_as_throughput(make_queue):
+    clock = main.SimulatedClock()
+    task_queue, _, job_ids = make_queue(tasks=10, clock=clock)
+    statistics = main.TaskStatisticsManager(task_queue, clock=clock)
+    task_queue.run_once()
+    for job_id in job_ids[4:]:
+        task_queue.cancel_task(job_id)
+    main.run_simulation(task_queue, clock)
+    statistics.update_stats()
+
+    assert task_queue.snapshot.completed == 4
+    assert statistics.throughput.total == 4
+    assert statistics.models["I2V-01-Director"]['throughput'].total == 4
@@ -0,0 +1,29 @@
+import pandas as pd
+import pytest
+
+import main
+
+
+def test_applies_format_spec_and_conversion():
+    template = main.PromptTemplate("{scene!r} lúc {hour:02d}h, tốc độ {speed:.1f}")
+    data = pd.DataFrame({'scene': ["phố", None], 'hour': [7, 21], 'speed': [1.25, 3.0]})
+    assert list(template.expand(data)) == ["'phố' lúc 07h, tốc độ 1.2", "lúc 21h, tốc độ 3.0"]
+    assert template.render({'scene': "phố", 'hour': 7, 'speed': 1.25}) == "'phố' lúc 07h, tốc độ 1.2"
+
+
+def test_plain_fields_unchanged():
+    template = main.PromptTemplate("{a} và {b}")
+    data = pd.DataFrame({'a': ["x", None], 'b': [1, 2]})
+    assert list(template.expand(data)) == ["x và 1", "và 2"]
+
+
+@pytest.mark.parametrize("text", ["{a!x}", "{a:{width}}", "{}"])
+def test_rejects_invalid_fields(text):
+    with pytest.raises(ValueError):
+        main.PromptTemplate(text)
+
+
+def test_format_error_is_value_error():
+    template = main.PromptTemplate("{a:.2f}")
+    with pytest.raises(ValueError, match="a"):
+        template.expand(pd.DataFrame({'a': ["chữ"]}))
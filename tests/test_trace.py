@@ -0,0 +1,56 @@
+import json
+import time
+
+import main
+
+
+class RecordedAPI(main.SimulatedAPI):
+    """SimulatedAPI ghi trace như MiniMaxAPI: request qua recorder, lượt tải qua MiniMaxAPI.download_video"""
+
+    download_video = main.MiniMaxAPI.download_video
+
+    def _send(self, op, method, url, api_key, task_id=None, **kwargs):
+        start = time.monotonic()
+        response = super()._send(op, method, url, api_key, task_id=task_id, **kwargs)
+        self.recorder.record(op, start, task_id=task_id, status=response.status_code,
+                             body=json.dumps(response.json()))
+        return response
+
+    def _download(self, download_url, output_path, throttle, should_stop, before_write):
+        if before_write:
+            before_write(1024)
+        with open(output_path, 'wb') as f:
+            f.write(b"\0" * 1024)
+
+
+def test_record_load_and_replay_round_trip(tmp_path):
+    path = str(tmp_path / "trace.jsonl.gz")
+    clock = main.SimulatedClock()
+    api = RecordedAPI(clock, generation_time=60, failure_rate=0.0)
+    api.recorder = main.TraceRecorder(path)
+    downloads = main.DownloadManager(post_processing=(), min_free_space_mb=0, clock=clock, inline=True)
+    task_queue = main.TaskQueueManager(api, max_concurrent_tasks=2, poll_interval=10,
+                                       download_manager=downloads, clock=clock)
+    task_queue.running = True
+    for i in range(5):
+        task_queue.add_task("a.png", "p", str(tmp_path / "out" / f"{i}.mp4"), source_digest="d")
+    main.run_simulation(task_queue, clock)
+    api.recorder.close()
+    assert task_queue.snapshot.completed == 5
+
+    entries = main.load_trace(path)
+    recorded = {}
+    for entry in entries:
+        recorded[entry['op']] = recorded.get(entry['op'], 0) + 1
+    assert recorded == dict(api.calls, download=5)
+    assert all(entry['status'] == 200 for entry in entries if entry['op'] != 'download')
+    assert [entry['size'] for entry in entries if entry['op'] == 'download'] == [1024] * 5
+
+    replay = main.TraceReplayAPI(entries)
+    assert len(replay.creates) == 5
+    assert set(replay.downloads) == set(replay.retrieves) == set(replay.queries)
+
+    result = main.replay_trace(path, max_concurrent_tasks=2, poll_interval=1, speed=1000, timeout=30)
+    assert (result['completed'], result['failed']) == (5, 0)
+    assert result['api_calls']['create'] == 5
+    assert result['api_calls']['download'] == 5
@@ -0,0 +1,34 @@
+import base64
+import os
+
+import main
+
+
+def make_body(tmp_path, chunk_size=7):
+    image = tmp_path / "a.png"
+    image.write_bytes(os.urandom(100))
+    parts = [b'{"model": "m", "first_frame_image": "', main.Base64File(str(image)), b'"}']
+    expected = parts[0] + base64.b64encode(image.read_bytes()) + parts[2]
+    return main.StreamingBody(parts, chunk_size=chunk_size), expected
+
+
+def test_read_in_sizes_across_chunk_boundaries(tmp_path):
+    for size in (1, 5, 7, 13):
+        body, expected = make_body(tmp_path)
+        assert len(body) == len(expected)
+        pieces = []
+        while True:
+            data = body.read(size)
+            if not data:
+                break
+            assert isinstance(data, bytes) and len(data) <= size
+            pieces.append(data)
+        assert b"".join(pieces) == expected
+
+
+def test_read_rest_after_partial_read(tmp_path):
+    body, expected = make_body(tmp_path)
+    assert body.read(0) == b""
+    head = body.read(10)
+    assert head + body.read() == expected
+    assert body.read() == b""
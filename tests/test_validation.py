@@ -0,0 +1,15 @@
+import main
+
+
+def test_validate_does_not_create_output_folder(tmp_path):
+    output_folder = tmp_path / "out" / "sub"
+    report = main.BatchValidator().validate([(str(tmp_path / "missing.png"), "p")], str(output_folder))
+    assert not (tmp_path / "out").exists()
+    assert report.free_bytes > 0
+    assert [label for label, _ in report.errors] == ["missing.png"]
+
+
+def test_validate_rejects_output_under_a_file(tmp_path):
+    (tmp_path / "file").write_text("x")
+    report = main.BatchValidator().validate([], str(tmp_path / "file" / "out"))
+    assert report.errors and report.errors[0][0] == str(tmp_path / "file" / "out")